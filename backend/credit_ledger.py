@@ -0,0 +1,204 @@
+"""
+credit_ledger.py - Compaction of the credits ledger.
+
+Every share report inserts one credits row, so the table grows by millions of rows a day. The
+ledger of a miner is the union of three disjoint time ranges:
+ - credits:        raw per-report rows, newer than raw_days
+ - credit_rollups: one row per miner and hour (period 3600) for older credits, and one row per miner
+                   and day (period 86400) for hours older than hourly_days
+compact() moves the oldest raw rows into hourly rows and the oldest hourly rows into daily rows, in
+short transactions of at most batch_size rows, so the database (and its indexes) stays small. Raw
+rows are appended to gzip archives (one file per month, <archive_dir>/credits-YYYY-MM.csv.gz)
+before they are deleted; every run appends a new gzip member, which gzip readers see as one stream.
+A crash between the archive write and the commit can leave a few rows archived twice: readers
+dedupe on the credit id (read_archive() does).
+
+miners.balance and miners.shares are never touched: moving a row between credits and
+credit_rollups keeps the per-miner totals of the ledger unchanged. verify() checks that:
+ - miners.shares equals the shares of the ledger (raw + rollups) for every miner
+ - miners.balance is not higher than the amount credited by the ledger (withdrawals are not
+   attributed to miners, so the difference is what was paid out or is pending)
+"""
+
+import csv
+import gzip
+import io
+import os
+import time
+
+from db import get_pool
+
+HOUR = 3600
+DAY = 86400
+ARCHIVE_FIELDS = ("id", "miner_id", "shares", "amount", "created_at")
+# float sums in a different order differ in the last bits
+TOLERANCE = 1e-6
+
+UPSERT_SQL = (
+    "INSERT INTO credit_rollups (miner_id, period, bucket, shares, amount, credits) VALUES (?,?,?,?,?,?) "
+    "ON CONFLICT(miner_id, period, bucket) DO UPDATE SET shares = shares + excluded.shares, "
+    "amount = amount + excluded.amount, credits = credits + excluded.credits"
+)
+
+
+def archive_path(archive_dir, ts):
+    return os.path.join(archive_dir, time.strftime("credits-%Y-%m.csv.gz", time.gmtime(ts)))
+
+
+def append_archive(archive_dir, rows):
+    """Append raw credit rows to the monthly archives (a new gzip member per file), fsynced."""
+    by_file = {}
+    for r in rows:
+        by_file.setdefault(archive_path(archive_dir, r["created_at"] or 0), []).append(r)
+    os.makedirs(archive_dir, exist_ok=True)
+    for path, file_rows in by_file.items():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        if not os.path.exists(path):
+            writer.writerow(ARCHIVE_FIELDS)
+        writer.writerows([r[k] for k in ARCHIVE_FIELDS] for r in file_rows)
+        with open(path, "ab") as f:
+            f.write(gzip.compress(buf.getvalue().encode("utf-8"), 6))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def read_archive(path):
+    """Yield the archived credits of one file as dicts, each credit id once."""
+    seen = set()
+    with gzip.open(path, "rt", newline="") as f:
+        for row in csv.DictReader(f):
+            if row["id"] in seen:
+                continue
+            seen.add(row["id"])
+            yield row
+
+
+def _accumulate(totals, miner_id, bucket, shares, amount, credits):
+    t = totals.setdefault((miner_id, bucket), [0.0, 0.0, 0])
+    t[0] += shares or 0
+    t[1] += amount or 0
+    t[2] += credits
+
+
+def _roll_raw(conn, cutoff, batch_size, archive_dir):
+    """One batch of raw credits older than cutoff -> hourly rollups. Returns rows moved."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(
+            "SELECT id, miner_id, shares, amount, created_at FROM credits WHERE created_at < ? "
+            "ORDER BY created_at, id LIMIT ?", (cutoff, batch_size)).fetchall()
+        if not rows:
+            conn.rollback()
+            return 0
+        if archive_dir:
+            append_archive(archive_dir, rows)
+        totals = {}
+        for r in rows:
+            _accumulate(totals, r["miner_id"], (r["created_at"] or 0) // HOUR * HOUR, r["shares"], r["amount"], 1)
+        conn.executemany(UPSERT_SQL, [(m, HOUR, b, t[0], t[1], t[2]) for (m, b), t in totals.items()])
+        conn.executemany("DELETE FROM credits WHERE id=?", [(r["id"],) for r in rows])
+        conn.commit()
+        return len(rows)
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _roll_hourly(conn, cutoff, batch_size):
+    """One batch of hourly rollups older than cutoff -> daily rollups. Returns rows moved."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(
+            "SELECT miner_id, bucket, shares, amount, credits FROM credit_rollups WHERE period=? AND bucket < ? "
+            "ORDER BY bucket, miner_id LIMIT ?", (HOUR, cutoff, batch_size)).fetchall()
+        if not rows:
+            conn.rollback()
+            return 0
+        totals = {}
+        for r in rows:
+            _accumulate(totals, r["miner_id"], r["bucket"] // DAY * DAY, r["shares"], r["amount"], r["credits"])
+        conn.executemany(UPSERT_SQL, [(m, DAY, b, t[0], t[1], t[2]) for (m, b), t in totals.items()])
+        conn.executemany("DELETE FROM credit_rollups WHERE miner_id=? AND period=? AND bucket=?",
+                         [(r["miner_id"], HOUR, r["bucket"]) for r in rows])
+        conn.commit()
+        return len(rows)
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def compact(db_path, raw_days=7, hourly_days=90, archive_dir=None, batch_size=5000, now=None, log=None):
+    """
+    Roll raw credits older than raw_days into hourly rows (archiving them to archive_dir when set)
+    and hourly rows older than hourly_days into daily rows. Cutoffs are aligned to whole hours /
+    days so a bucket is never split between two tiers. Returns {"raw_rows": n, "hourly_rows": n}.
+    """
+    now = int(time.time() if now is None else now)
+    raw_cutoff = (now - raw_days * DAY) // HOUR * HOUR
+    hourly_cutoff = (now - hourly_days * DAY) // DAY * DAY
+    pool = get_pool(db_path)
+    conn = pool.acquire()
+    stats = {"raw_rows": 0, "hourly_rows": 0}
+    try:
+        while True:
+            moved = _roll_raw(conn, raw_cutoff, batch_size, archive_dir)
+            if not moved:
+                break
+            stats["raw_rows"] += moved
+            if log:
+                log(f"rolled {stats['raw_rows']} raw credits into hourly rows")
+        while True:
+            moved = _roll_hourly(conn, hourly_cutoff, batch_size)
+            if not moved:
+                break
+            stats["hourly_rows"] += moved
+            if log:
+                log(f"rolled {stats['hourly_rows']} hourly rows into daily rows")
+    finally:
+        pool.release(conn)
+    return stats
+
+
+def ledger_totals(conn):
+    """{miner_id: [shares, amount]} summed over raw credits and both rollup tiers."""
+    totals = {}
+    for sql in ("SELECT miner_id, SUM(shares) AS shares, SUM(amount) AS amount FROM credits GROUP BY miner_id",
+                "SELECT miner_id, SUM(shares) AS shares, SUM(amount) AS amount FROM credit_rollups GROUP BY miner_id"):
+        for r in conn.execute(sql):
+            t = totals.setdefault(r["miner_id"], [0.0, 0.0])
+            t[0] += r["shares"] or 0
+            t[1] += r["amount"] or 0
+    return totals
+
+
+def verify(db_path):
+    """
+    Compare miners.shares / miners.balance with the ledger. Returns {"ok", "miners", "problems": [...]}
+    where each problem is {"miner_id", "error", ...}.
+    """
+    pool = get_pool(db_path)
+    conn = pool.acquire()
+    try:
+        # one read transaction so the ledger and the balances are from the same snapshot
+        conn.execute("BEGIN")
+        totals = ledger_totals(conn)
+        miners = conn.execute("SELECT id, balance, shares FROM miners").fetchall()
+        conn.rollback()
+    finally:
+        pool.release(conn)
+    problems = []
+    seen = set()
+    for m in miners:
+        seen.add(m["id"])
+        shares, amount = totals.get(m["id"], (0.0, 0.0))
+        if abs((m["shares"] or 0) - shares) > TOLERANCE * max(1.0, shares):
+            problems.append({"miner_id": m["id"], "error": "shares mismatch", "miner_shares": m["shares"],
+                             "ledger_shares": shares})
+        if (m["balance"] or 0) > amount + TOLERANCE * max(1.0, amount):
+            problems.append({"miner_id": m["id"], "error": "balance above credited amount", "balance": m["balance"],
+                             "ledger_amount": amount})
+    for miner_id in totals:
+        if miner_id not in seen:
+            problems.append({"miner_id": miner_id, "error": "ledger rows for an unknown miner"})
+    return {"ok": not problems, "miners": len(miners), "problems": problems}
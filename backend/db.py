@@ -0,0 +1,443 @@
+"""
+db.py - SQLite access layer for the backend.
+This module provides:
+ - a thread-safe pool of long-lived connections (one pool per database file)
+ - per-connection tuning: WAL journal, synchronous=NORMAL, memory-mapped I/O, page cache, busy timeout
+ - versioned schema migrations tracked with PRAGMA user_version
+Pools are per process: a forked worker (gunicorn) never reuses connections opened by its parent.
+
+Tuning is configurable via env vars: DB_POOL_SIZE, DB_MMAP_SIZE (bytes), DB_CACHE_SIZE
+(SQLite cache_size, negative = KiB) and DB_BUSY_TIMEOUT_MS.
+
+LOCK_STATS counts waits for a pooled connection. With DB_TRACK_LOCKS=1 (tools/bench_api.py)
+connections also count SQLite lock waits: SQLite's busy handler is replaced by an equivalent
+retry loop in Python that records every statement that had to wait for the database lock.
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE") or 8)
+MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE") or 256 * 1024 * 1024)
+CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE") or -64000)  # ~64 MiB
+BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS") or 5000)
+TRACK_LOCKS = (os.getenv("DB_TRACK_LOCKS") or "").lower() in ("1", "true", "yes")
+
+LOCK_STATS = {
+    "pool_waits": 0,          # acquire() had to block for a free connection
+    "pool_wait_seconds": 0.0,
+    "lock_waits": 0,          # statements that found the database locked (DB_TRACK_LOCKS only)
+    "lock_wait_seconds": 0.0,
+    "lock_timeouts": 0,       # ... and gave up after DB_BUSY_TIMEOUT_MS
+}
+_stats_lock = threading.Lock()
+
+# Each entry is (version, [statements]). Append new migrations at the end; never edit
+# a migration that has already shipped.
+MIGRATIONS = [
+    (1, [
+        """
+        CREATE TABLE IF NOT EXISTS withdrawals (
+            id TEXT PRIMARY KEY,
+            currency TEXT,
+            amount REAL,
+            to_address TEXT,
+            txid TEXT,
+            status TEXT,
+            created_at INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS miners (
+            id TEXT PRIMARY KEY,
+            owner TEXT,
+            worker_name TEXT,
+            balance REAL DEFAULT 0,
+            shares INTEGER DEFAULT 0,
+            created_at INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS credits (
+            id TEXT PRIMARY KEY,
+            miner_id TEXT,
+            shares INTEGER,
+            amount REAL,
+            created_at INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS psbts (
+            id TEXT PRIMARY KEY,
+            psbt TEXT,
+            status TEXT,
+            txid TEXT,
+            created_at INTEGER
+        )
+        """,
+        # used by /api/register, /api/login and /api/user/link_miner
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            username TEXT,
+            password_hash TEXT,
+            email TEXT,
+            created_at INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_miners (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            miner_id TEXT,
+            created_at INTEGER
+        )
+        """,
+    ]),
+    # keyset pagination orders by (created_at, id); include id so pages are served from the index
+    (2, [
+        "CREATE INDEX IF NOT EXISTS idx_withdrawals_created_id ON withdrawals (created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_withdrawals_status_created_id ON withdrawals (status, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_credits_created_id ON credits (created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_credits_miner_created_id ON credits (miner_id, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_miners_created_id ON miners (created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_psbts_created_at ON psbts (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)",
+        "CREATE INDEX IF NOT EXISTS idx_user_miners_user_id ON user_miners (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_user_miners_miner_id ON user_miners (miner_id)",
+    ]),
+    # payout_engine.py: one transaction per batch of withdrawals
+    (3, [
+        """
+        CREATE TABLE IF NOT EXISTS payout_batches (
+            id TEXT PRIMARY KEY,
+            status TEXT,
+            mode TEXT,
+            txid TEXT,
+            psbt_id TEXT,
+            payments INTEGER,
+            total REAL,
+            fee REAL,
+            fee_saved REAL,
+            rpc_seconds REAL,
+            rpc_seconds_saved REAL,
+            report TEXT,
+            error TEXT,
+            created_at INTEGER,
+            completed_at INTEGER
+        )
+        """,
+        "ALTER TABLE withdrawals ADD COLUMN batch_id TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_withdrawals_batch_id ON withdrawals (batch_id)",
+        "CREATE INDEX IF NOT EXISTS idx_payout_batches_created_id ON payout_batches (created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_payout_batches_status ON payout_batches (status)",
+    ]),
+    # job_queue.py: durable payout jobs (one per idempotency key)
+    (4, [
+        """
+        CREATE TABLE IF NOT EXISTS payout_jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT,
+            ref_id TEXT,
+            idempotency_key TEXT UNIQUE,
+            status TEXT,
+            attempts INTEGER DEFAULT 0,
+            max_attempts INTEGER,
+            run_at REAL,
+            locked_by TEXT,
+            locked_at REAL,
+            last_error TEXT,
+            result TEXT,
+            created_at REAL,
+            started_at REAL,
+            finished_at REAL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_payout_jobs_status_run_at ON payout_jobs (status, run_at)",
+    ]),
+    # mining_sim.SharedMiningSimulator: simulated accounts shared by all worker processes
+    (5, [
+        """
+        CREATE TABLE IF NOT EXISTS sim_accounts (
+            id TEXT PRIMARY KEY,
+            base_balance REAL DEFAULT 0,
+            since REAL,
+            hashrate REAL,
+            running INTEGER DEFAULT 0
+        )
+        """,
+    ]),
+    # hashrate_stats.py: difficulty-weighted shares per minute / hour (worker_name '' = whole miner,
+    # miner_id '' = whole pool)
+    (6, [
+        """
+        CREATE TABLE IF NOT EXISTS hashrate_rollups (
+            miner_id TEXT NOT NULL,
+            worker_name TEXT NOT NULL,
+            resolution INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            shares REAL NOT NULL,
+            PRIMARY KEY (miner_id, worker_name, resolution, bucket)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_hashrate_rollups_resolution_bucket ON hashrate_rollups (resolution, bucket)",
+    ]),
+    # credit_ledger.py: compacted credits, one row per miner and hour (period 3600) or day (86400)
+    (7, [
+        """
+        CREATE TABLE IF NOT EXISTS credit_rollups (
+            miner_id TEXT NOT NULL,
+            period INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            shares REAL NOT NULL,
+            amount REAL NOT NULL,
+            credits INTEGER NOT NULL,
+            PRIMARY KEY (miner_id, period, bucket)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_credit_rollups_period_bucket ON credit_rollups (period, bucket)",
+    ]),
+    # stratum_auth.SqliteAuth: workers whose credentials changed (links added, moved or removed,
+    # passwords changed, accounts deleted), filled by triggers; entries older than a day are pruned
+    (8, [
+        """
+        CREATE TABLE IF NOT EXISTS auth_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            miner_id TEXT,
+            changed_at INTEGER NOT NULL
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_user_miners_insert_auth AFTER INSERT ON user_miners BEGIN
+            INSERT INTO auth_changes (miner_id, changed_at) VALUES (NEW.miner_id, strftime('%s', 'now'));
+            DELETE FROM auth_changes WHERE changed_at < strftime('%s', 'now') - 86400;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_user_miners_update_auth AFTER UPDATE ON user_miners BEGIN
+            INSERT INTO auth_changes (miner_id, changed_at) VALUES (OLD.miner_id, strftime('%s', 'now'));
+            INSERT INTO auth_changes (miner_id, changed_at) VALUES (NEW.miner_id, strftime('%s', 'now'));
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_user_miners_delete_auth AFTER DELETE ON user_miners BEGIN
+            INSERT INTO auth_changes (miner_id, changed_at) VALUES (OLD.miner_id, strftime('%s', 'now'));
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_update_auth AFTER UPDATE OF id, password_hash ON users BEGIN
+            INSERT INTO auth_changes (miner_id, changed_at)
+                SELECT miner_id, strftime('%s', 'now') FROM user_miners WHERE user_id IN (OLD.id, NEW.id);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_delete_auth AFTER DELETE ON users BEGIN
+            INSERT INTO auth_changes (miner_id, changed_at)
+                SELECT miner_id, strftime('%s', 'now') FROM user_miners WHERE user_id = OLD.id;
+        END
+        """,
+    ]),
+    # server.login_attempt_limit: failed logins per username, shared by all worker processes
+    (9, [
+        """
+        CREATE TABLE IF NOT EXISTS login_failures (
+            key TEXT PRIMARY KEY,
+            window_start INTEGER NOT NULL,
+            failures INTEGER NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_login_failures_window_start ON login_failures (window_start)",
+    ]),
+    # server.api_report_shares: batch ids already credited, with the answer sent for them
+    (10, [
+        """
+        CREATE TABLE IF NOT EXISTS report_batches (
+            id TEXT PRIMARY KEY,
+            result TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_report_batches_created_at ON report_batches (created_at)",
+    ]),
+]
+
+
+def _count(**deltas):
+    with _stats_lock:
+        for key, value in deltas.items():
+            LOCK_STATS[key] += value
+
+
+def reset_lock_stats():
+    with _stats_lock:
+        for key in LOCK_STATS:
+            LOCK_STATS[key] = type(LOCK_STATS[key])()
+
+
+def _retry_locked(call, *args):
+    """Run call(*args), retrying while the database is locked, like SQLite's busy handler."""
+    started = None
+    delay = 0.001
+    while True:
+        try:
+            result = call(*args)
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) and "busy" not in str(e):
+                raise
+            now = time.perf_counter()
+            if started is None:
+                started = now
+            elif now - started >= BUSY_TIMEOUT_MS / 1000.0:
+                _count(lock_waits=1, lock_wait_seconds=now - started, lock_timeouts=1)
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+            continue
+        if started is not None:
+            _count(lock_waits=1, lock_wait_seconds=time.perf_counter() - started)
+        return result
+
+
+class TrackedCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        return _retry_locked(super().execute, *args)
+
+    def executemany(self, *args):
+        return _retry_locked(super().executemany, *args)
+
+
+class TrackedConnection(sqlite3.Connection):
+    def cursor(self, factory=TrackedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        return _retry_locked(super().commit)
+
+
+def connect(path):
+    """Open a tuned connection. Rows are returned as sqlite3.Row."""
+    if TRACK_LOCKS:
+        # busy timeout 0: lock waits happen (and are counted) in _retry_locked instead
+        conn = sqlite3.connect(path, check_same_thread=False, timeout=0, factory=TrackedConnection)
+    else:
+        conn = sqlite3.connect(path, check_same_thread=False, timeout=BUSY_TIMEOUT_MS / 1000.0)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size={CACHE_SIZE}")
+    conn.execute(f"PRAGMA busy_timeout={0 if TRACK_LOCKS else BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+class ConnectionPool:
+    """
+    Fixed-size pool of long-lived connections. Connections are created lazily up to max_size;
+    acquire() blocks (up to timeout seconds) once all of them are in use.
+    """
+
+    def __init__(self, path, max_size=POOL_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=30):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.max_size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return connect(self.path)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        started = time.perf_counter()
+        conn = self._idle.get(timeout=timeout)
+        _count(pool_waits=1, pool_wait_seconds=time.perf_counter() - started)
+        return conn
+
+    def release(self, conn):
+        try:
+            # never hand out a connection with a half-finished transaction
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+_pools = {}
+_pools_pid = os.getpid()
+_pools_lock = threading.Lock()
+
+
+def get_pool(path):
+    global _pools, _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            # forked: SQLite connections must not cross fork(), start with fresh pools
+            _pools, _pools_pid = {}, os.getpid()
+        pool = _pools.get(path)
+        if pool is None:
+            pool = _pools[path] = ConnectionPool(path)
+        return pool
+
+
+def migrate(path):
+    """
+    Apply pending migrations to the database at path. Returns the resulting schema version.
+    Safe to run from several processes at once: each step re-reads the version under a write lock.
+    """
+    conn = connect(path)
+    try:
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            pending = [m for m in MIGRATIONS if m[0] > current]
+            if not pending:
+                conn.rollback()
+                return current
+            version, statements = pending[0]
+            try:
+                for stmt in statements:
+                    conn.execute(stmt)
+                conn.execute(f"PRAGMA user_version={int(version)}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    finally:
+        conn.close()
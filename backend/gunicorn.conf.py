@@ -0,0 +1,38 @@
+"""
+gunicorn.conf.py - gunicorn settings for the backend (gunicorn -c gunicorn.conf.py wsgi:app).
+
+Shared state (balances, simulated accounts, payout jobs) lives in SQLite, so workers are plain
+processes with nothing to coordinate. Env overrides: PORT, WEB_CONCURRENCY (processes),
+GUNICORN_THREADS (threads per process), GUNICORN_WORKER_CLASS, GUNICORN_TIMEOUT, GUNICORN_PRELOAD,
+SSE_MAX_CLIENTS (open /api/stream connections per process).
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("WEB_CONCURRENCY") or min(4, multiprocessing.cpu_count() * 2))
+# threaded workers: each open /api/stream (SSE) connection holds one thread
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS") or 8)
+# so half the threads of a gthread worker stay free for API requests, streams past this answer 503
+# (the dashboard's EventSource reconnects). gevent / eventlet streams are greenlets: no cap. The
+# workers inherit the environment, server.py reads it.
+if worker_class in ("gevent", "eventlet"):
+    os.environ.setdefault("SSE_MAX_CLIENTS", "0")
+else:
+    os.environ.setdefault("SSE_MAX_CLIENTS", str(max(1, threads // 2)))
+timeout = int(os.getenv("GUNICORN_TIMEOUT") or 60)
+graceful_timeout = 20
+keepalive = 5
+preload_app = (os.getenv("GUNICORN_PRELOAD") or "false").lower() == "true"
+accesslog = os.getenv("GUNICORN_ACCESS_LOG") or None
+errorlog = "-"
+
+
+def post_fork(server, worker):
+    # with preload_app the app (and its threads) was created in the master; threads do not
+    # survive fork(), so start this worker's own SSE publisher and payout workers
+    if preload_app:
+        import server as backend
+        backend.start_background()
@@ -0,0 +1,261 @@
+"""
+hashrate_stats.py - Effective hashrate estimation and time-series rollups.
+
+Every credited share is difficulty-weighted, and one difficulty-1 share stands for 2**32 hashes on
+average, so hashrate over a window = shares_in_window * 2**32 / window_seconds.
+ - live estimates for 5m / 1h / 24h windows come from fixed-size ring buffers in memory, one set per
+   (miner, worker), per miner (worker "") and for the whole pool (miner "", worker ""). All rings live
+   in one flat array('d'): a worker costs `stride` doubles plus its dict entry, whatever its share rate,
+   and workers idle for longer than the longest window are evicted and their slot reused
+ - shares are also summed per minute and per hour and flushed by a background thread into the
+   hashrate_rollups table (one row per key and bucket, upserted), so history and charts are served
+   from a few rows instead of scanning credits; old buckets are pruned after their retention
+The rings are per process. With several worker processes (gunicorn) each one only sees the reports
+it handled, so server.py answers estimates from the rollups instead (see estimate_from_rollups).
+"""
+
+import atexit
+import logging
+import threading
+import time
+from array import array
+
+from db import get_pool
+
+logger = logging.getLogger('mining_backend')
+
+HASHES_PER_SHARE = 2 ** 32
+# (name, bucket seconds, buckets): 5 x 1 min, 12 x 5 min, 24 x 1 h
+WINDOWS = (("5m", 60, 5), ("1h", 300, 12), ("24h", 3600, 24))
+# rollup resolution (seconds) -> retention (seconds)
+ROLLUPS = {60: 2 * 86400, 3600: 90 * 86400}
+
+UPSERT_SQL = (
+    "INSERT INTO hashrate_rollups (miner_id, worker_name, resolution, bucket, shares) VALUES (?,?,?,?,?) "
+    "ON CONFLICT(miner_id, worker_name, resolution, bucket) DO UPDATE SET shares = shares + excluded.shares"
+)
+
+
+def to_hashrate(shares, seconds):
+    return shares * HASHES_PER_SHARE / seconds if seconds > 0 else 0.0
+
+
+class HashrateStats:
+    def __init__(self, db_path, windows=WINDOWS, rollups=ROLLUPS, flush_interval=10.0, prune_interval=600.0,
+                 clock=time.time):
+        self.db_path = db_path
+        self.windows = windows
+        self.rollups = rollups
+        self.flush_interval = flush_interval
+        self.prune_interval = prune_interval
+        self.clock = clock
+        # slot layout: [last_seen, epoch per window, buckets of window 0, buckets of window 1, ...]
+        self.offsets = []
+        offset = 1 + len(windows)
+        for _, _, count in windows:
+            self.offsets.append(offset)
+            offset += count
+        self.stride = offset
+        self.max_span = max(width * count for _, width, count in windows)
+        self.data = array('d')
+        self.slots = {}       # (miner_id, worker_name) -> slot index
+        self.free = []
+        self.by_miner = {}    # miner_id -> set of worker names with a slot
+        self.pending = {}     # (miner_id, worker_name, resolution, bucket) -> shares not yet flushed
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self._thread = None
+        self._last_prune = 0.0
+        self._last_evict = 0.0
+
+    # --- ring buffers ---
+
+    def _slot(self, key, now):
+        slot = self.slots.get(key)
+        if slot is not None:
+            return slot * self.stride
+        zeros = array('d', bytes(8 * self.stride))
+        if self.free:
+            slot = self.free.pop()
+            base = slot * self.stride
+            self.data[base:base + self.stride] = zeros
+        else:
+            slot = len(self.data) // self.stride
+            base = slot * self.stride
+            self.data.extend(zeros)
+        for i, (_, width, _) in enumerate(self.windows):
+            self.data[base + 1 + i] = now // width
+        self.slots[key] = slot
+        self.by_miner.setdefault(key[0], set()).add(key[1])
+        return base
+
+    def _advance(self, base, now):
+        """Move every ring of the slot at base to now, zeroing buckets that fell out of the window."""
+        data = self.data
+        for i, (_, width, count) in enumerate(self.windows):
+            idx = int(now // width)
+            last = int(data[base + 1 + i])
+            if idx <= last:
+                continue
+            off = base + self.offsets[i]
+            if idx - last >= count:
+                for k in range(count):
+                    data[off + k] = 0.0
+            else:
+                for k in range(last + 1, idx + 1):
+                    data[off + k % count] = 0.0
+            data[base + 1 + i] = idx
+
+    def add(self, miner_id, worker_name, shares, now=None):
+        """Record difficulty-weighted shares for a worker (and its miner and the pool totals)."""
+        now = self.clock() if now is None else now
+        miner_id, worker_name = str(miner_id or ""), str(worker_name or "")
+        if not miner_id:
+            return
+        keys = [(miner_id, worker_name), (miner_id, ""), ("", "")]
+        if not worker_name:
+            keys.pop(0)
+        data = self.data
+        with self.lock:
+            for key in keys:
+                base = self._slot(key, now)
+                self._advance(base, now)
+                data[base] = now
+                for i, (_, width, count) in enumerate(self.windows):
+                    data[base + self.offsets[i] + int(now // width) % count] += shares
+                for resolution in self.rollups:
+                    pkey = key + (resolution, int(now // resolution) * resolution)
+                    self.pending[pkey] = self.pending.get(pkey, 0.0) + shares
+
+    def estimate(self, miner_id="", worker_name="", now=None):
+        """{"5m": H/s, "1h": H/s, "24h": H/s} from the rings; zeros for an unknown key."""
+        now = self.clock() if now is None else now
+        out = {}
+        with self.lock:
+            slot = self.slots.get((str(miner_id), str(worker_name or "")))
+            if slot is not None:
+                base = slot * self.stride
+                self._advance(base, now)
+            for i, (name, width, count) in enumerate(self.windows):
+                if slot is None:
+                    out[name] = 0.0
+                    continue
+                off = base + self.offsets[i]
+                total = sum(self.data[off:off + count])
+                # full buckets plus the elapsed part of the current one
+                covered = (count - 1) * width + (now - (now // width) * width)
+                out[name] = to_hashrate(total, covered)
+        return out
+
+    def workers(self, miner_id):
+        with self.lock:
+            return sorted(w for w in self.by_miner.get(str(miner_id), ()) if w)
+
+    def evict_idle(self, now=None):
+        """Free the slots of keys without shares for longer than the longest window."""
+        now = self.clock() if now is None else now
+        cutoff = now - self.max_span
+        evicted = 0
+        with self.lock:
+            for key, slot in list(self.slots.items()):
+                if self.data[slot * self.stride] < cutoff:
+                    del self.slots[key]
+                    self.free.append(slot)
+                    workers = self.by_miner.get(key[0])
+                    if workers is not None:
+                        workers.discard(key[1])
+                        if not workers:
+                            del self.by_miner[key[0]]
+                    evicted += 1
+        return evicted
+
+    def memory_bytes(self):
+        return self.data.buffer_info()[1] * self.data.itemsize
+
+    # --- rollups ---
+
+    def flush(self):
+        """Write pending per-minute / per-hour sums to hashrate_rollups. Returns rows written."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        pool = get_pool(self.db_path)
+        conn = pool.acquire()
+        try:
+            conn.executemany(UPSERT_SQL, [k + (v,) for k, v in pending.items()])
+            now = self.clock()
+            if now - self._last_prune >= self.prune_interval:
+                self._last_prune = now
+                for resolution, retention in self.rollups.items():
+                    conn.execute("DELETE FROM hashrate_rollups WHERE resolution=? AND bucket<?",
+                                 (resolution, int(now - retention)))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            # keep the sums for the next attempt
+            with self.lock:
+                for k, v in pending.items():
+                    self.pending[k] = self.pending.get(k, 0.0) + v
+            raise
+        finally:
+            pool.release(conn)
+        return len(pending)
+
+    def start(self):
+        # idempotent: safe to call from every worker init
+        with self.lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="hashrate-rollups", daemon=True)
+            self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+                now = self.clock()
+                if now - self._last_evict >= 60:
+                    self._last_evict = now
+                    self.evict_idle(now)
+            except Exception as e:
+                logger.error(f"Hashrate rollup flush failed: {e}")
+
+
+def estimate_from_rollups(conn, miner_id="", worker_name="", now=None, windows=WINDOWS, rollups=ROLLUPS):
+    """
+    Same result as HashrateStats.estimate(), from the rollups every process writes to (lags by up to
+    one flush interval). Each window reads the coarsest resolution that divides its bucket width, so
+    the 24h window sums 24 hourly rows, not 1440 minute rows.
+    """
+    now = time.time() if now is None else now
+    plan = []
+    for name, width, count in windows:
+        resolution = max(r for r in rollups if width % r == 0)
+        covered = (count - 1) * width + (now - (now // width) * width)
+        plan.append((name, resolution, covered, int(now - covered)))
+    starts = {}
+    for _, resolution, _, start in plan:
+        starts[resolution] = min(start, starts.get(resolution, start))
+    shares = {resolution: [] for resolution in starts}
+    for resolution, start in starts.items():
+        shares[resolution] = conn.execute(
+            "SELECT bucket, shares FROM hashrate_rollups WHERE miner_id=? AND worker_name=? AND resolution=? "
+            "AND bucket>=?", (str(miner_id), str(worker_name or ""), resolution, start)).fetchall()
+    return {name: to_hashrate(sum(r["shares"] for r in shares[resolution] if r["bucket"] >= start), covered)
+            for name, resolution, covered, start in plan}
+
+
+def history(conn, miner_id="", worker_name="", resolution=60, since=None, until=None, limit=2000):
+    """[[bucket_start, hashrate], ...] oldest first, from the rollups at the given resolution."""
+    now = int(time.time())
+    until = now if until is None else int(until)
+    since = until - resolution * 60 if since is None else int(since)
+    rows = conn.execute(
+        "SELECT bucket, shares FROM hashrate_rollups WHERE miner_id=? AND worker_name=? AND resolution=? "
+        "AND bucket>=? AND bucket<=? ORDER BY bucket LIMIT ?",
+        (str(miner_id), str(worker_name or ""), int(resolution), since // resolution * resolution, until, int(limit)))
+    return [[r["bucket"], to_hashrate(r["shares"], resolution)] for r in rows]
@@ -0,0 +1,239 @@
+"""
+job_queue.py - Durable SQLite job queue and worker pool for wallet payouts.
+
+HTTP handlers only record work (a withdrawal row plus a job row, in the same transaction) and
+return; a pool of worker threads does the slow wallet calls. Because the queue lives in the
+database, jobs survive restarts and several processes can share it.
+ - enqueue(): one job per idempotency key; enqueueing a key again is a no-op while its job is
+   pending, processing or completed, and revives it when it ended in 'error'
+ - claim(): a single UPDATE ... RETURNING moves the oldest due job from pending to processing,
+   so two workers (or processes) never get the same job
+ - failed attempts are retried with exponential backoff (plus jitter) until max_attempts, then the
+   job is left in 'error'
+ - a job still 'processing' after its lease expired (worker died mid-payment) goes to 'error', not
+   back to pending: the payment may already have been sent, so it needs a human look. An expiry
+   hook per kind moves the rows the job works on to 'error' in the same transaction, so they can
+   be reviewed and retried from the admin page
+
+Handlers are called with the job row and return {"ok": True, ...} or
+{"ok": False, "error": ..., "retry": bool}. An exception counts as a non-retryable failure.
+Expiry hooks are called with the queue's connection and the expired job row; they must not commit.
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import deque
+
+from db import get_pool
+
+logger = logging.getLogger('mining_backend')
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+class JobQueue:
+    def __init__(self, db_path, max_attempts=5, backoff_base=2.0, backoff_max=300.0, lease=300.0):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease = lease
+
+    def _conn(self):
+        pool = get_pool(self.db_path)
+        return pool, pool.acquire()
+
+    def enqueue(self, conn, kind, ref_id, key=None, max_attempts=None):
+        """
+        Add a job using the caller's connection; the caller commits, so the job is written
+        atomically with the row it refers to. Returns (job_id, created).
+        """
+        key = key or f"{kind}:{ref_id}"
+        now = time.time()
+        row = conn.execute("SELECT id, status FROM payout_jobs WHERE idempotency_key=?", (key,)).fetchone()
+        if row is not None:
+            if row["status"] != "error":
+                return row["id"], False
+            conn.execute(
+                "UPDATE payout_jobs SET status='pending', attempts=0, run_at=?, last_error=NULL, "
+                "locked_by=NULL, finished_at=NULL WHERE id=?", (now, row["id"]))
+            return row["id"], True
+        job_id = str(uuid.uuid4())
+        conn.execute(
+            "INSERT INTO payout_jobs (id,kind,ref_id,idempotency_key,status,attempts,max_attempts,run_at,created_at) "
+            "VALUES (?,?,?,?,?,?,?,?,?)",
+            (job_id, kind, ref_id, key, "pending", 0, max_attempts or self.max_attempts, now, now))
+        return job_id, True
+
+    def find(self, conn, key):
+        row = conn.execute("SELECT * FROM payout_jobs WHERE idempotency_key=?", (key,)).fetchone()
+        return dict(row) if row else None
+
+    def claim(self, worker_id):
+        pool, conn = self._conn()
+        try:
+            now = time.time()
+            row = conn.execute(
+                "UPDATE payout_jobs SET status='processing', locked_by=?, locked_at=?, attempts=attempts+1, "
+                "started_at=? WHERE id = (SELECT id FROM payout_jobs WHERE status='pending' AND run_at<=? "
+                "ORDER BY run_at LIMIT 1) AND status='pending' RETURNING *",
+                (worker_id, now, now, now)).fetchall()
+            conn.commit()
+            return dict(row[0]) if row else None
+        finally:
+            pool.release(conn)
+
+    def finish(self, job, result):
+        """Record a handler result: complete, reschedule with backoff, or give up."""
+        pool, conn = self._conn()
+        try:
+            now = time.time()
+            if result.get("ok"):
+                conn.execute(
+                    "UPDATE payout_jobs SET status='completed', result=?, finished_at=?, locked_by=NULL WHERE id=?",
+                    (json.dumps(result, default=str), now, job["id"]))
+                status = "completed"
+            elif result.get("retry") and job["attempts"] < job["max_attempts"]:
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (job["attempts"] - 1))
+                delay *= random.uniform(0.8, 1.2)
+                conn.execute(
+                    "UPDATE payout_jobs SET status='pending', run_at=?, last_error=?, locked_by=NULL WHERE id=?",
+                    (now + delay, str(result.get("error")), job["id"]))
+                status = "pending"
+            else:
+                conn.execute(
+                    "UPDATE payout_jobs SET status='error', last_error=?, finished_at=?, locked_by=NULL WHERE id=?",
+                    (str(result.get("error")), now, job["id"]))
+                status = "error"
+            conn.commit()
+            return status
+        finally:
+            pool.release(conn)
+
+    def expire_leases(self, hooks=None):
+        """Move jobs whose lease expired to 'error'; hooks: {kind: callable(conn, job)}, same transaction."""
+        pool, conn = self._conn()
+        try:
+            now = time.time()
+            rows = conn.execute(
+                "UPDATE payout_jobs SET status='error', last_error='lease expired; check the wallet before retrying', "
+                "finished_at=?, locked_by=NULL WHERE status='processing' AND locked_at < ? RETURNING *",
+                (now, now - self.lease)).fetchall()
+            for job in rows:
+                logger.error(f"Job {job['id']} ({job['kind']} {job['ref_id']}): lease expired, needs a manual check")
+                hook = (hooks or {}).get(job["kind"])
+                if hook:
+                    hook(conn, dict(job))
+            conn.commit()
+            return len(rows)
+        finally:
+            pool.release(conn)
+
+    def depth(self):
+        pool, conn = self._conn()
+        try:
+            counts = {r["status"]: r["n"] for r in conn.execute(
+                "SELECT status, COUNT(*) AS n FROM payout_jobs GROUP BY status")}
+            row = conn.execute("SELECT MIN(run_at) AS oldest FROM payout_jobs WHERE status='pending' AND run_at<=?",
+                               (time.time(),)).fetchone()
+            oldest = row["oldest"]
+            return counts, (time.time() - oldest) if oldest else 0.0
+        finally:
+            pool.release(conn)
+
+
+class WorkerPool:
+    def __init__(self, jobs, handlers, size=2, poll_interval=1.0, history=1000, expired=None):
+        """handlers: {kind: callable(job) -> result dict}; expired: {kind: callable(conn, job)}."""
+        self.jobs = jobs
+        self.handlers = handlers
+        self.expired = expired or {}
+        self.size = size
+        self.poll_interval = poll_interval
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.threads = []
+        # recent (queue wait, run time, enqueue-to-done) samples for the latency metrics
+        self.samples = deque(maxlen=history)
+        self.stats = {"completed": 0, "retried": 0, "failed": 0, "expired": 0}
+
+    def start(self):
+        # idempotent: safe to call from every enqueue / worker init
+        with self.lock:
+            self.threads = [t for t in self.threads if t.is_alive()]
+            for i in range(len(self.threads), self.size):
+                t = threading.Thread(target=self._run, args=(f"payout-worker-{i}",), name=f"payout-worker-{i}", daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def notify(self):
+        """Wake idle workers right away (call after enqueueing)."""
+        self.start()
+        self.wakeup.set()
+
+    def _run(self, name):
+        worker_id = f"{name}-{uuid.uuid4().hex[:8]}"
+        last_expire = 0.0
+        while True:
+            try:
+                if time.time() - last_expire >= self.jobs.lease / 10.0:
+                    last_expire = time.time()
+                    self.stats["expired"] += self.jobs.expire_leases(self.expired)
+                job = self.jobs.claim(worker_id)
+            except Exception as e:
+                logger.error(f"Job queue error: {e}")
+                job = None
+            if job is None:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+                continue
+            self.run_job(job)
+
+    def run_job(self, job):
+        handler = self.handlers.get(job["kind"])
+        started = time.time()
+        try:
+            if handler is None:
+                result = {"ok": False, "error": f"no handler for {job['kind']}"}
+            else:
+                result = handler(job) or {"ok": True}
+        except Exception as e:
+            logger.error(f"Job {job['id']} ({job['kind']}) raised: {e}")
+            result = {"ok": False, "error": str(e)}
+        status = self.jobs.finish(job, result)
+        done = time.time()
+        self.stats[{"completed": "completed", "pending": "retried", "error": "failed"}[status]] += 1
+        if status == "completed":
+            self.samples.append((started - job["run_at"], done - started, done - job["created_at"]))
+        return status
+
+    def metrics(self):
+        counts, oldest = self.jobs.depth()
+        samples = list(self.samples)
+        out = {
+            "depth": counts.get("pending", 0),
+            "processing": counts.get("processing", 0),
+            "by_status": counts,
+            "oldest_pending_seconds": round(oldest, 3),
+            "workers": self.size,
+            "stats": dict(self.stats),
+        }
+        for i, name in enumerate(("queue_wait", "run", "total")):
+            values = [s[i] for s in samples]
+            out[name + "_seconds"] = {
+                "p50": round(percentile(values, 50), 4),
+                "p95": round(percentile(values, 95), 4),
+                "p99": round(percentile(values, 99), 4),
+                "max": round(max(values), 4) if values else 0.0,
+            }
+        return out
@@ -0,0 +1,159 @@
+"""
+mining_sim.py - Tick-free mining simulation.
+
+Instead of a background thread adding hashrate * rate to a balance every second, each simulated
+account stores a base balance, the time of its last change (start/stop, hashrate change,
+withdrawal) and its hashrate. The balance is computed in closed form when it is read:
+
+    balance(now) = base_balance + hashrate * rate * (now - since)   while running
+    balance(now) = base_balance                                     while stopped
+
+Every state change first folds the accrued amount into base_balance ("rebase"), so no accrual is
+ever lost to a late tick and there is no thread at all. Accounts are created on first use, so
+thousands of simulated miners cost one small object each.
+
+MiningSimulator keeps the accounts in process memory (one server process only).
+SharedMiningSimulator has the same interface but keeps them in the sim_accounts table, so
+several worker processes (gunicorn -w N) share one state; every change is a single UPDATE that
+folds the accrual in SQL, so concurrent writers never lose or double-count it.
+"""
+
+import threading
+import time
+
+from db import get_pool
+
+
+class MiningAccount:
+    __slots__ = ("base_balance", "since", "hashrate", "running")
+
+    def __init__(self, hashrate, now):
+        self.base_balance = 0.0
+        self.since = now
+        self.hashrate = float(hashrate)
+        self.running = False
+
+    def balance(self, rate, now):
+        if not self.running:
+            return self.base_balance
+        return self.base_balance + self.hashrate * rate * max(0.0, now - self.since)
+
+    def rebase(self, rate, now):
+        self.base_balance = self.balance(rate, now)
+        self.since = now
+
+
+class MiningSimulator:
+    def __init__(self, rate_per_hash, initial_hashrate, clock=time.time):
+        """rate_per_hash: BTC per hashrate unit per second."""
+        self.rate = float(rate_per_hash)
+        self.initial_hashrate = float(initial_hashrate)
+        self.clock = clock
+        self.accounts = {}
+        self.lock = threading.Lock()
+
+    def _account(self, account_id, now):
+        acct = self.accounts.get(account_id)
+        if acct is None:
+            acct = self.accounts[account_id] = MiningAccount(self.initial_hashrate, now)
+        return acct
+
+    def snapshot(self, account_id="default"):
+        now = self.clock()
+        with self.lock:
+            acct = self._account(account_id, now)
+            return {
+                "running": acct.running,
+                "hashrate": acct.hashrate,
+                "balance": round(acct.balance(self.rate, now), 8)
+            }
+
+    def set_running(self, running, account_id="default"):
+        now = self.clock()
+        with self.lock:
+            acct = self._account(account_id, now)
+            acct.rebase(self.rate, now)
+            acct.running = bool(running)
+
+    def set_hashrate(self, hashrate, account_id="default"):
+        now = self.clock()
+        with self.lock:
+            acct = self._account(account_id, now)
+            acct.rebase(self.rate, now)
+            acct.hashrate = float(hashrate)
+
+    def withdraw(self, amount, account_id="default", conn=None):
+        """Deduct amount if the current balance covers it. Returns True on success. conn is unused here."""
+        now = self.clock()
+        with self.lock:
+            acct = self._account(account_id, now)
+            acct.rebase(self.rate, now)
+            if amount > acct.base_balance:
+                return False
+            acct.base_balance -= amount
+            return True
+
+
+# balance(now) in SQL, same formula as MiningAccount.balance()
+BALANCE_SQL = "(base_balance + CASE WHEN running THEN hashrate * :rate * MAX(0.0, :now - since) ELSE 0.0 END)"
+
+
+class SharedMiningSimulator:
+    def __init__(self, db_path, rate_per_hash, initial_hashrate, clock=time.time):
+        """rate_per_hash: BTC per hashrate unit per second."""
+        self.db_path = db_path
+        self.rate = float(rate_per_hash)
+        self.initial_hashrate = float(initial_hashrate)
+        self.clock = clock
+
+    def _update(self, account_id, assignments, extra_where="", conn=None, **params):
+        """
+        Rebase the account and apply `assignments` in one statement. Returns rows changed.
+        With conn the statement joins the caller's transaction (the caller commits).
+        """
+        now = self.clock()
+        params.update({"id": account_id, "rate": self.rate, "now": now})
+        pool = None
+        if conn is None:
+            pool = get_pool(self.db_path)
+            conn = pool.acquire()
+        try:
+            conn.execute(
+                "INSERT OR IGNORE INTO sim_accounts (id, base_balance, since, hashrate, running) VALUES (:id, 0, :now, :hr, 0)",
+                {"id": account_id, "now": now, "hr": self.initial_hashrate})
+            cur = conn.execute(
+                f"UPDATE sim_accounts SET {assignments}, since = :now WHERE id = :id {extra_where}", params)
+            if pool is not None:
+                conn.commit()
+            return cur.rowcount
+        finally:
+            if pool is not None:
+                pool.release(conn)
+
+    def snapshot(self, account_id="default"):
+        now = self.clock()
+        pool = get_pool(self.db_path)
+        conn = pool.acquire()
+        try:
+            row = conn.execute(f"SELECT running, hashrate, {BALANCE_SQL} AS balance FROM sim_accounts WHERE id = :id",
+                               {"id": account_id, "rate": self.rate, "now": now}).fetchone()
+        finally:
+            pool.release(conn)
+        if row is None:
+            return {"running": False, "hashrate": self.initial_hashrate, "balance": 0.0}
+        return {
+            "running": bool(row["running"]),
+            "hashrate": row["hashrate"],
+            "balance": round(row["balance"], 8)
+        }
+
+    def set_running(self, running, account_id="default"):
+        self._update(account_id, f"base_balance = {BALANCE_SQL}, running = :running", running=1 if running else 0)
+
+    def set_hashrate(self, hashrate, account_id="default"):
+        self._update(account_id, f"base_balance = {BALANCE_SQL}, hashrate = :hashrate", hashrate=float(hashrate))
+
+    def withdraw(self, amount, account_id="default", conn=None):
+        """Deduct amount if the current balance covers it. Returns True on success."""
+        return self._update(account_id, f"base_balance = {BALANCE_SQL} - :amount",
+                            f"AND {BALANCE_SQL} >= :amount", conn=conn, amount=float(amount)) == 1
@@ -0,0 +1,111 @@
+"""
+password_hasher.py - bcrypt hashing and verification on a small process pool.
+
+bcrypt costs tens to hundreds of milliseconds of CPU per call; run in a request thread it holds
+the GIL, and every other request of that worker process waits. PasswordHasher sends the work to
+`processes` child processes instead and sheds load: when `max_queue` calls are already running
+or waiting (a call that timed out counts until its child is done with it), new ones fail at once
+with HasherBusy (answer 503 + Retry-After) rather than piling up request threads. verify() also
+reports a replacement hash when the stored one was made with fewer rounds than configured, so
+the cost factor is raised transparently at the next login.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger('mining_backend')
+
+
+class HasherBusy(Exception):
+    """Too many hashing calls queued, or one did not finish in time."""
+
+
+# --- run in the child processes ---
+
+def _hash(password, rounds):
+    from passlib.hash import bcrypt
+    return bcrypt.using(rounds=rounds).hash(password)
+
+
+def _verify(password, password_hash, rounds):
+    from passlib.hash import bcrypt
+    if not password_hash or not bcrypt.verify(password, password_hash):
+        return False, None
+    hasher = bcrypt.using(rounds=rounds)
+    # rehash while the plain password is at hand if the stored cost is below the configured one
+    return True, (hasher.hash(password) if hasher.needs_update(password_hash) else None)
+
+
+class PasswordHasher:
+    def __init__(self, processes=2, max_queue=32, rounds=12, timeout=10.0):
+        self.processes = max(1, processes)
+        self.max_queue = max(1, max_queue)
+        self.rounds = rounds
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.max_queue)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+        self.stats = {"hashed": 0, "verified": 0, "upgraded": 0, "shed": 0, "timeouts": 0, "restarts": 0}
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                # created on first use in each (gunicorn worker) process; spawn, not fork: the
+                # parent is multi-threaded
+                self._pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+                self._pid = os.getpid()
+            return self._pool
+
+    def _reset(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+                self.stats["restarts"] += 1
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _call(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            self.stats["shed"] += 1
+            raise HasherBusy("password hashing queue full")
+        try:
+            pool = self._executor()
+            future = pool.submit(fn, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            logger.warning("password hashing pool broken; restarting")
+            self._reset(pool)
+            raise HasherBusy("password hashing pool restarted")
+        except BaseException:
+            self._slots.release()
+            raise
+        # the slot is held until the child is done, not until the caller gives up: a timed-out
+        # call still occupies a process, and new calls must not queue up behind it unbounded
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            self.stats["timeouts"] += 1
+            raise HasherBusy("password hashing timed out")
+        except BrokenProcessPool:
+            # a child died (OOM killer, ...): start a new pool for the next call
+            logger.warning("password hashing pool broken; restarting")
+            self._reset(pool)
+            raise HasherBusy("password hashing pool restarted")
+
+    def hash(self, password):
+        result = self._call(_hash, password, self.rounds)
+        self.stats["hashed"] += 1
+        return result
+
+    def verify(self, password, password_hash):
+        """(ok, new_hash): new_hash is set when the stored hash should be replaced (cost upgrade)."""
+        ok, new_hash = self._call(_verify, password, password_hash, self.rounds)
+        self.stats["verified"] += 1
+        if new_hash:
+            self.stats["upgraded"] += 1
+        return ok, new_hash
@@ -0,0 +1,310 @@
+"""
+payout_engine.py - Batched on-chain payouts.
+
+Paying every withdrawal with its own sendtoaddress costs one transaction (and one fee) per
+payment plus a blocking RPC inside the HTTP request. The engine pays a whole batch at once, off
+the request path:
+ - create_batch() links withdrawals rows to a new payout_batches row (status 'queued') in the
+   caller's transaction, so the request only does database work; the caller enqueues a
+   "payout_batch" job (job_queue.py) in the same transaction
+ - a payout worker pays the batch with one transaction: sendmany (wallet_backend "bitcoind",
+   payout_mode "sendmany") or one walletcreatefundedpsbt PSBT for offline signing
+   (payout_mode "psbt", stored in the psbts table)
+ - every withdrawal of the batch gets the same txid; the batch row records the fee and RPC time
+   and the estimated savings versus one transaction / one RPC per payment (see savings_report())
+ - a PSBT batch waits in 'psbt_created' (withdrawals 'awaiting_signature') until the signed PSBT
+   is posted to /api/admin/finalize_psbt; finalize_psbt() broadcasts it and completes the batch
+
+Batch status: queued -> sending -> completed | psbt_created (-> completed) | failed | error. A
+failed attempt puts the batch back to 'queued' so the job queue can retry it; after the last
+attempt the batch is 'failed' and its withdrawals go back to 'pending' for manual processing.
+When the wallet call may have paid anyway (timeout / connection lost after sending, see
+wallet_integration.py) nothing is retried: the batch and the withdrawals concerned go to 'error'
+for manual review, so no payment can go out twice.
+PSBT status: unsigned | partially_signed -> finalizing -> broadcast.
+"""
+
+import json
+import logging
+import time
+import uuid
+
+from db import get_pool
+from wallet_integration import (bitcoind_sendmany, bitcoind_create_psbt, bitcoind_finalize_psbt,
+                                bitcoind_psbt_txids, btcpay_payout)
+
+logger = logging.getLogger('mining_backend')
+
+# P2WPKH size estimates (vbytes) used for the fee comparison; one input per transaction
+TX_OVERHEAD_VB = 11
+INPUT_VB = 68
+OUTPUT_VB = 31
+DEFAULT_FEE_RATE = 10.0  # sat/vB, used when the wallet does not report the fee
+
+
+def tx_vsize(outputs, inputs=1):
+    # payment outputs plus one change output
+    return TX_OVERHEAD_VB + inputs * INPUT_VB + (outputs + 1) * OUTPUT_VB
+
+
+def savings_report(payments, outputs, fee, rpc_seconds, rpc_calls, fee_rate=DEFAULT_FEE_RATE):
+    """
+    Compare a batch transaction with paying each of `payments` withdrawals separately.
+    fee: actual batch fee in BTC (None = estimate from fee_rate sat/vB).
+    Individual RPC time is estimated as one call of the batch's average latency per payment.
+    """
+    batch_vb = tx_vsize(outputs)
+    if fee is None:
+        fee = batch_vb * fee_rate * 1e-8
+    rate = fee / batch_vb  # BTC per vbyte actually paid
+    individual_fee = payments * tx_vsize(1) * rate
+    per_call = rpc_seconds / rpc_calls if rpc_calls else 0.0
+    individual_rpc_seconds = payments * per_call
+    return {
+        "payments": payments,
+        "outputs": outputs,
+        "fee": round(fee, 8),
+        "fee_rate_sat_vb": round(rate * 1e8, 3),
+        "estimated_individual_fee": round(individual_fee, 8),
+        "fee_saved": round(individual_fee - fee, 8),
+        "rpc_calls": rpc_calls,
+        "rpc_seconds": round(rpc_seconds, 4),
+        "estimated_individual_rpc_calls": payments,
+        "estimated_individual_rpc_seconds": round(individual_rpc_seconds, 4),
+        "rpc_seconds_saved": round(individual_rpc_seconds - rpc_seconds, 4) + 0.0,
+    }
+
+
+class PayoutEngine:
+    def __init__(self, db_path, settings):
+        """
+        settings: the server config dict (read at payout time): wallet_backend, bitcoind.rpc_url,
+        btcpay.*, payout_mode ("sendmany" | "psbt") and payout_fee_rate (sat/vB, estimate only).
+        """
+        self.db_path = db_path
+        self.settings = settings
+        self.stats = {"batches": 0, "payments": 0, "failed": 0, "fee_saved": 0.0, "rpc_seconds_saved": 0.0}
+
+    def create_batch(self, conn, withdrawal_ids):
+        """
+        Claim pending withdrawals into a new queued batch; the caller commits. Withdrawals that are
+        not pending (or already in a batch) are skipped. Returns (batch_id, claimed) or (None, 0).
+        """
+        if not withdrawal_ids:
+            return None, 0
+        batch_id = str(uuid.uuid4())
+        claimed = 0
+        for i in range(0, len(withdrawal_ids), 500):
+            chunk = withdrawal_ids[i:i + 500]
+            cur = conn.execute(
+                "UPDATE withdrawals SET status='queued', batch_id=? WHERE status='pending' AND batch_id IS NULL "
+                "AND id IN (%s)" % ",".join("?" * len(chunk)), [batch_id] + list(chunk))
+            claimed += cur.rowcount
+        if not claimed:
+            return None, 0
+        row = conn.execute("SELECT COALESCE(SUM(amount), 0) AS total FROM withdrawals WHERE batch_id=?",
+                           (batch_id,)).fetchone()
+        conn.execute(
+            "INSERT INTO payout_batches (id,status,mode,txid,psbt_id,payments,total,created_at) VALUES (?,?,?,?,?,?,?,?)",
+            (batch_id, "queued", self.mode(), "", "", claimed, row["total"], int(time.time())))
+        return batch_id, claimed
+
+    def mode(self):
+        backend = self.settings.get("wallet_backend", "simulated")
+        if backend == "bitcoind":
+            return "psbt" if self.settings.get("payout_mode") == "psbt" else "sendmany"
+        return backend
+
+    def _send(self, mode, outputs, rows):
+        """Returns (result dict, rpc_calls). result: ok, txid, fee, psbt, txids (per withdrawal)."""
+        if mode == "simulated":
+            return {"ok": True, "txid": "sim_tx_" + str(uuid.uuid4()), "fee": None}, 0
+        rpc = self.settings.get("bitcoind", {}).get("rpc_url", "")
+        if mode == "sendmany":
+            if not rpc:
+                return {"ok": False, "error": "bitcoind rpc_url not configured"}, 0
+            return bitcoind_sendmany(rpc, outputs), 2
+        if mode == "psbt":
+            if not rpc:
+                return {"ok": False, "error": "bitcoind rpc_url not configured"}, 0
+            res = bitcoind_create_psbt(rpc, [{addr: amt} for addr, amt in outputs.items()])
+            return res, 1
+        if mode == "btcpay":
+            # no batch payout API here: pay each withdrawal, still off the request path
+            cfg = self.settings.get("btcpay", {})
+            txids = {}
+            for r in rows:
+                res = btcpay_payout(cfg.get("host", ""), cfg.get("api_key", ""), r["to_address"], r["amount"])
+                if not res.get("ok"):
+                    return {"ok": False, "error": res.get("error"), "txids": txids, "failed_id": r["id"],
+                            "uncertain": res.get("uncertain")}, len(txids) + 1
+                txids[r["id"]] = str((res.get("result") or {}).get("id", ""))
+            return {"ok": True, "txid": "", "fee": None, "txids": txids}, len(rows)
+        return {"ok": False, "error": "unknown wallet backend"}, 0
+
+    def expire_batch(self, conn, batch_id):
+        """
+        The worker paying batch_id stopped mid-payment (job lease expired): the transaction may
+        have been sent, so hold the batch and its withdrawals in 'error' for manual review. Runs
+        in the caller's transaction.
+        """
+        conn.execute("UPDATE payout_batches SET status='error', error=?, completed_at=? WHERE id=? AND status='sending'",
+                     ("outcome unknown: payout worker lease expired", int(time.time()), batch_id))
+        conn.execute("UPDATE withdrawals SET status='error' WHERE batch_id=? AND status='queued'", (batch_id,))
+
+    def pay_batch(self, batch_id, final=True):
+        """
+        Pay a queued batch. Returns a job result: {"ok": True, ...} or {"ok": False, "error": ...,
+        "retry": True}. With final=False a failed batch stays queued for another attempt.
+        """
+        pool = get_pool(self.db_path)
+        conn = pool.acquire()
+        try:
+            cur = conn.execute("UPDATE payout_batches SET status='sending' WHERE id=? AND status='queued'", (batch_id,))
+            conn.commit()
+            if cur.rowcount == 0:
+                return {"ok": True, "skipped": True}  # already paid or picked up elsewhere
+            rows = conn.execute("SELECT id, amount, to_address FROM withdrawals WHERE batch_id=? AND status='queued'",
+                                (batch_id,)).fetchall()
+            # sendmany needs unique addresses: merge payments to the same address into one output
+            outputs = {}
+            for r in rows:
+                outputs[r["to_address"]] = round(outputs.get(r["to_address"], 0.0) + r["amount"], 8)
+            mode = self.mode()
+            start = time.perf_counter()
+            try:
+                res, rpc_calls = self._send(mode, outputs, rows) if rows else ({"ok": False, "error": "empty batch"}, 0)
+            except Exception as e:
+                res, rpc_calls = {"ok": False, "error": str(e), "uncertain": mode != "psbt"}, 0
+            rpc_seconds = time.perf_counter() - start
+            now = int(time.time())
+
+            if not res.get("ok"):
+                error = res.get("error")
+                error_text = error if isinstance(error, str) else json.dumps(error)
+                logger.error(f"Payout batch {batch_id} failed: {error}")
+                paid = res.get("txids") or {}
+                for wid, txid in paid.items():
+                    conn.execute("UPDATE withdrawals SET status='completed', txid=? WHERE id=?", (txid, wid))
+                if res.get("uncertain") and mode != "psbt":
+                    # the payment may have been made: hold the withdrawals concerned for manual review
+                    if res.get("failed_id"):
+                        conn.execute("UPDATE withdrawals SET status='error' WHERE id=?", (res["failed_id"],))
+                        conn.execute("UPDATE withdrawals SET status='pending', batch_id=NULL WHERE batch_id=? AND status='queued'",
+                                     (batch_id,))
+                    else:
+                        conn.execute("UPDATE withdrawals SET status='error' WHERE batch_id=? AND status='queued'", (batch_id,))
+                    conn.execute("UPDATE payout_batches SET status='error', error=?, rpc_seconds=?, completed_at=? WHERE id=?",
+                                 ("outcome unknown: " + error_text, rpc_seconds, now, batch_id))
+                    conn.commit()
+                    self.stats["failed"] += 1
+                    logger.error(f"Payout batch {batch_id}: payment outcome unknown, check the wallet before paying again")
+                    return {"ok": False, "error": "outcome unknown: " + error_text, "retry": False}
+                if final or not rows:
+                    conn.execute("UPDATE withdrawals SET status='pending', batch_id=NULL WHERE batch_id=? AND status='queued'",
+                                 (batch_id,))
+                    conn.execute("UPDATE payout_batches SET status='failed', error=?, rpc_seconds=?, completed_at=? WHERE id=?",
+                                 (error_text, rpc_seconds, now, batch_id))
+                    self.stats["failed"] += 1
+                else:
+                    conn.execute("UPDATE payout_batches SET status='queued', error=? WHERE id=?", (error_text, batch_id))
+                conn.commit()
+                return {"ok": False, "error": error_text, "retry": bool(rows)}
+
+            report = savings_report(len(rows), len(outputs), res.get("fee"), rpc_seconds, rpc_calls,
+                                    float(self.settings.get("payout_fee_rate", DEFAULT_FEE_RATE)))
+            txid, psbt_id, status = res.get("txid") or "", "", "completed"
+            if mode == "psbt":
+                psbt_id, status = str(uuid.uuid4()), "psbt_created"
+                conn.execute("INSERT INTO psbts (id,psbt,status,txid,created_at) VALUES (?,?,?,?,?)",
+                             (psbt_id, res.get("psbt"), "unsigned", "", now))
+                conn.execute("UPDATE withdrawals SET status='awaiting_signature' WHERE batch_id=? AND status='queued'",
+                             (batch_id,))
+            elif res.get("txids"):
+                conn.executemany("UPDATE withdrawals SET status='completed', txid=? WHERE id=?",
+                                 [(t, wid) for wid, t in res["txids"].items()])
+            else:
+                conn.execute("UPDATE withdrawals SET status='completed', txid=? WHERE batch_id=? AND status='queued'",
+                             (txid, batch_id))
+            conn.execute(
+                "UPDATE payout_batches SET status=?, mode=?, txid=?, psbt_id=?, fee=?, fee_saved=?, rpc_seconds=?, "
+                "rpc_seconds_saved=?, report=?, completed_at=? WHERE id=?",
+                (status, mode, txid, psbt_id, report["fee"], report["fee_saved"], report["rpc_seconds"],
+                 report["rpc_seconds_saved"], json.dumps(report), now, batch_id))
+            conn.commit()
+            self.stats["batches"] += 1
+            self.stats["payments"] += len(rows)
+            self.stats["fee_saved"] += report["fee_saved"]
+            self.stats["rpc_seconds_saved"] += report["rpc_seconds_saved"]
+            logger.info(f"Payout batch {batch_id}: {len(rows)} payments in one {mode} transaction, "
+                        f"saved ~{report['fee_saved']} BTC in fees and ~{report['rpc_seconds_saved']}s of RPC time")
+            return {"ok": True, "status": status, "txid": txid, "psbt_id": psbt_id}
+        finally:
+            pool.release(conn)
+
+    def finalize_psbt(self, psbt_id, signed_psbt=None):
+        """
+        Finalize and broadcast a batch PSBT (signed_psbt: the signed copy; default the stored one).
+        On broadcast the PSBT is 'broadcast' and its batch and the batch's withdrawals 'completed'
+        with the txid. A PSBT still missing signatures is stored as 'partially_signed'.
+        Returns {"ok": True, "complete": ...} or {"ok": False, "error": ..., "http_status": ...}.
+        """
+        rpc = self.settings.get("bitcoind", {}).get("rpc_url", "")
+        if not rpc:
+            return {"ok": False, "error": "bitcoind rpc_url not configured", "http_status": 400}
+        pool = get_pool(self.db_path)
+        conn = pool.acquire()
+        try:
+            row = conn.execute("SELECT psbt, status, txid FROM psbts WHERE id=?", (psbt_id,)).fetchone()
+            if not row:
+                return {"ok": False, "error": "not found", "http_status": 404}
+            if row["status"] == "broadcast":
+                return {"ok": True, "complete": True, "txid": row["txid"], "already_broadcast": True}
+            signed_psbt = signed_psbt or row["psbt"]
+            if signed_psbt != row["psbt"]:
+                # the signed PSBT must spend and pay exactly what the batch was created with
+                res = bitcoind_psbt_txids(rpc, [row["psbt"], signed_psbt])
+                if not res.get("ok"):
+                    return {"ok": False, "error": res.get("error"), "http_status": 502}
+                if not res["txids"][0] or res["txids"][0] != res["txids"][1]:
+                    return {"ok": False, "error": "psbt does not match the stored transaction", "http_status": 400}
+            # claim it, so two concurrent posts cannot both broadcast and complete the batch
+            cur = conn.execute("UPDATE psbts SET status='finalizing' WHERE id=? AND status IN ('unsigned','partially_signed')",
+                               (psbt_id,))
+            conn.commit()
+            if cur.rowcount == 0:
+                return {"ok": False, "error": "psbt is being finalized", "http_status": 409}
+            try:
+                res = bitcoind_finalize_psbt(rpc, signed_psbt)
+            except Exception as e:
+                res = {"ok": False, "error": str(e)}
+            if not res.get("ok") or not res.get("txid"):
+                # failed or still missing signatures: keep the most complete PSBT for the next attempt.
+                # Re-broadcasting the same transaction cannot pay twice, so a retry is safe.
+                ok = bool(res.get("ok"))
+                status = "partially_signed" if ok or row["status"] == "partially_signed" else "unsigned"
+                conn.execute("UPDATE psbts SET status=?, psbt=? WHERE id=?",
+                             (status, res.get("psbt") or signed_psbt, psbt_id))
+                conn.commit()
+                if not ok:
+                    error = res.get("error")
+                    logger.error(f"Finalizing PSBT {psbt_id} failed: {error}")
+                    return {"ok": False, "error": error if isinstance(error, str) else json.dumps(error),
+                            "http_status": 502}
+                return {"ok": True, "complete": False, "psbt": res.get("psbt") or signed_psbt}
+            txid, now = res["txid"], int(time.time())
+            conn.execute("UPDATE psbts SET status='broadcast', psbt=?, txid=? WHERE id=?", (signed_psbt, txid, psbt_id))
+            batch = conn.execute("SELECT id FROM payout_batches WHERE psbt_id=?", (psbt_id,)).fetchone()
+            completed = 0
+            if batch:
+                conn.execute("UPDATE payout_batches SET status='completed', txid=?, completed_at=? WHERE id=?",
+                             (txid, now, batch["id"]))
+                completed = conn.execute(
+                    "UPDATE withdrawals SET status='completed', txid=? WHERE batch_id=? AND status='awaiting_signature'",
+                    (txid, batch["id"])).rowcount
+            conn.commit()
+            logger.info(f"PSBT {psbt_id} broadcast as {txid}; {completed} withdrawals completed")
+            return {"ok": True, "complete": True, "txid": txid, "batch_id": batch["id"] if batch else None,
+                    "withdrawals": completed}
+        finally:
+            pool.release(conn)
@@ -1,13 +1,16 @@
 import os
-import threading
 import time
-import sqlite3
 import uuid
 import json
-from flask import Flask, jsonify, request, g, send_from_directory, abort, Response
+import base64
+import math
+import threading
+from collections import OrderedDict
+from flask import Flask, jsonify, request, g, abort, Response
 from dotenv import load_dotenv
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from limits import parse as parse_limit
 from functools import wraps
 import os as _os
 import logging
@@ -15,13 +18,23 @@ from ipaddress import ip_network, ip_address
 import hmac
 import hashlib
 import jwt
-from passlib.hash import bcrypt
 from datetime import datetime, timedelta
 
 from flask_cors import CORS
 
+from db import get_pool, migrate
+from sse_hub import BroadcastHub
+from mining_sim import MiningSimulator, SharedMiningSimulator
+from payout_engine import PayoutEngine
+from job_queue import JobQueue, WorkerPool
+from static_assets import StaticAssets
+import hashrate_stats
+from hashrate_stats import HashrateStats
+from stratum_auth import issue_token
+from password_hasher import PasswordHasher, HasherBusy
+
 BASE_DIR = os.path.dirname(__file__)
-DB_PATH = os.path.join(BASE_DIR, "data", "withdrawals.db")
+DB_PATH = os.getenv("MINING_DB_PATH") or os.path.join(BASE_DIR, "data", "withdrawals.db")
 CONFIG_PATH = os.path.join(BASE_DIR, "config.json")
 
 # --- Serve frontend static files from /static/... ---
@@ -43,7 +56,8 @@ if FRONTEND_DIR is None:
     # Fallback to first path and let warning show
     FRONTEND_DIR = os.path.abspath(possible_paths[0])
 
-app = Flask(__name__, static_folder=FRONTEND_DIR, static_url_path='/static')
+# /static is served by STATIC_ASSETS (hashed, precompressed build output when present)
+app = Flask(__name__, static_folder=None)
 
 # Production logging configuration
 if os.getenv('FLASK_ENV') == 'production':
@@ -64,6 +78,12 @@ logger = logging.getLogger('mining_backend')
 if not os.path.exists(FRONTEND_DIR):
     logger.warning(f"Frontend directory not found: {FRONTEND_DIR}")
 
+# Build output of tools/build_static.py; without one the plain frontend folder is served
+STATIC_BUILD_DIR = os.getenv('STATIC_BUILD_DIR') or os.path.join(FRONTEND_DIR, "dist")
+STATIC_ASSETS = StaticAssets(FRONTEND_DIR, STATIC_BUILD_DIR, reload=os.getenv('FLASK_ENV') != 'production')
+if not STATIC_ASSETS.built:
+    logger.info(f"No static build in {STATIC_BUILD_DIR}; run tools/build_static.py for hashed, precompressed assets")
+
 # Production error handlers
 @app.errorhandler(404)
 def not_found(error):
@@ -98,10 +118,13 @@ load_dotenv()
 # rate limiter (configurable via env)
 use_rl = os.getenv('USE_RATE_LIMIT','true').lower() in ('1','true','yes')
 if use_rl:
+    # counters are per process by default; point RATE_LIMIT_STORAGE_URI at e.g. redis:// to share
+    # them between worker processes
     limiter = Limiter(
         app=app,
         key_func=get_remote_address,
-        default_limits=[f"{os.getenv('RATE_LIMIT_PER_MINUTE','60')} per minute"]
+        default_limits=[f"{os.getenv('RATE_LIMIT_PER_MINUTE','60')} per minute"],
+        storage_uri=os.getenv('RATE_LIMIT_STORAGE_URI', 'memory://')
     )
 else:
     limiter = None
@@ -130,67 +153,26 @@ with open(CONFIG_PATH, "r") as f:
     config = json.load(f)
 
 # --- Simple DB setup ---
-os.makedirs(os.path.join(BASE_DIR, "data"), exist_ok=True)
+os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
 def get_db():
     db = getattr(g, "_database", None)
     if db is None:
-        db = g._database = sqlite3.connect(DB_PATH, check_same_thread=False)
-        db.row_factory = sqlite3.Row
+        pool = g._db_pool = get_pool(DB_PATH)
+        db = g._database = pool.acquire()
     return db
 
 def init_db():
-    # Create connection directly (not using get_db() which requires Flask context)
-    db = sqlite3.connect(DB_PATH, check_same_thread=False)
-    db.row_factory = sqlite3.Row
-    cur = db.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS withdrawals (
-        id TEXT PRIMARY KEY,
-        currency TEXT,
-        amount REAL,
-        to_address TEXT,
-        txid TEXT,
-        status TEXT,
-        created_at INTEGER
-    )
-    """)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS miners (
-        id TEXT PRIMARY KEY,
-        owner TEXT,
-        worker_name TEXT,
-        balance REAL DEFAULT 0,
-        shares INTEGER DEFAULT 0,
-        created_at INTEGER
-    )
-    """)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS credits (
-        id TEXT PRIMARY KEY,
-        miner_id TEXT,
-        shares INTEGER,
-        amount REAL,
-        created_at INTEGER
-    )
-    """)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS psbts (
-        id TEXT PRIMARY KEY,
-        psbt TEXT,
-        status TEXT,
-        txid TEXT,
-        created_at INTEGER
-    )
-    """)
-    db.commit()
-    db.close()
+    # Apply schema migrations (tables + indexes) directly, outside of a Flask context
+    version = migrate(DB_PATH)
+    logger.info(f"Database schema at version {version}")
 
 @app.teardown_appcontext
 def close_connection(exception):
+    # return the connection to the pool instead of closing it
     db = getattr(g, "_database", None)
     if db is not None:
-        db.close()
+        g._db_pool.release(db)
 
 # --- Mining simulation ---
 # Allow hashrate to be set via environment variable or config
@@ -203,27 +185,19 @@ if initial_hashrate:
 else:
     initial_hashrate = config.get("initial_hashrate", 800)
 
-mining_state = {
-    "running": False,
-    "hashrate": initial_hashrate,
-    "balance": 0.0,
-    "last_update": time.time()
-}
-
-mining_lock = threading.Lock()
-
-def mining_loop():
-    while True:
-        time.sleep(1)
-        with mining_lock:
-            if mining_state["running"]:
-                # increment balance based on hashrate
-                rate = config.get("mining_rate_per_hash", 1e-8)
-                mining_state["balance"] += mining_state["hashrate"] * rate
-                mining_state["last_update"] = time.time()
+# Balances accrue in closed form (see mining_sim.py); no background tick thread.
+# The state lives in SQLite by default so every worker process sees the same accounts;
+# SIM_STATE_STORE=memory keeps it in-process (single process only).
+if (os.getenv('SIM_STATE_STORE') or 'sqlite') == 'memory':
+    SIMULATOR = MiningSimulator(config.get("mining_rate_per_hash", 1e-8), initial_hashrate)
+else:
+    SIMULATOR = SharedMiningSimulator(DB_PATH, config.get("mining_rate_per_hash", 1e-8), initial_hashrate)
 
-miner_thread = threading.Thread(target=mining_loop, daemon=True)
-miner_thread.start()
+def sim_account(data=None):
+    # optional "account" (body or query) selects a simulated miner; defaults to the single demo account
+    if isinstance(data, dict) and data.get("account"):
+        return str(data["account"])
+    return request.args.get("account") or "default"
 
 # --- Wallet integration skeleton ---
 # --- Wallet integration helper ---
@@ -250,53 +224,117 @@ def send_onchain_payment(currency, amount, address):
     else:
         return {"ok": False, "error": "unknown wallet backend"}
 
+# Batch payouts: one transaction per batch (see payout_engine.py)
+PAYOUTS = PayoutEngine(DB_PATH, config)
+PAYOUT_MAX_PENDING = int(os.getenv('PAYOUT_MAX_PENDING') or 500)
+
+# Payout jobs: handlers record a job and return; payout workers make the wallet calls (see job_queue.py)
+PAYOUT_JOBS = JobQueue(
+    DB_PATH,
+    max_attempts=int(os.getenv('PAYOUT_MAX_ATTEMPTS') or 5),
+    backoff_base=float(os.getenv('PAYOUT_BACKOFF_BASE') or 2.0),
+    backoff_max=float(os.getenv('PAYOUT_BACKOFF_MAX') or 300.0),
+    lease=float(os.getenv('PAYOUT_JOB_LEASE') or 300.0),
+)
+
+def pay_withdrawal_job(job):
+    """
+    Job handler: pay one withdrawal with send_onchain_payment.
+    A failure the wallet reports is retried; when the payment may have gone out anyway (timeout or
+    connection lost after sending, or an unexpected exception) the withdrawal is set to 'error'
+    for manual review instead, so it is never paid twice.
+    """
+    wid = job["ref_id"]
+    pool = get_pool(DB_PATH)
+    conn = pool.acquire()
+    try:
+        # only one worker can move the row out of 'pending'; batches take rows with a batch_id
+        cur = conn.execute("UPDATE withdrawals SET status='processing' WHERE id=? AND status='pending' AND batch_id IS NULL", (wid,))
+        conn.commit()
+        if cur.rowcount == 0:
+            return {"ok": True, "skipped": True}  # completed, rejected or paid by a batch
+        row = conn.execute("SELECT currency, amount, to_address FROM withdrawals WHERE id=?", (wid,)).fetchone()
+        try:
+            result = send_onchain_payment(row["currency"], row["amount"], row["to_address"])
+        except Exception as e:
+            result = {"ok": False, "error": str(e), "uncertain": True}
+        if result.get("ok"):
+            txid = result.get("txid", "")
+            conn.execute("UPDATE withdrawals SET status=?, txid=? WHERE id=?", ("completed", txid, wid))
+            conn.commit()
+            return {"ok": True, "txid": txid}
+        error_msg = result.get("error", "Payment processing failed")
+        if result.get("uncertain"):
+            logger.error(f"Withdrawal {wid}: payment outcome unknown, check the wallet before paying again: {error_msg}")
+            conn.execute("UPDATE withdrawals SET status='error' WHERE id=?", (wid,))
+            conn.commit()
+            return {"ok": False, "error": f"outcome unknown: {error_msg}", "retry": False}
+        final = job["attempts"] >= job["max_attempts"]
+        logger.error(f"Withdrawal {wid} failed (attempt {job['attempts']}/{job['max_attempts']}): {error_msg}")
+        conn.execute("UPDATE withdrawals SET status=? WHERE id=?", ("error" if final else "pending", wid))
+        conn.commit()
+        return {"ok": False, "error": error_msg, "retry": True}
+    finally:
+        pool.release(conn)
+
+def pay_batch_job(job):
+    """Job handler: pay a payout batch with one transaction."""
+    return PAYOUTS.pay_batch(job["ref_id"], final=job["attempts"] >= job["max_attempts"])
+
+def expire_withdrawal_job(conn, job):
+    """Lease expired mid-payment: the payment may have gone out, hold the withdrawal for review."""
+    conn.execute("UPDATE withdrawals SET status='error' WHERE id=? AND status='processing'", (job["ref_id"],))
+
+PAYOUT_WORKERS = WorkerPool(
+    PAYOUT_JOBS,
+    {"withdrawal": pay_withdrawal_job, "payout_batch": pay_batch_job},
+    size=int(os.getenv('PAYOUT_WORKERS') or 2),
+    expired={"withdrawal": expire_withdrawal_job, "payout_batch": lambda conn, job: PAYOUTS.expire_batch(conn, job["ref_id"])},
+)
+
 
 # --- API endpoints ---
+def mining_snapshot():
+    return SIMULATOR.snapshot()
+
 @app.route("/api/status", methods=["GET"])
 def api_status():
-    with mining_lock:
-        return jsonify({
-            "running": mining_state["running"],
-            "hashrate": mining_state["hashrate"],
-            "balance": round(mining_state["balance"], 8)
-        })
+    return jsonify(SIMULATOR.snapshot(sim_account()))
+
+# One publisher serializes state changes once and fans the bytes out to every SSE client
+STATE_HUB = BroadcastHub(
+    mining_snapshot,
+    poll_interval=float(os.getenv('SSE_POLL_INTERVAL') or 1.0),
+    heartbeat_interval=float(os.getenv('SSE_HEARTBEAT_INTERVAL') or 15.0),
+    max_queue=int(os.getenv('SSE_CLIENT_QUEUE') or 16),
+    # streams per process; gunicorn.conf.py sets it below the thread count for threaded workers
+    max_subscribers=int(os.getenv('SSE_MAX_CLIENTS') or 0),
+)
 
 @app.route("/api/stream", methods=["GET"])
 def api_stream():
     # Server-Sent Events (SSE) streaming endpoint for realtime updates
-    def event_stream():
-        while True:
-            try:
-                time.sleep(1)
-                with mining_lock:
-                    data = {
-                        "running": mining_state["running"],
-                        "hashrate": mining_state["hashrate"],
-                        "balance": round(mining_state["balance"], 8),
-                        "ts": int(time.time())
-                    }
-                yield f"data: {json.dumps(data)}\n\n"
-            except GeneratorExit:
-                break
-            except Exception as e:
-                logger.error(f"SSE stream error: {e}")
-                break
-    
-    response = Response(event_stream(), mimetype="text/event-stream")
+    sub = STATE_HUB.subscribe()
+    if sub is None:
+        # every stream holds a worker thread: keep the rest for the API (EventSource retries)
+        response = jsonify({"ok": False, "error": "too many streams, retry later"})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    response = Response(STATE_HUB.stream(sub), mimetype="text/event-stream")
     response.headers['Cache-Control'] = 'no-cache'
     response.headers['X-Accel-Buffering'] = 'no'
     return response
 
 @app.route("/api/start", methods=["POST"])
 def api_start():
-    with mining_lock:
-        mining_state["running"] = True
+    SIMULATOR.set_running(True, sim_account(request.get_json(silent=True)))
+    STATE_HUB.notify()
     return jsonify({"ok": True, "msg": "mining started"})
 
 @app.route("/api/stop", methods=["POST"])
 def api_stop():
-    with mining_lock:
-        mining_state["running"] = False
+    SIMULATOR.set_running(False, sim_account(request.get_json(silent=True)))
+    STATE_HUB.notify()
     return jsonify({"ok": True, "msg": "mining stopped"})
 
 @app.route("/api/set_hashrate", methods=["POST"])
@@ -305,8 +343,8 @@ def api_set_hashrate():
     hr = data.get("hashrate")
     if hr is None:
         return jsonify({"ok": False, "error": "missing hashrate"}), 400
-    with mining_lock:
-        mining_state["hashrate"] = float(hr)
+    SIMULATOR.set_hashrate(float(hr), sim_account(data))
+    STATE_HUB.notify()
     return jsonify({"ok": True})
 
 @app.route("/api/withdraw", methods=["POST"])
@@ -318,32 +356,48 @@ def api_withdraw():
     if amount <= 0 or not to_address:
         return jsonify({"ok": False, "error": "invalid request"}), 400
 
-    with mining_lock:
-        if amount > mining_state["balance"]:
-            return jsonify({"ok": False, "error": "insufficient balance"}), 400
-        mining_state["balance"] -= amount
+    # optional Idempotency-Key header: retries of the same request return the first withdrawal
+    key = request.headers.get("Idempotency-Key") or data.get("idempotency_key")
+    job_key = f"withdraw:{key}" if key else None
 
-    # Create withdrawal record (status 'pending')
     db = get_db()
-    cur = db.cursor()
-    wid = str(uuid.uuid4())
-    cur.execute(
-        "INSERT INTO withdrawals (id,currency,amount,to_address,txid,status,created_at) VALUES (?,?,?,?,?,?,?)",
-        (wid, currency, amount, to_address, "", "pending", int(time.time()))
-    )
-    db.commit()
+    try:
+        # write lock up front so concurrent requests with the same key are serialized
+        db.execute("BEGIN IMMEDIATE")
+        if job_key:
+            job = PAYOUT_JOBS.find(db, job_key)
+            if job:
+                row = db.execute("SELECT status, txid FROM withdrawals WHERE id=?", (job["ref_id"],)).fetchone()
+                db.rollback()
+                return jsonify({"ok": True, "id": job["ref_id"], "status": row["status"] if row else "unknown",
+                                "txid": (row["txid"] if row else "") or None, "duplicate": True})
+        if not SIMULATOR.withdraw(amount, sim_account(data), conn=db):
+            db.rollback()
+            return jsonify({"ok": False, "error": "insufficient balance"}), 400
 
-    # Try to process payout immediately (demo: simulated)
-    result = send_onchain_payment(currency, amount, to_address)
-    cur = db.cursor()
-    if result.get("ok"):
-        txid = result.get("txid", "")
-        cur.execute("UPDATE withdrawals SET status=?, txid=? WHERE id=?", ("completed", txid, wid))
+        # Create withdrawal record (status 'pending') and its payout job in one transaction
+        wid = str(uuid.uuid4())
+        db.execute(
+            "INSERT INTO withdrawals (id,currency,amount,to_address,txid,status,created_at) VALUES (?,?,?,?,?,?,?)",
+            (wid, currency, amount, to_address, "", "pending", int(time.time()))
+        )
+        PAYOUT_JOBS.enqueue(db, "withdrawal", wid, key=job_key)
         db.commit()
-        return jsonify({"ok": True, "id": wid, "txid": txid})
-    else:
-        # leave as pending and return id for admin processing
-        return jsonify({"ok": True, "id": wid, "note": "pending manual processing"})
+    except Exception:
+        db.rollback()
+        raise
+    STATE_HUB.notify()
+    # a payout worker sends the payment; poll /api/withdraw/<id> for the txid
+    PAYOUT_WORKERS.notify()
+    return jsonify({"ok": True, "id": wid, "status": "pending"}), 202
+
+@app.route("/api/withdraw/<wid>", methods=["GET"])
+def api_withdraw_status(wid):
+    row = get_db().execute("SELECT id, currency, amount, to_address, txid, status, created_at FROM withdrawals WHERE id=?",
+                           (wid,)).fetchone()
+    if not row:
+        return jsonify({"ok": False, "error": "not found"}), 404
+    return jsonify({"ok": True, **dict(row)})
 
 # --- Admin endpoints ---
 
@@ -387,18 +441,14 @@ def admin_protected(f):
     return wrapped
 
 
-@app.route("/api/report_share", methods=["POST"])
-def api_report_share():
+def verify_report_signature(req):
     """
-    Endpoint for miners or pool servers to report shares earned by a worker.
-    Body: { "miner_id": "<id>", "worker_name": "<name>", "shares": <int> }
-    This will credit the miner's balance according to MINING_PAYOUT_RATE_PER_SHARE env var or config value.
-    Authentication: Requests must include header 'X-REPORT-SIG' which is HMAC-SHA256 of the raw body using REPORT_SHARED_SECRET.
+    Check the 'X-REPORT-SIG' header (HMAC-SHA256 of the raw body using REPORT_SHARED_SECRET).
+    Returns None when the signature is valid, otherwise a (response, status) tuple to return.
     """
-    # Verify HMAC signature to ensure reports are authentic
     shared_secret = os.getenv('REPORT_SHARED_SECRET') or config.get('report_shared_secret') or config.get('stratum_async', {}).get('report_secret') or ''
-    sig_header = request.headers.get('X-REPORT-SIG') or request.headers.get('X-SIGNATURE') or ''
-    raw = request.get_data() or b''
+    sig_header = req.headers.get('X-REPORT-SIG') or req.headers.get('X-SIGNATURE') or ''
+    raw = req.get_data() or b''
     if not shared_secret:
         # If no shared secret configured, reject to avoid unauthenticated reports in production by mistake
         return jsonify({"ok": False, "error": "reporting disabled (no secret configured)"}), 403
@@ -412,19 +462,43 @@ def api_report_share():
     # constant-time compare
     if not sig_header or not hmac.compare_digest(sig_header, expected):
         return jsonify({"ok": False, "error": "invalid signature"}), 401
+    return None
+
+def get_payout_per_share():
+    return float(os.getenv('MINING_PAYOUT_RATE_PER_SHARE') or config.get('payout_per_share') or 0.0)
+
+# Per-worker effective hashrate from the credited shares (ring buffers + hashrate_rollups table).
+# HASHRATE_SOURCE=memory answers estimates from this process's rings (single process only);
+# the default, rollups, reads the per-minute rollups every worker process writes to.
+HASHRATE = HashrateStats(DB_PATH, flush_interval=float(os.getenv('HASHRATE_FLUSH_INTERVAL') or 10.0))
+HASHRATE_SOURCE = (os.getenv('HASHRATE_SOURCE') or 'rollups').lower()
+
+@app.route("/api/report_share", methods=["POST"])
+def api_report_share():
+    """
+    Endpoint for miners or pool servers to report shares earned by a worker.
+    Body: { "miner_id": "<id>", "worker_name": "<name>", "shares": <number> }
+    shares may be fractional: Stratum servers report difficulty-weighted shares.
+    This will credit the miner's balance according to MINING_PAYOUT_RATE_PER_SHARE env var or config value.
+    Authentication: Requests must include header 'X-REPORT-SIG' which is HMAC-SHA256 of the raw body using REPORT_SHARED_SECRET.
+    """
+    # Verify HMAC signature to ensure reports are authentic
+    err = verify_report_signature(request)
+    if err:
+        return err
 
     # parse JSON body after verifying
     data = request.get_json() or {}
     miner_id = data.get("miner_id")
     worker_name = data.get("worker_name", "")
     try:
-        shares = int(data.get("shares", 0) or 0)
+        shares = float(data.get("shares", 0) or 0)
     except:
         shares = 0
-    if not miner_id or shares <= 0:
+    if not miner_id or not math.isfinite(shares) or shares <= 0:
         return jsonify({"ok": False, "error": "invalid"}), 400
 
-    payout_per_share = float(os.getenv('MINING_PAYOUT_RATE_PER_SHARE') or config.get('payout_per_share') or 0.0)
+    payout_per_share = get_payout_per_share()
     amount = shares * payout_per_share
 
     db = get_db()
@@ -443,15 +517,201 @@ def api_report_share():
     cred_id = str(uuid.uuid4())
     cur.execute("INSERT INTO credits (id, miner_id, shares, amount, created_at) VALUES (?,?,?,?,?)", (cred_id, miner_id, shares, amount, ts))
     db.commit()
+    HASHRATE.add(miner_id, worker_name, shares)
     return jsonify({"ok": True, "miner_id": miner_id, "credited": amount, "shares": shares})
+
+MAX_REPORT_BATCH = int(os.getenv('MAX_REPORT_BATCH') or 5000)
+# how long a batch_id is remembered; covers aggregator retries and spill-file replays
+REPORT_BATCH_ID_TTL = int(os.getenv('REPORT_BATCH_ID_TTL') or 7 * 86400)
+
+@app.route("/api/report_shares", methods=["POST"])
+def api_report_shares():
+    """
+    Batch variant of /api/report_share used by the stratum share aggregator.
+    Body: { "batch_id": "<id>", "reports": [ { "miner_id": "<id>", "worker_name": "<name>", "shares": <number> }, ... ] }
+    (a bare JSON array is accepted too). Signed the same way as /api/report_share.
+    All miners are upserted and all credits inserted in a single transaction, together with the
+    optional batch_id: a batch sent again (retry after a lost answer) is not credited twice, the
+    stored answer is returned instead. Returns one result per entry, in request order.
+    """
+    err = verify_report_signature(request)
+    if err:
+        return err
+
+    data = request.get_json(silent=True)
+    reports = data.get("reports") if isinstance(data, dict) else data
+    batch_id = data.get("batch_id") if isinstance(data, dict) else None
+    if not isinstance(reports, list) or not reports:
+        return jsonify({"ok": False, "error": "invalid request"}), 400
+    if batch_id is not None and (not isinstance(batch_id, str) or not 0 < len(batch_id) <= 128):
+        return jsonify({"ok": False, "error": "invalid batch_id"}), 400
+    if len(reports) > MAX_REPORT_BATCH:
+        return jsonify({"ok": False, "error": f"too many entries (max {MAX_REPORT_BATCH})"}), 413
+    if batch_id:
+        row = get_db().execute("SELECT result FROM report_batches WHERE id=?", (batch_id,)).fetchone()
+        if row:
+            return Response(row["result"], mimetype="application/json")
+
+    payout_per_share = get_payout_per_share()
+    ts = int(time.time())
+    results = []
+    # per-miner totals so a miner appearing several times is upserted once
+    totals = {}
+    credit_rows = []
+    worker_shares = []
+    for entry in reports:
+        if not isinstance(entry, dict):
+            results.append({"ok": False, "error": "invalid"})
+            continue
+        miner_id = entry.get("miner_id")
+        worker_name = entry.get("worker_name", "") or ""
+        try:
+            shares = float(entry.get("shares", 0) or 0)
+        except:
+            shares = 0
+        if not miner_id or not math.isfinite(shares) or shares <= 0:
+            results.append({"ok": False, "miner_id": miner_id, "error": "invalid"})
+            continue
+        amount = shares * payout_per_share
+        t = totals.setdefault(miner_id, [worker_name, 0.0, 0])
+        t[1] += amount
+        t[2] += shares
+        credit_rows.append((str(uuid.uuid4()), miner_id, shares, amount, ts))
+        worker_shares.append((miner_id, worker_name, shares))
+        results.append({"ok": True, "miner_id": miner_id, "credited": amount, "shares": shares})
+
+    body = {"ok": True, "accepted": len(credit_rows), "results": results}
+    if credit_rows:
+        db = get_db()
+        cur = db.cursor()
+        try:
+            if batch_id:
+                cur.execute("DELETE FROM report_batches WHERE created_at < ?", (ts - REPORT_BATCH_ID_TTL,))
+                # a concurrent copy of this batch that committed first makes this INSERT fail
+                cur.execute("INSERT INTO report_batches (id, result, created_at) VALUES (?,?,?)",
+                            (batch_id, json.dumps(body), ts))
+            cur.executemany(
+                "INSERT INTO miners (id,owner,worker_name,balance,shares,created_at) VALUES (?,?,?,?,?,?) "
+                "ON CONFLICT(id) DO UPDATE SET balance = balance + excluded.balance, shares = shares + excluded.shares",
+                [(mid, "", t[0], t[1], t[2], ts) for mid, t in totals.items()]
+            )
+            cur.executemany("INSERT INTO credits (id, miner_id, shares, amount, created_at) VALUES (?,?,?,?,?)", credit_rows)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            row = db.execute("SELECT result FROM report_batches WHERE id=?", (batch_id,)).fetchone() if batch_id else None
+            if row:
+                return Response(row["result"], mimetype="application/json")
+            logger.error(f"Batch share report failed: {e}")
+            return jsonify({"ok": False, "error": "database error"}), 500
+        for miner_id, worker_name, shares in worker_shares:
+            HASHRATE.add(miner_id, worker_name, shares)
+    return jsonify(body)
+# --- Admin listing helpers (keyset pagination on (created_at, id)) ---
+ADMIN_PAGE_DEFAULT = int(os.getenv('ADMIN_PAGE_DEFAULT') or 100)
+ADMIN_PAGE_MAX = int(os.getenv('ADMIN_PAGE_MAX') or 1000)
+NDJSON_FETCH_SIZE = 500
+
+def encode_cursor(created_at, row_id):
+    raw = f"{int(created_at or 0)}:{row_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+    created_at, row_id = raw.split(':', 1)
+    return int(created_at), row_id
+
+def query_int(name, default=None):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    return int(value)
+
+def query_float(name, default=None):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    return float(value)
+
+def admin_listing(table, key, where=None, params=None):
+    """
+    Return one page of `table`, newest first, as JSON ({key: [...], "next_cursor": ...}).
+    Query args: limit (default ADMIN_PAGE_DEFAULT, max ADMIN_PAGE_MAX), cursor (next_cursor of
+    the previous page) and format=ndjson. In NDJSON mode rows are streamed one per line with
+    bounded memory, limit=0 streams every matching row, and the last line is {"next_cursor": ...}.
+    """
+    where = list(where or [])
+    params = list(params or [])
+    ndjson = request.args.get('format') == 'ndjson' or 'application/x-ndjson' in (request.headers.get('Accept') or '')
+    try:
+        limit = query_int('limit', ADMIN_PAGE_DEFAULT)
+        cursor = request.args.get('cursor')
+        if cursor:
+            where.append("(created_at, id) < (?, ?)")
+            params.extend(decode_cursor(cursor))
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid limit or cursor"}), 400
+    if limit < 0 or (not ndjson and limit == 0):
+        return jsonify({"ok": False, "error": "invalid limit"}), 400
+    if not ndjson:
+        limit = min(limit, ADMIN_PAGE_MAX)
+
+    sql = f"SELECT * FROM {table}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY created_at DESC, id DESC"
+    if limit:
+        # fetch one extra row to know whether there is a next page
+        sql += " LIMIT ?"
+        params.append(limit + 1)
+
+    if ndjson:
+        pool = get_pool(DB_PATH)
+
+        def generate():
+            conn = pool.acquire()
+            try:
+                cur = conn.execute(sql, params)
+                sent = 0
+                last = None
+                while True:
+                    batch = cur.fetchmany(NDJSON_FETCH_SIZE)
+                    if not batch:
+                        break
+                    for r in batch:
+                        if limit and sent == limit:
+                            yield json.dumps({"next_cursor": encode_cursor(last["created_at"], last["id"])}) + "\n"
+                            return
+                        yield json.dumps(dict(r)) + "\n"
+                        last = r
+                        sent += 1
+                yield json.dumps({"next_cursor": None}) + "\n"
+            finally:
+                pool.release(conn)
+
+        return Response(generate(), mimetype="application/x-ndjson")
+
+    cur = get_db().execute(sql, params)
+    rows = [dict(r) for r in cur.fetchall()]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+    return jsonify({"ok": True, key: rows, "next_cursor": next_cursor})
+
 @app.route("/api/admin/withdrawals", methods=["GET"])
 def api_admin_withdrawals():
+    """
+    List withdrawals, newest first. Filters: status (comma separated, e.g. ?status=pending,error).
+    Paginated with limit/cursor; see admin_listing().
+    """
     require_api_key(request)
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("SELECT * FROM withdrawals ORDER BY created_at DESC")
-    rows = [dict(r) for r in cur.fetchall()]
-    return jsonify({"ok": True, "withdrawals": rows})
+    where, params = [], []
+    statuses = [st for st in (request.args.get('status') or '').split(',') if st]
+    if statuses:
+        where.append("status IN (%s)" % ",".join("?" * len(statuses)))
+        params.extend(statuses)
+    return admin_listing("withdrawals", "withdrawals", where, params)
 
 @app.route("/api/admin/process", methods=["POST"])
 def api_admin_process():
@@ -464,23 +724,20 @@ def api_admin_process():
     db = get_db()
     cur = db.cursor()
     if action == "approve" or action == "retry":
-        # attempt payment when admin approves or retries
-        cur.execute("SELECT currency, amount, to_address FROM withdrawals WHERE id=?", (wid,))
+        # queue the payment when admin approves or retries; a payout worker sends it
+        cur.execute("SELECT status FROM withdrawals WHERE id=?", (wid,))
         row = cur.fetchone()
         if not row:
             return jsonify({"ok": False, "error": "not found"}), 404
-        currency, amount, to_address = row["currency"], row["amount"], row["to_address"]
-        result = send_onchain_payment(currency, amount, to_address)
-        if result.get("ok"):
-            txid = result.get("txid", "")
-            cur.execute("UPDATE withdrawals SET status=?, txid=? WHERE id=?", ("completed", txid, wid))
-        else:
-            # Store error message for debugging
-            error_msg = result.get("error", "Payment processing failed")
-            logger.error(f"Withdrawal {wid} failed: {error_msg}")
-            cur.execute("UPDATE withdrawals SET status=? WHERE id=?", ("error", wid))
-    else:
-        cur.execute("UPDATE withdrawals SET status=? WHERE id=?", ("rejected", wid))
+        if row["status"] not in ("pending", "error", "rejected"):
+            return jsonify({"ok": False, "error": f"withdrawal is {row['status']}"}), 409
+        # a withdrawal held from a failed batch is retried on its own
+        cur.execute("UPDATE withdrawals SET status=?, batch_id=NULL WHERE id=?", ("pending", wid))
+        job_id, _ = PAYOUT_JOBS.enqueue(db, "withdrawal", wid)
+        db.commit()
+        PAYOUT_WORKERS.notify()
+        return jsonify({"ok": True, "job_id": job_id, "status": "pending"}), 202
+    cur.execute("UPDATE withdrawals SET status=? WHERE id=?", ("rejected", wid))
     db.commit()
     return jsonify({"ok": True})
 
@@ -513,64 +770,119 @@ def api_admin_token():
 @app.route("/api/admin/miners", methods=["GET"])
 @admin_protected
 def api_admin_miners():
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("SELECT * FROM miners ORDER BY created_at DESC")
-    rows = [dict(r) for r in cur.fetchall()]
-    return jsonify({"ok": True, "miners": rows})
+    """
+    List miners, newest first. Filters: min_balance.
+    Paginated with limit/cursor; see admin_listing().
+    """
+    try:
+        min_balance = query_float('min_balance')
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid min_balance"}), 400
+    where, params = [], []
+    if min_balance is not None:
+        where.append("balance >= ?")
+        params.append(min_balance)
+    return admin_listing("miners", "miners", where, params)
 
 @app.route("/api/admin/batch_payout", methods=["POST"])
 @admin_protected
 def api_admin_batch_payout():
     """
     Admin-triggered batch payout.
-    Expected body: { "payments": [ { "miner_id": "...", "to_address": "...", "amount": 0.001 }, ... ] }
-    For each payment, a withdrawal record is created and send_onchain_payment is attempted immediately.
-    Returns list of results per payment.
+    Expected body: { "payments": [ { "miner_id": "...", "to_address": "...", "amount": 0.001 }, ... ],
+                     "include_pending": false }
+    For each payment the miner balance is deducted and a withdrawal record is created; with
+    include_pending, up to PAYOUT_MAX_PENDING pending withdrawals are added as well. All of them are
+    queued as one payout batch and paid with a single transaction by a payout worker.
+    Returns 202 with the batch id and per-payment results; poll /api/admin/payout_batches/<id>.
     """
     data = request.get_json() or {}
     payments = data.get("payments", [])
-    if not payments or not isinstance(payments, list):
+    include_pending = bool(data.get("include_pending"))
+    if not isinstance(payments, list) or (not payments and not include_pending):
         return jsonify({"ok": False, "error": "invalid request"}), 400
 
     results = []
+    wids = []
     db = get_db()
     cur = db.cursor()
-    for p in payments:
-        miner_id = p.get("miner_id")
-        to_address = p.get("to_address")
-        amount = float(p.get("amount", 0) or 0)
-        if not miner_id or not to_address or amount <= 0:
-            results.append({"ok": False, "miner_id": miner_id, "error": "invalid payment entry"})
-            continue
+    ts = int(time.time())
+    try:
+        for p in payments:
+            miner_id = p.get("miner_id")
+            to_address = p.get("to_address")
+            amount = float(p.get("amount", 0) or 0)
+            if not miner_id or not to_address or amount <= 0:
+                results.append({"ok": False, "miner_id": miner_id, "error": "invalid payment entry"})
+                continue
+
+            # Deduct from miner balance if it covers the amount
+            cur.execute("UPDATE miners SET balance = balance - ? WHERE id=? AND balance >= ?", (amount, miner_id, amount))
+            if cur.rowcount == 0:
+                results.append({"ok": False, "miner_id": miner_id, "error": "insufficient balance or miner not found"})
+                continue
+
+            # create withdrawal record; create_batch() moves it to the batch
+            wid = str(uuid.uuid4())
+            cur.execute("INSERT INTO withdrawals (id,currency,amount,to_address,txid,status,created_at) VALUES (?,?,?,?,?,?,?)",
+                        (wid, "BTC", amount, to_address, "", "pending", ts))
+            wids.append(wid)
+            results.append({"ok": True, "miner_id": miner_id, "wid": wid})
+
+        if include_pending:
+            cur.execute("SELECT id FROM withdrawals WHERE status='pending' AND batch_id IS NULL AND currency='BTC' "
+                        "ORDER BY created_at LIMIT ?", (PAYOUT_MAX_PENDING,))
+            new = set(wids)
+            wids.extend(r["id"] for r in cur.fetchall() if r["id"] not in new)
+
+        # one commit for balances, withdrawals, the batch and its payout job
+        batch_id, claimed = PAYOUTS.create_batch(db, wids)
+        if batch_id:
+            PAYOUT_JOBS.enqueue(db, "payout_batch", batch_id)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Batch payout failed: {e}")
+        return jsonify({"ok": False, "error": "database error"}), 500
 
-        # Deduct from miner balance if exist
-        cur.execute("SELECT balance FROM miners WHERE id=?", (miner_id,))
-        row = cur.fetchone()
-        if not row or row["balance"] < amount:
-            results.append({"ok": False, "miner_id": miner_id, "error": "insufficient balance or miner not found"})
-            continue
+    if batch_id:
+        PAYOUT_WORKERS.notify()
+    return jsonify({"ok": True, "batch_id": batch_id, "status": "queued" if batch_id else "empty",
+                    "withdrawals": claimed, "results": results}), 202
 
-        # deduct balance
-        cur.execute("UPDATE miners SET balance = balance - ? WHERE id=?", (amount, miner_id))
-        # create withdrawal record
-        wid = str(uuid.uuid4())
-        ts = int(time.time())
-        cur.execute("INSERT INTO withdrawals (id,currency,amount,to_address,txid,status,created_at) VALUES (?,?,?,?,?,?,?)",
-                    (wid, "BTC", amount, to_address, "", "pending", ts))
-        db.commit()
+@app.route("/api/admin/payout_batches", methods=["GET"])
+@admin_protected
+def api_admin_payout_batches():
+    """
+    List payout batches (with fee / RPC-time savings), newest first. Filters: status.
+    Paginated with limit/cursor; see admin_listing().
+    """
+    where, params = [], []
+    statuses = [st for st in (request.args.get('status') or '').split(',') if st]
+    if statuses:
+        where.append("status IN (%s)" % ",".join("?" * len(statuses)))
+        params.extend(statuses)
+    return admin_listing("payout_batches", "batches", where, params)
+
+@app.route("/api/admin/payout_batches/<batch_id>", methods=["GET"])
+@admin_protected
+def api_admin_payout_batch(batch_id):
+    db = get_db()
+    row = db.execute("SELECT * FROM payout_batches WHERE id=?", (batch_id,)).fetchone()
+    if not row:
+        return jsonify({"ok": False, "error": "not found"}), 404
+    batch = dict(row)
+    batch["report"] = json.loads(batch["report"]) if batch.get("report") else None
+    withdrawals = [dict(r) for r in db.execute(
+        "SELECT id, amount, to_address, txid, status FROM withdrawals WHERE batch_id=?", (batch_id,))]
+    return jsonify({"ok": True, "batch": batch, "withdrawals": withdrawals})
 
-        # attempt payment
-        res = send_onchain_payment("BTC", amount, to_address)
-        if res.get("ok"):
-            txid = res.get("txid","")
-            cur.execute("UPDATE withdrawals SET status=?, txid=? WHERE id=?", ("completed", txid, wid))
-            db.commit()
-            results.append({"ok": True, "miner_id": miner_id, "wid": wid, "txid": txid})
-        else:
-            results.append({"ok": False, "miner_id": miner_id, "wid": wid, "error": res.get("error")})
-    return jsonify({"ok": True, "results": results})
 
+@app.route("/api/admin/queue", methods=["GET"])
+@admin_protected
+def api_admin_queue():
+    """Payout job queue: depth by status, oldest pending job and queue-wait / run latency percentiles."""
+    return jsonify({"ok": True, "queue": PAYOUT_WORKERS.metrics(), "payouts": PAYOUTS.stats})
 
 @app.route("/api/admin/psbts", methods=["GET"])
 @admin_protected
@@ -581,6 +893,24 @@ def api_admin_psbts():
     rows = [dict(r) for r in cur.fetchall()]
     return jsonify({"ok": True, "psbts": rows})
 
+@app.route("/api/admin/finalize_psbt", methods=["POST"])
+@admin_protected
+def api_admin_finalize_psbt():
+    """
+    Finalize and broadcast a signed payout PSBT (see tools/OFFLINE_SIGNING.md).
+    Body: { "psbt_id": "<id>", "psbt": "<signed_psbt_base64>" } ("psbt" may be omitted when the
+    wallet can sign the stored one). On broadcast the payout batch and its withdrawals are marked
+    completed with the txid; a PSBT still missing signatures is stored and returned with complete=false.
+    """
+    data = request.get_json(silent=True) or {}
+    psbt_id = data.get("psbt_id")
+    signed = data.get("psbt")
+    if not isinstance(psbt_id, str) or not psbt_id or (signed is not None and not isinstance(signed, str)):
+        return jsonify({"ok": False, "error": "invalid request"}), 400
+    res = PAYOUTS.finalize_psbt(psbt_id, signed)
+    status = res.pop("http_status", 200)
+    return jsonify(res), status
+
 @app.route("/api/admin/get_psbt/<psbt_id>", methods=["GET"])
 @admin_protected
 def api_admin_get_psbt(psbt_id):
@@ -595,44 +925,106 @@ def api_admin_get_psbt(psbt_id):
 @app.route("/api/admin/credits", methods=["GET"])
 @admin_protected
 def api_admin_credits():
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("SELECT * FROM credits ORDER BY created_at DESC")
-    rows = [dict(r) for r in cur.fetchall()]
-    return jsonify({"ok": True, "credits": rows})
+    """
+    List credits, newest first. Filters: miner_id, since and until (unix timestamps, inclusive).
+    Paginated with limit/cursor; see admin_listing().
+    Only raw credits are listed: tools/compact_credits.py rolls older ones into credit_rollups.
+    """
+    try:
+        since = query_int('since')
+        until = query_int('until')
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid since/until"}), 400
+    where, params = [], []
+    miner_id = request.args.get('miner_id')
+    if miner_id:
+        where.append("miner_id = ?")
+        params.append(miner_id)
+    if since is not None:
+        where.append("created_at >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("created_at <= ?")
+        params.append(until)
+    return admin_listing("credits", "credits", where, params)
+
+# --- Hashrate statistics (served from hashrate_stats, never from a credits scan) ---
+def hashrate_estimate(miner_id, worker_name=""):
+    if HASHRATE_SOURCE == 'memory':
+        return HASHRATE.estimate(miner_id, worker_name)
+    return hashrate_stats.estimate_from_rollups(get_db(), miner_id, worker_name)
+
+@app.route("/api/stats/hashrate", methods=["GET"])
+def api_pool_hashrate():
+    """Effective hashrate of the whole pool over 5m / 1h / 24h, in hashes per second."""
+    return jsonify({"ok": True, "source": HASHRATE_SOURCE, "hashrate": hashrate_estimate("")})
+
+@app.route("/api/stats/hashrate/<miner_id>", methods=["GET"])
+def api_miner_hashrate(miner_id):
+    """
+    Effective hashrate of a miner and of each of its workers over 5m / 1h / 24h (hashes per second).
+    Workers without shares in the last 24h are not listed.
+    """
+    if HASHRATE_SOURCE == 'memory':
+        workers = HASHRATE.workers(miner_id)
+    else:
+        cur = get_db().execute(
+            "SELECT DISTINCT worker_name FROM hashrate_rollups WHERE miner_id=? AND resolution=3600 "
+            "AND bucket>=? AND worker_name<>'' ORDER BY worker_name", (miner_id, int(time.time()) - 86400))
+        workers = [r["worker_name"] for r in cur]
+    return jsonify({
+        "ok": True,
+        "miner_id": miner_id,
+        "source": HASHRATE_SOURCE,
+        "hashrate": hashrate_estimate(miner_id),
+        "workers": {w: hashrate_estimate(miner_id, w) for w in workers},
+    })
+
+@app.route("/api/stats/hashrate/<miner_id>/history", methods=["GET"])
+def api_miner_hashrate_history(miner_id):
+    """
+    Hashrate time series from the rollups: points = [[bucket_start, hashes_per_second], ...], oldest first.
+    Query: worker (default: whole miner; miner "_pool" = whole pool), resolution (60 or 3600),
+    since/until (unix timestamps; default the last 60 buckets).
+    """
+    try:
+        resolution = query_int('resolution', 60)
+        since = query_int('since')
+        until = query_int('until')
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid resolution/since/until"}), 400
+    if resolution not in hashrate_stats.ROLLUPS:
+        return jsonify({"ok": False, "error": f"resolution must be one of {sorted(hashrate_stats.ROLLUPS)}"}), 400
+    if miner_id == "_pool":
+        miner_id = ""
+    worker_name = request.args.get('worker', '')
+    points = hashrate_stats.history(get_db(), miner_id, worker_name, resolution, since, until)
+    return jsonify({"ok": True, "miner_id": miner_id, "worker": worker_name, "resolution": resolution, "points": points})
 
 @app.route("/")
 def index():
     # Serve index.html by default
-    return send_from_directory(FRONTEND_DIR, "index.html")
+    return STATIC_ASSETS.html("index.html")
 
 @app.route("/index.html")
 def frontend_index():
-    return send_from_directory(FRONTEND_DIR, "index.html")
+    return STATIC_ASSETS.html("index.html")
 
 @app.route("/admin.html")
 def frontend_admin():
-    return send_from_directory(FRONTEND_DIR, "admin.html")
+    return STATIC_ASSETS.html("admin.html")
 
 @app.route("/psbt.html")
 def frontend_psbt():
-    return send_from_directory(FRONTEND_DIR, "psbt.html")
+    return STATIC_ASSETS.html("psbt.html")
 
+@app.route("/static/<path:filename>")
+def frontend_static(filename):
+    return STATIC_ASSETS.static(filename)
 
-if __name__ == "__main__":
-    # initialize DB
-    init_db()
-    # optionally allow overriding API key by env var
-    env_key = os.environ.get("MINING_SERVER_API_KEY")
-    if env_key:
-        config["server_api_key"] = env_key
-        with open(CONFIG_PATH, "w") as f:
-            json.dump(config, f, indent=2)
-    # Use PORT environment variable (Railway, Heroku, etc.) or default to 5000
-    port = int(os.getenv('PORT', 5000))
-    debug = os.getenv('FLASK_ENV') != 'production'
-    print(f"Starting Flask mining backend on http://0.0.0.0:{port}")
-    app.run(debug=debug, host="0.0.0.0", port=port)
+if limiter:
+    # one page load fetches several assets; they are cheap and mostly cached
+    limiter.exempt(frontend_static)
 
 
 # --- User auth (JWT) helper functions ---
@@ -640,6 +1032,23 @@ JWT_SECRET = os.getenv('JWT_SECRET') or config.get('jwt_secret') or 'change_this
 JWT_ALGO = 'HS256'
 JWT_EXP_MINUTES = int(os.getenv('JWT_EXP_MINUTES') or 60*24*7)  # default 1 week
 
+# verified tokens -> (user id, exp); a token is only decoded and its signature checked once
+JWT_CACHE_SIZE = int(os.getenv('JWT_CACHE_SIZE') or 10000)
+_jwt_cache = OrderedDict()
+_jwt_cache_lock = threading.Lock()
+
+# bcrypt runs on a process pool (password_hasher.py); BCRYPT_ROUNDS above a stored hash's cost
+# upgrades that hash at its next login
+PASSWORDS = PasswordHasher(
+    processes=int(os.getenv('PASSWORD_HASH_PROCESSES') or 2),
+    max_queue=int(os.getenv('PASSWORD_HASH_MAX_QUEUE') or 32),
+    rounds=int(os.getenv('BCRYPT_ROUNDS') or 12),
+    timeout=float(os.getenv('PASSWORD_HASH_TIMEOUT') or 10),
+)
+# failed logins per username (only 401 answers count), on top of the per-IP default limit; counted
+# in SQLite so that every worker process sees the same number
+LOGIN_ATTEMPT_LIMIT = parse_limit(os.getenv('LOGIN_ATTEMPT_LIMIT') or '5 per 15 minutes')
+
 def create_token(user_id):
     exp = datetime.utcnow() + timedelta(minutes=JWT_EXP_MINUTES)
     payload = {"sub": user_id, "exp": exp.timestamp()}
@@ -650,11 +1059,59 @@ def verify_token_from_header(req):
     if not auth.startswith('Bearer '):
         return None
     token = auth.split(' ',1)[1]
+    now = time.time()
+    with _jwt_cache_lock:
+        hit = _jwt_cache.get(token)
+        if hit is not None:
+            if hit[1] > now:
+                _jwt_cache.move_to_end(token)
+                return hit[0]
+            del _jwt_cache[token]
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGO])
-        return payload.get('sub')
     except Exception:
         return None
+    sub = payload.get('sub')
+    if sub and payload.get('exp'):
+        with _jwt_cache_lock:
+            _jwt_cache[token] = (sub, float(payload['exp']))
+            while len(_jwt_cache) > JWT_CACHE_SIZE:
+                _jwt_cache.popitem(last=False)
+    return sub
+
+def _login_attempt_key():
+    data = request.get_json(silent=True) or {}
+    return "login:" + str(data.get('username') or get_remote_address())
+
+def login_attempt_limit(view):
+    if not limiter:
+        return view
+    limit, window = LOGIN_ATTEMPT_LIMIT.amount, LOGIN_ATTEMPT_LIMIT.get_expiry()
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = _login_attempt_key()
+        now = int(time.time())
+        db = get_db()
+        row = db.execute("SELECT window_start, failures FROM login_failures WHERE key=?", (key,)).fetchone()
+        if row and row['window_start'] > now - window and row['failures'] >= limit:
+            resp = jsonify({"ok": False, "error": "too many failed logins, retry later"})
+            resp.headers['Retry-After'] = str(row['window_start'] + window - now)
+            return resp, 429
+        response = app.make_response(view(*args, **kwargs))
+        if response.status_code == 401:
+            # fixed window per key: a failure after the window restarts it; expired rows are dropped
+            db.execute("DELETE FROM login_failures WHERE window_start <= ?", (now - window,))
+            db.execute("INSERT INTO login_failures (key, window_start, failures) VALUES (?,?,1) "
+                       "ON CONFLICT(key) DO UPDATE SET failures = failures + 1", (key, now))
+            db.commit()
+        return response
+    return wrapper
+
+def _hasher_busy():
+    resp = jsonify({"ok": False, "error": "server busy, retry later"})
+    resp.headers['Retry-After'] = '1'
+    return resp, 503
 
 @app.route('/api/register', methods=['POST'])
 def api_register():
@@ -671,7 +1128,10 @@ def api_register():
     if cur.fetchone():
         return jsonify({"ok": False, "error": "username taken"}), 400
     uid = str(uuid.uuid4())
-    ph = bcrypt.hash(password)
+    try:
+        ph = PASSWORDS.hash(password)
+    except HasherBusy:
+        return _hasher_busy()
     ts = int(time.time())
     cur.execute("INSERT INTO users (id,username,password_hash,email,created_at) VALUES (?,?,?,?,?)", (uid, username, ph, email, ts))
     db.commit()
@@ -679,6 +1139,7 @@ def api_register():
     return jsonify({"ok": True, "user_id": uid, "token": token})
 
 @app.route('/api/login', methods=['POST'])
+@login_attempt_limit
 def api_login():
     data = request.get_json() or {}
     username = data.get('username')
@@ -689,8 +1150,18 @@ def api_login():
     cur = db.cursor()
     cur.execute("SELECT id, password_hash FROM users WHERE username=?", (username,))
     row = cur.fetchone()
-    if not row or not bcrypt.verify(password, row['password_hash']):
+    if not row:
         return jsonify({"ok": False, "error": "invalid credentials"}), 401
+    try:
+        ok, new_hash = PASSWORDS.verify(password, row['password_hash'])
+    except HasherBusy:
+        return _hasher_busy()
+    if not ok:
+        return jsonify({"ok": False, "error": "invalid credentials"}), 401
+    if new_hash:
+        # cost factor upgrade; skipped if the hash changed meanwhile
+        cur.execute("UPDATE users SET password_hash=? WHERE id=? AND password_hash=?", (new_hash, row['id'], row['password_hash']))
+        db.commit()
     token = create_token(row['id'])
     return jsonify({"ok": True, "token": token})
 
@@ -727,3 +1198,70 @@ def api_user_link_miner():
     cur.execute("INSERT INTO user_miners (id,user_id,miner_id,created_at) VALUES (?,?,?,?)", (link_id, uid, miner_id, ts))
     db.commit()
     return jsonify({"ok": True})
+
+# Stratum password for a linked miner when stratum_async runs with auth_backend "token"
+STRATUM_TOKEN_SECRET = os.getenv('STRATUM_AUTH_TOKEN_SECRET') or config.get('stratum_async', {}).get('auth_token_secret') or 'change_this_stratum_token_secret'
+
+@app.route('/api/user/miner_token', methods=['POST'])
+def api_user_miner_token():
+    """
+    Body: {"miner_id": ..., "ttl": seconds (optional, 0 = no expiry)}. Returns a token to use as
+    the mining.authorize password of that miner; the miner must be linked to the caller.
+    """
+    uid = verify_token_from_header(request)
+    if not uid:
+        return jsonify({"ok": False, "error": "unauthorized"}), 401
+    data = request.get_json() or {}
+    miner_id = data.get('miner_id')
+    if not miner_id:
+        return jsonify({"ok": False, "error": "missing miner_id"}), 400
+    try:
+        ttl = max(0, int(data.get('ttl') or 0))
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "invalid ttl"}), 400
+    db = get_db()
+    cur = db.cursor()
+    cur.execute("SELECT 1 FROM user_miners WHERE user_id=? AND miner_id=?", (uid, miner_id))
+    if not cur.fetchone():
+        return jsonify({"ok": False, "error": "miner not linked"}), 404
+    return jsonify({"ok": True, "miner_id": miner_id, "token": issue_token(STRATUM_TOKEN_SECRET, miner_id, ttl)})
+
+
+# --- Serving ---
+
+def start_background():
+    """
+    Start this process's background threads: the SSE publisher, the payout workers and the
+    hashrate rollup writer.
+    Idempotent, and safe after fork(): threads that did not survive the fork are started again.
+    """
+    STATE_HUB.start()
+    PAYOUT_WORKERS.start()
+    HASHRATE.start()
+
+def create_app():
+    """
+    App factory for WSGI servers (wsgi.py, gunicorn.conf.py): applies schema migrations and starts
+    the background threads of the calling process. Every worker process calls it; repeated calls
+    are cheap. Shared state (balances, simulated accounts, payout jobs) lives in SQLite, so any
+    number of worker processes can serve the same app.
+    """
+    init_db()
+    start_background()
+    return app
+
+
+if __name__ == "__main__":
+    # Werkzeug development server; for production use gunicorn: gunicorn -c gunicorn.conf.py wsgi:app
+    create_app()
+    # optionally allow overriding API key by env var
+    env_key = os.environ.get("MINING_SERVER_API_KEY")
+    if env_key:
+        config["server_api_key"] = env_key
+        with open(CONFIG_PATH, "w") as f:
+            json.dump(config, f, indent=2)
+    # Use PORT environment variable (Railway, Heroku, etc.) or default to 5000
+    port = int(os.getenv('PORT', 5000))
+    debug = os.getenv('FLASK_ENV') != 'production'
+    print(f"Starting Flask mining backend on http://0.0.0.0:{port}")
+    app.run(debug=debug, host="0.0.0.0", port=port)
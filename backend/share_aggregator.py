@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+share_aggregator.py - In-process aggregation of accepted shares before they are reported to the backend.
+
+The Stratum servers used to POST every single mining.submit to /api/report_share, blocking the
+caller until the backend answered. ShareAggregator instead:
+- queues accepted shares without blocking (add() only touches an in-memory dict),
+- combines them per (miner_id, worker_name) until flush_interval seconds pass or flush_count
+  submits have been queued,
+- sends HMAC-signed reports over a pooled keep-alive requests.Session from a dedicated
+  thread, so the asyncio event loop never waits on the backend,
+- retries failed flushes with exponential backoff and spills entries to a JSONL file on disk
+  when the backend stays unreachable; spilled entries are replayed on the next good flush,
+- bounds memory by capping the number of distinct (miner, worker) keys held in memory; shares
+  for keys over the cap are combined in an overflow table of the same size that the reporter
+  writes to the spill file (not add()); shares that fit in neither are dropped and counted.
+
+The reporter runs as a task on the server's asyncio loop (run()), or, for servers without one
+(stratum_server.py), on a dedicated thread with its own event loop (start()).
+
+If batch_url is configured the entries of a flush go out in signed requests of at most max_batch
+entries each (body: {"batch_id": ..., "reports": [...]}; keep max_batch <= the backend's
+MAX_REPORT_BATCH). A batch keeps its id through retries, the spill file and replay, so the
+backend credits a batch whose answer was lost (timeout after commit) only once. Otherwise each
+entry is sent to report_url using the same body format as before ({"miner_id", "worker_name",
+"shares"}). An entry the backend rejects with a 4xx is logged and dropped: sending it again would
+get the same answer.
+"""
+
+import asyncio, json, os, hmac, hashlib, threading, uuid, requests
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ReportError(Exception):
+    def __init__(self, status):
+        super().__init__(f"report_error:{status}")
+        self.status = status
+
+    @property
+    def permanent(self):
+        # the request itself is bad (signature, validation): retrying cannot help. 408/429 are load.
+        return 400 <= self.status < 500 and self.status not in (408, 429)
+
+
+class ShareAggregator:
+    def __init__(self, report_url, secret, batch_url="", flush_interval=2.0, flush_count=500,
+                 max_pending=10000, spill_path="", max_retries=5, backoff_base=0.5,
+                 backoff_max=30.0, timeout=5, max_batch=5000):
+        self.report_url = report_url
+        self.batch_url = batch_url
+        self.secret = secret or ""
+        self.flush_interval = float(flush_interval)
+        self.flush_count = int(flush_count)
+        self.max_pending = int(max_pending)
+        self.max_batch = max(1, int(max_batch))
+        self.spill_path = spill_path
+        self.max_retries = int(max_retries)
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+        self.timeout = timeout
+        self.pending = {}  # (miner_id, worker_name) -> shares
+        self.pending_submits = 0
+        self.overflow = {}  # (miner_id, worker_name) -> shares over max_pending, spilled by the reporter
+        self.lock = threading.Lock()
+        self.spill_lock = threading.Lock()
+        # one keep-alive connection to the backend, used only from the reporter thread
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="share-report")
+        self.stats = {"queued": 0, "reported": 0, "flushes": 0, "retries": 0, "spilled": 0, "replayed": 0, "dropped": 0,
+                      "overflow_dropped": 0}
+        self._loop = None
+        self._wakeup = None
+        self._thread = None
+
+    # --- producer side (called from connection handlers) ---
+    def add(self, miner_id, worker_name, shares=1):
+        """Queue shares for (miner_id, worker_name). Never blocks on the network."""
+        key = (miner_id or "unknown", worker_name or "")
+        with self.lock:
+            if key not in self.pending and len(self.pending) >= self.max_pending:
+                # memory cap reached: the reporter moves the share to disk on its next flush
+                if key in self.overflow or len(self.overflow) < self.max_pending:
+                    self.overflow[key] = self.overflow.get(key, 0) + shares
+                else:
+                    # the reporter is stuck retrying and both tables are full
+                    self.stats["overflow_dropped"] += 1
+                full = True
+            else:
+                self.pending[key] = self.pending.get(key, 0) + shares
+                full = False
+            self.pending_submits += 1
+            self.stats["queued"] += 1
+            full = full or self.pending_submits >= self.flush_count
+        if full:
+            self._notify()
+        return True
+
+    def _notify(self):
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def take_batch(self):
+        with self.lock:
+            entries = [{"miner_id": m, "worker_name": w, "shares": s} for (m, w), s in self.pending.items()]
+            self.pending = {}
+            self.pending_submits = 0
+        return entries
+
+    def take_overflow(self):
+        with self.lock:
+            overflow, self.overflow = self.overflow, {}
+        return [{"miner_id": m, "worker_name": w, "shares": s} for (m, w), s in overflow.items()]
+
+    def package(self, entries):
+        """Items to send: batches of at most max_batch entries with an id (batch_url), else the entries."""
+        if not self.batch_url:
+            return entries
+        return [{"batch_id": uuid.uuid4().hex, "reports": entries[i:i + self.max_batch]}
+                for i in range(0, len(entries), self.max_batch)]
+
+    @staticmethod
+    def count(items):
+        return sum(len(item["reports"]) if "reports" in item else 1 for item in items)
+
+    # --- reporting (runs on the reporter thread) ---
+    def _post(self, url, payload):
+        body = json.dumps(payload).encode("utf-8")
+        sig = hmac.new(self.secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+        headers = {"Content-Type": "application/json", "X-REPORT-SIG": sig}
+        r = self.session.post(url, headers=headers, data=body, timeout=self.timeout)
+        if r.status_code != 200:
+            raise ReportError(r.status_code)
+        return r
+
+    def send_batch(self, items):
+        """Send package()d items to the backend. Returns the items that could not be delivered."""
+        if not items:
+            return []
+        if self.batch_url:
+            for i, batch in enumerate(items):
+                try:
+                    self._post(self.batch_url, batch)
+                except Exception:
+                    # this batch and the ones not yet sent are retried under the same ids
+                    return items[i:]
+            return []
+        failed = []
+        for i, entry in enumerate(items):
+            try:
+                self._post(self.report_url, entry)
+            except requests.ConnectionError:
+                # backend is down; don't hammer it with the rest of the batch
+                failed.extend(items[i:])
+                break
+            except ReportError as e:
+                if e.permanent:
+                    print("share aggregator: dropping rejected entry", entry, e)
+                    with self.lock:
+                        self.stats["dropped"] += 1
+                else:
+                    failed.append(entry)
+            except Exception:
+                failed.append(entry)
+        return failed
+
+    # --- disk spill ---
+    def spill(self, items):
+        """Append entries or batches (one per line; batches keep their id) to the spill file."""
+        if not items:
+            return
+        n = self.count(items)
+        with self.lock:
+            self.stats["spilled"] += n
+        if not self.spill_path:
+            print("share aggregator: dropping", n, "entries (no spill_path configured)")
+            return
+        with self.spill_lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.spill_path)), exist_ok=True)
+            with open(self.spill_path, "a") as f:
+                for item in items:
+                    f.write(json.dumps(item) + "\n")
+
+    def load_spill(self):
+        """
+        Read and remove spilled items, ready to send: batches that were sent before are replayed
+        unchanged (the backend may have credited them already), entries are combined per
+        (miner_id, worker_name) and packaged.
+        """
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return []
+        with self.spill_lock:
+            combined = {}
+            batches = []
+            with open(self.spill_path, "r") as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                    except Exception:
+                        continue
+                    if "reports" in item and self.batch_url:
+                        batches.append(item)
+                        continue
+                    for e in item.get("reports") or [item]:
+                        key = (e.get("miner_id"), e.get("worker_name", ""))
+                        combined[key] = combined.get(key, 0) + e.get("shares", 0)
+            os.remove(self.spill_path)
+        return batches + self.package([{"miner_id": m, "worker_name": w, "shares": s} for (m, w), s in combined.items()])
+
+    # --- asyncio driver ---
+    async def flush(self):
+        loop = asyncio.get_running_loop()
+        overflow = self.take_overflow()
+        if overflow:
+            await loop.run_in_executor(self.executor, self.spill, overflow)
+        entries = self.take_batch()
+        if not entries:
+            return
+        total = len(entries)
+        items = self.package(entries)
+        dropped = self.stats["dropped"]
+        delay = self.backoff_base
+        for attempt in range(self.max_retries + 1):
+            items = await loop.run_in_executor(self.executor, self.send_batch, items)
+            if not items:
+                break
+            if attempt < self.max_retries:
+                with self.lock:
+                    self.stats["retries"] += 1
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.backoff_max)
+        with self.lock:
+            self.stats["flushes"] += 1
+            self.stats["reported"] += total - self.count(items) - (self.stats["dropped"] - dropped)
+        if items:
+            await loop.run_in_executor(self.executor, self.spill, items)
+            return
+        # backend is reachable again: replay anything we spilled earlier
+        replay = await loop.run_in_executor(self.executor, self.load_spill)
+        if replay:
+            failed = await loop.run_in_executor(self.executor, self.send_batch, replay)
+            with self.lock:
+                self.stats["replayed"] += self.count(replay) - self.count(failed)
+            if failed:
+                await loop.run_in_executor(self.executor, self.spill, failed)
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print("share aggregator flush error", e)
+
+    def start(self):
+        """Run the reporter on its own thread and event loop. add() may be called from any thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=asyncio.run, args=(self.run(),), name="share-reporter", daemon=True)
+            self._thread.start()
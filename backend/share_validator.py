@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+share_validator.py - Share checking and variable difficulty (vardiff) for the Stratum servers.
+
+validate_share() rebuilds what the miner hashed for a mining.submit:
+ - coinbase from the job's coinbase parts plus the connection's extranonce1 and the submitted extranonce2
+ - merkle root by folding sha256d(coinbase) with the job's merkle branch
+ - block header via assemble_block_header() with the submitted ntime and nonce
+and compares the header hash against the share target of the difficulty the job was sent with.
+parse_submit() checks the types of the mining.submit params before anything is looked up with them.
+
+VardiffController moves each connection's difficulty toward a target submit interval, so fast rigs
+submit fewer, higher-difficulty shares. As in Stratum, a new difficulty applies to the jobs sent
+after it; job_difficulty() answers which one a job was sent with. Shares are credited weighted
+by their difficulty.
+"""
+
+import binascii, time
+
+try:
+    from .stratum_job_assembler import sha256d, merkle_root_from_branch, assemble_block_header
+except ImportError:
+    from stratum_job_assembler import sha256d, merkle_root_from_branch, assemble_block_header
+
+# difficulty changes remembered per connection (the servers keep at most 16 recent jobs)
+HISTORY = 16
+
+# Target of a difficulty-1 share (bdiff)
+DIFF1_TARGET = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
+
+
+def difficulty_to_target(difficulty):
+    return int(DIFF1_TARGET / float(difficulty))
+
+
+def hash_difficulty(hash_int):
+    return DIFF1_TARGET / float(hash_int or 1)
+
+
+def parse_hex_int(value):
+    # ntime/nonce arrive as hex strings in mining.submit; ints are accepted for convenience
+    if isinstance(value, int):
+        return value
+    return int(value, 16)
+
+
+def parse_bits(bits):
+    if bits is None:
+        return None
+    if isinstance(bits, int):
+        return bits
+    return int(bits, 16)
+
+
+def parse_submit(params):
+    """
+    (worker, job_id, extranonce2, ntime, nonce) from mining.submit params, or None when malformed.
+    extranonce2 is lower-cased and ntime / nonce are parsed to ints, so one share has one
+    duplicate-check key however the miner spells its hex.
+    """
+    if not isinstance(params, list) or len(params) < 5:
+        return None
+    worker, job_id, extranonce2, ntime, nonce = params[:5]
+    if not isinstance(worker, str) or not isinstance(job_id, str) or not isinstance(extranonce2, str):
+        return None
+    try:
+        ntime, nonce = parse_hex_int(ntime), parse_hex_int(nonce)
+    except (ValueError, TypeError):
+        return None
+    if isinstance(ntime, bool) or isinstance(nonce, bool) or not (0 <= ntime <= 0xffffffff and 0 <= nonce <= 0xffffffff):
+        return None
+    return worker, job_id, extranonce2.lower(), ntime, nonce
+
+
+def validate_share(job, extranonce1, extranonce2, ntime, nonce, difficulty, extranonce2_size=4):
+    """
+    Returns (ok, error, share_difficulty). error is None when ok.
+    job needs: coinb1, coinb2, merkle_branch, previousblockhash, bits, version (optional) and curtime.
+    """
+    try:
+        if len(extranonce2) != extranonce2_size * 2:
+            return False, "invalid extranonce2 size", 0.0
+        ntime_i = parse_hex_int(ntime)
+        nonce_i = parse_hex_int(nonce)
+        coinbase = binascii.unhexlify(job["coinb1"] + extranonce1 + extranonce2 + job["coinb2"])
+    except (ValueError, TypeError, KeyError):
+        return False, "malformed submit", 0.0
+    curtime = job.get("curtime")
+    if curtime and not (curtime - 600 <= ntime_i <= curtime + 7200):
+        return False, "ntime out of range", 0.0
+    branch = [binascii.unhexlify(h) for h in job.get("merkle_branch", [])]
+    root = merkle_root_from_branch(sha256d(coinbase), branch)
+    _, header_hash = assemble_block_header(
+        job.get("previousblockhash") or "00" * 32,
+        binascii.hexlify(root[::-1]).decode(),
+        ntime_i, parse_bits(job.get("bits")), nonce_i, parse_bits(job.get("version")))
+    hash_int = int(header_hash, 16)
+    if hash_int > difficulty_to_target(difficulty):
+        return False, "low difficulty share", hash_difficulty(hash_int)
+    return True, None, hash_difficulty(hash_int)
+
+
+class VardiffController:
+    """
+    Per-connection difficulty controller. Call record_share() on every accepted share; it returns
+    the new difficulty when a retarget happened (send it with mining.set_difficulty) or None.
+    """
+
+    def __init__(self, initial=1.0, minimum=0.001, maximum=2 ** 32, target_interval=10.0,
+                 retarget_interval=60.0, variance=0.3, clock=time.time):
+        self.minimum = float(minimum)
+        self.maximum = float(maximum)
+        self.difficulty = min(max(float(initial), self.minimum), self.maximum)
+        self.target_interval = float(target_interval)
+        self.retarget_interval = float(retarget_interval)
+        self.variance = float(variance)
+        self.clock = clock
+        self.window_start = clock()
+        self.window_shares = 0
+        # (first job sequence number, difficulty), oldest first
+        self.history = [(0, self.difficulty)]
+
+    def job_difficulty(self, seq):
+        """Difficulty in force when the job with sequence number seq was sent."""
+        for first, difficulty in reversed(self.history):
+            if seq >= first:
+                return difficulty
+        return self.history[0][1]
+
+    def record_share(self, next_job=0):
+        """next_job: sequence number of the next job to be sent, the first one a retarget applies to."""
+        now = self.clock()
+        self.window_shares += 1
+        elapsed = now - self.window_start
+        # retarget once per retarget_interval, or early when a rig floods submits
+        flood = self.window_shares >= 4 * max(1.0, self.retarget_interval / self.target_interval)
+        if elapsed < self.retarget_interval and not flood:
+            return None
+        new = self._retarget(now, elapsed)
+        if new is not None:
+            self.history.append((next_job, new))
+            del self.history[:-HISTORY]
+        return new
+
+    def _retarget(self, now, elapsed):
+        shares = self.window_shares
+        self.window_start = now
+        self.window_shares = 0
+        if shares == 0:
+            return None
+        avg = max(elapsed, 0.001) / shares
+        low = self.target_interval * (1 - self.variance)
+        high = self.target_interval * (1 + self.variance)
+        if low <= avg <= high:
+            return None
+        # scale toward the target rate, at most 4x per step
+        factor = min(4.0, max(0.25, self.target_interval / avg))
+        new = min(max(self.difficulty * factor, self.minimum), self.maximum)
+        if new == self.difficulty:
+            return None
+        self.difficulty = new
+        return new
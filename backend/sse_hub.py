@@ -0,0 +1,142 @@
+"""
+sse_hub.py - Server-Sent Events fan-out for /api/stream.
+
+A single publisher thread takes a state snapshot, serializes it once and pushes the same encoded
+bytes to every subscriber queue. Frames are only sent when the snapshot changes (or when
+notify() is called after a state change), plus a comment heartbeat so proxies keep idle
+streams open. Each subscriber has a small bounded queue; a client that falls behind is dropped
+instead of slowing down the others.
+
+The hub only uses threading primitives and queue.Queue, so it works with the threaded Werkzeug
+server and, unchanged, under a gevent worker (gunicorn -k gevent) where every stream is a
+greenlet rather than an OS thread - that is the recommended way to serve thousands of streams.
+With threaded workers every stream holds a thread for as long as it is open; max_subscribers caps
+them per process (subscribe() returns None past it) so some threads stay free for the API.
+"""
+
+import json
+import queue
+import threading
+import time
+
+HEARTBEAT = b": ping\n\n"
+
+
+class Subscriber:
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize)
+        self.dropped = False
+
+
+class BroadcastHub:
+    def __init__(self, snapshot, poll_interval=1.0, heartbeat_interval=15.0, max_queue=16, max_subscribers=0):
+        """
+        snapshot: callable returning a JSON-serializable dict of the current state.
+        poll_interval: how often the publisher checks for changes when nobody calls notify().
+        max_subscribers: open streams allowed at once (0 = no limit).
+        """
+        self.snapshot = snapshot
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.max_queue = max_queue
+        self.max_subscribers = max_subscribers
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.last_state = None
+        self.last_frame = None
+        self.last_sent = 0.0
+        self.stats = {"frames": 0, "heartbeats": 0, "dropped": 0, "refused": 0}
+        self._thread = None
+
+    def start(self):
+        # idempotent: safe to call from every request / worker init
+        with self.lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="sse-hub", daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        """Wake the publisher right away (call after changing state)."""
+        self.wakeup.set()
+
+    def subscribe(self):
+        """New Subscriber, or None when max_subscribers streams are already open."""
+        sub = Subscriber(self.max_queue)
+        with self.lock:
+            if self.max_subscribers and len(self.subscribers) >= self.max_subscribers:
+                self.stats["refused"] += 1
+                return None
+            self.subscribers.add(sub)
+            frame = self.last_frame
+        if frame is not None:
+            sub.queue.put_nowait(frame)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers.discard(sub)
+
+    def publish(self, frame):
+        with self.lock:
+            subs = list(self.subscribers)
+        for sub in subs:
+            try:
+                sub.queue.put_nowait(frame)
+            except queue.Full:
+                self._drop(sub)
+
+    def _drop(self, sub):
+        # slow consumer: discard its backlog and leave a sentinel so its stream ends
+        self.unsubscribe(sub)
+        sub.dropped = True
+        self.stats["dropped"] += 1
+        try:
+            while True:
+                sub.queue.get_nowait()
+        except queue.Empty:
+            pass
+        sub.queue.put_nowait(None)
+
+    def _tick(self):
+        state = self.snapshot()
+        now = time.time()
+        if state != self.last_state:
+            payload = dict(state)
+            payload["ts"] = int(now)
+            frame = b"data: " + json.dumps(payload).encode("utf-8") + b"\n\n"
+            with self.lock:
+                self.last_state = state
+                self.last_frame = frame
+            self.publish(frame)
+            self.stats["frames"] += 1
+            self.last_sent = now
+        elif now - self.last_sent >= self.heartbeat_interval:
+            self.publish(HEARTBEAT)
+            self.stats["heartbeats"] += 1
+            self.last_sent = now
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+            try:
+                self._tick()
+            except Exception as e:
+                print("sse hub error", e)
+
+    def stream(self, sub):
+        """Generator of encoded frames for one client; ends when the client is dropped."""
+        try:
+            while True:
+                try:
+                    frame = sub.queue.get(timeout=self.heartbeat_interval * 2)
+                except queue.Empty:
+                    # publisher stalled; keep the connection alive anyway
+                    frame = HEARTBEAT
+                if frame is None:
+                    break
+                yield frame
+        finally:
+            self.unsubscribe(sub)
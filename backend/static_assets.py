@@ -0,0 +1,132 @@
+"""
+static_assets.py - Serve the frontend with HTTP caching.
+
+tools/build_static.py turns frontend/ into a build directory (default frontend/dist):
+ - <name>.<hash>.js / .css copies of the scripts and stylesheets, referenced from the HTML, so they
+   can be cached for a year ("immutable") and change URL whenever their content changes
+ - .gz (and .br, when the brotli package is installed) siblings of every text file, compressed once
+   at build time instead of per request
+ - asset-manifest.json mapping original names to hashed names, and a service worker that precaches them
+
+StaticAssets serves that build (or the plain frontend/ folder when nothing was built):
+ - /static/<file>: the precompressed variant the client accepts, an ETag and Cache-Control
+   (immutable for hashed names, no-cache = always revalidate for everything else)
+ - HTML entry points (/, /index.html, ...): held in memory with their compressed variants and ETag,
+   so a dashboard load never touches the disk; If-None-Match answers 304
+
+In production nginx serves the same build directory directly (nginx/conf.d/mining.conf); this
+module is the fallback for single-container deployments and development.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+
+from flask import Response, abort, request, send_file
+from werkzeug.security import safe_join
+
+MANIFEST_NAME = "asset-manifest.json"
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+# (Content-Encoding, file suffix) in order of preference
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+mimetypes.add_type("application/manifest+json", ".webmanifest")
+mimetypes.add_type("text/javascript", ".js")
+
+
+def load_manifest(build_dir):
+    try:
+        with open(os.path.join(build_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class StaticAssets:
+    def __init__(self, source_dir, build_dir=None, reload=False):
+        """
+        source_dir: the frontend folder. build_dir: output of tools/build_static.py; used when it
+        holds an asset manifest. reload=True re-reads HTML when the file changes (development).
+        """
+        self.manifest = load_manifest(build_dir) if build_dir else None
+        if self.manifest is not None:
+            self.html_dir = build_dir
+            self.static_dir = os.path.join(build_dir, "static")
+        else:
+            self.html_dir = self.static_dir = source_dir
+        self.hashed = set((self.manifest or {}).get("assets", {}).values())
+        self.reload = reload
+        self._html = {}
+        self._lock = threading.Lock()
+
+    @property
+    def built(self):
+        return self.manifest is not None
+
+    def _accepted(self):
+        return [(enc, suffix) for enc, suffix in ENCODINGS if request.accept_encodings[enc]]
+
+    def _load_html(self, name):
+        path = safe_join(self.html_dir, name)
+        if path is None or not os.path.isfile(path):
+            return None
+        mtime = os.path.getmtime(path)
+        with open(path, "rb") as f:
+            body = f.read()
+        variants = {None: body}
+        for enc, suffix in ENCODINGS:
+            if os.path.isfile(path + suffix):
+                with open(path + suffix, "rb") as f:
+                    variants[enc] = f.read()
+        if "gzip" not in variants:
+            variants["gzip"] = gzip.compress(body, 9, mtime=0)
+        etag = hashlib.sha256(body).hexdigest()[:16]
+        return {"mtime": mtime, "path": path, "variants": variants, "etag": etag}
+
+    def html(self, name):
+        """Response for an HTML entry point from the in-memory cache (404 if it does not exist)."""
+        entry = self._html.get(name)
+        if entry is None or (self.reload and os.path.getmtime(entry["path"]) != entry["mtime"]):
+            with self._lock:
+                entry = self._html[name] = self._load_html(name)
+        if entry is None:
+            abort(404)
+        encoding = next((enc for enc, _ in self._accepted() if enc in entry["variants"]), None)
+        etag = entry["etag"] + ("-" + encoding if encoding else "")
+        if etag in request.if_none_match:
+            resp = Response(status=304)
+        else:
+            resp = Response(entry["variants"][encoding], mimetype="text/html")
+            if encoding:
+                resp.headers["Content-Encoding"] = encoding
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = REVALIDATE
+        resp.headers["Vary"] = "Accept-Encoding"
+        return resp
+
+    def static(self, filename):
+        """Response for /static/<filename>, preferring a precompressed variant."""
+        path = safe_join(self.static_dir, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        encoding = None
+        for enc, suffix in self._accepted():
+            if os.path.isfile(path + suffix):
+                path, encoding = path + suffix, enc
+                break
+        immutable = os.path.basename(filename) in self.hashed
+        resp = send_file(path, mimetype=mimetype, conditional=True, etag=True,
+                         max_age=None if immutable else 0)
+        if encoding:
+            resp.headers["Content-Encoding"] = encoding
+        resp.headers["Cache-Control"] = IMMUTABLE if immutable else REVALIDATE
+        resp.headers["Vary"] = "Accept-Encoding"
+        if filename == "service-worker.js":
+            # registered from /static/ but controls the whole site
+            resp.headers["Service-Worker-Allowed"] = "/"
+        return resp
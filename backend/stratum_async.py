@@ -7,18 +7,52 @@ Features:
 - Uses asyncio streams for scalable TCP handling.
 - Pulls jobs from bitcoind via JSON-RPC getblocktemplate (configurable RPC URL).
 - Supports TLS when certificate and key paths are provided in config or env vars.
-- Worker authentication: validates user:password against configured credentials or optional JWT/HMAC adapter.
+- Worker authentication through stratum_auth.Authorizer: a static auth_map, pool accounts and their
+  linked miners in SQLite (/api/user/link_miner), or signed tokens; results are cached and slow
+  (bcrypt) checks run off the event loop.
 - Handles mining.subscribe, mining.authorize, mining.submit, and mining.extranonce.subscribe (basic).
 - Converts bitcoind getblocktemplate into a simplified notify job. This is a bridge/simplification —
   a production Stratum v1/v2 implementation requires more comprehensive protocol handling.
 Notes:
 - Configure in backend/config.json under "stratum_async".
-- Requires 'requests' in backend/requirements.txt for JSON-RPC calls to bitcoind.
+- JSON-RPC calls to bitcoind go through bitcoind_client.AsyncBitcoindRPC (pooled keep-alive connections).
+- Accepted shares are acknowledged immediately and reported to the backend in batches
+  by share_aggregator.ShareAggregator (report_flush_interval / report_flush_count).
+- processes > 1 (STRATUM_PROCESSES, 0 = one per CPU core): a supervisor process polls bitcoind
+  and builds each job once, then sends it over a pipe to N worker processes. Every worker runs
+  its own event loop on the same port (SO_REUSEPORT, the kernel spreads new connections over
+  them), validates and reports the shares of its connections, and sends its counters back to the
+  supervisor every second; the stats endpoint (served by the supervisor) sums them. Workers that
+  exit are restarted. Extranonce1 values are partitioned so they stay unique across workers.
+  Jobs are written to each pipe by a per-worker sender thread from a bounded queue, so a worker
+  that stops reading never blocks the supervisor's event loop; one whose queue fills up or whose
+  pipe write stays blocked for worker_stall_timeout seconds is killed and restarted.
+- Every connection goes through stratum_guard.StratumGuard ("guard" section / STRATUM_* env):
+  per-connection and per-IP message rates checked before a line is parsed, a line length cap,
+  handshake and idle timeouts and temporary IP bans for clients that keep sending garbage. In
+  multi-process mode each worker keeps its own per-IP tables.
 """
 
-import asyncio, json, os, uuid, time, hmac, hashlib, requests, ssl
+import asyncio, json, os, uuid, time, hmac, hashlib, ssl, binascii, itertools, multiprocessing, signal, socket, queue, threading
+from collections import OrderedDict
 from datetime import datetime
-from .stratum_job_assembler import build_coinbase, merkle_root, assemble_block_header
+try:
+    from .stratum_job_assembler import build_coinbase, assemble_block_header, txid_from_raw, merkle_root_from_branch, split_coinbase, MerkleEngine
+    from .share_aggregator import ShareAggregator
+    from .share_validator import validate_share, parse_submit, parse_bits, VardiffController
+    from .bitcoind_client import AsyncBitcoindRPC, RPCError
+    from . import stratum_codec as codec
+    from .stratum_guard import StratumGuard, load_guard_config, CLOSE, DROP
+    from .stratum_auth import Authorizer, make_backend, BUSY
+except ImportError:
+    # running as a script (python backend/stratum_async.py)
+    from stratum_job_assembler import build_coinbase, assemble_block_header, txid_from_raw, merkle_root_from_branch, split_coinbase, MerkleEngine
+    from share_aggregator import ShareAggregator
+    from share_validator import validate_share, parse_submit, parse_bits, VardiffController
+    from bitcoind_client import AsyncBitcoindRPC, RPCError
+    import stratum_codec as codec
+    from stratum_guard import StratumGuard, load_guard_config, CLOSE, DROP
+    from stratum_auth import Authorizer, make_backend, BUSY
 
 
 CFG_PATH = os.path.join(os.path.dirname(__file__), "config.json")
@@ -38,135 +72,409 @@ def load_config():
     sc["tls_cert"] = os.getenv("STRATUM_TLS_CERT", sc.get("tls_cert",""))
     sc["tls_key"] = os.getenv("STRATUM_TLS_KEY", sc.get("tls_key",""))
     sc["auth_map"] = sc.get("auth_map", {})  # { "workername": "password" }
+    # worker authorization (see stratum_auth.py): static (auth_map), sqlite (user_miners) or token
+    sc["auth_backend"] = os.getenv("STRATUM_AUTH_BACKEND", sc.get("auth_backend", "static"))
+    sc["auth_db_path"] = os.getenv("MINING_DB_PATH", sc.get("auth_db_path", os.path.join(os.path.dirname(__file__), "data", "withdrawals.db")))
+    sc["auth_token_secret"] = os.getenv("STRATUM_AUTH_TOKEN_SECRET", sc.get("auth_token_secret", "change_this_stratum_token_secret"))
+    sc["auth_ttl"] = float(os.getenv("STRATUM_AUTH_TTL", sc.get("auth_ttl", 300)))
+    sc["auth_negative_ttl"] = float(os.getenv("STRATUM_AUTH_NEGATIVE_TTL", sc.get("auth_negative_ttl", 30)))
+    sc["auth_cache_size"] = int(os.getenv("STRATUM_AUTH_CACHE_SIZE", sc.get("auth_cache_size", 100000)))
+    sc["auth_threads"] = int(os.getenv("STRATUM_AUTH_THREADS", sc.get("auth_threads", 4)))
+    sc["auth_max_pending"] = int(os.getenv("STRATUM_AUTH_MAX_PENDING", sc.get("auth_max_pending", 256)))
+    sc["auth_reload_interval"] = float(os.getenv("STRATUM_AUTH_RELOAD_INTERVAL", sc.get("auth_reload_interval", 5)))
+    sc["auth_cache_path"] = os.getenv("STRATUM_AUTH_CACHE_PATH", sc.get("auth_cache_path", os.path.join(os.path.dirname(__file__), "data", "auth_cache.json")))
     sc["report_url"] = os.getenv("REPORT_URL", sc.get("report_url","http://127.0.0.1:5000/api/report_share"))
     sc["report_secret"] = os.getenv("REPORT_SHARED_SECRET", sc.get("report_secret","change_this_report_secret"))
     sc["poll_interval"] = int(os.getenv("STRATUM_POLL_INTERVAL", sc.get("poll_interval", 10)))
+    # getblocktemplate long polling (falls back to poll_interval polling if unsupported/failing)
+    sc["longpoll"] = str(os.getenv("STRATUM_LONGPOLL", sc.get("longpoll", True))).lower() in ("1", "true", "yes")
+    sc["longpoll_timeout"] = int(os.getenv("STRATUM_LONGPOLL_TIMEOUT", sc.get("longpoll_timeout", 120)))
+    # long polls failing fast this many times in a row switch long polling off for the process
+    sc["longpoll_max_failures"] = int(os.getenv("STRATUM_LONGPOLL_MAX_FAILURES", sc.get("longpoll_max_failures", 5)))
+    # minimum seconds between non-clean jobs triggered by fee/tx-set changes only
+    sc["job_refresh_interval"] = float(os.getenv("STRATUM_JOB_REFRESH_INTERVAL", sc.get("job_refresh_interval", 5)))
+    # broadcast backpressure: per-client drain timeout and output buffer high-water mark (bytes)
+    sc["drain_timeout"] = float(os.getenv("STRATUM_DRAIN_TIMEOUT", sc.get("drain_timeout", 5.0)))
+    sc["client_buffer_hwm"] = int(os.getenv("STRATUM_CLIENT_BUFFER_HWM", sc.get("client_buffer_hwm", 256 * 1024)))
+    # share difficulty / vardiff
+    sc["initial_difficulty"] = float(os.getenv("STRATUM_INITIAL_DIFFICULTY", sc.get("initial_difficulty", 1.0)))
+    sc["min_difficulty"] = float(os.getenv("STRATUM_MIN_DIFFICULTY", sc.get("min_difficulty", 0.001)))
+    sc["max_difficulty"] = float(os.getenv("STRATUM_MAX_DIFFICULTY", sc.get("max_difficulty", 2 ** 32)))
+    sc["vardiff_target_interval"] = float(os.getenv("STRATUM_VARDIFF_TARGET", sc.get("vardiff_target_interval", 10.0)))
+    sc["vardiff_retarget_interval"] = float(os.getenv("STRATUM_VARDIFF_RETARGET", sc.get("vardiff_retarget_interval", 60.0)))
+    sc["extranonce2_size"] = int(sc.get("extranonce2_size", 4))
+    # optional HTTP endpoint serving METRICS as JSON (0 = disabled)
+    sc["stats_port"] = int(os.getenv("STRATUM_STATS_PORT", sc.get("stats_port", 0)))
+    # worker processes sharing the port (1 = single process, 0 = one per CPU core)
+    sc["processes"] = int(os.getenv("STRATUM_PROCESSES", sc.get("processes", 1)))
+    # a worker that has not taken a job off its pipe for this many seconds is killed and restarted
+    sc["worker_stall_timeout"] = float(os.getenv("STRATUM_WORKER_STALL_TIMEOUT", sc.get("worker_stall_timeout", 10.0)))
+    # share report aggregation (see share_aggregator.py)
+    # batch endpoint next to report_url unless configured explicitly (set to "" to disable)
+    default_batch = sc["report_url"] + "s" if sc["report_url"].endswith("/api/report_share") else ""
+    sc["report_batch_url"] = os.getenv("REPORT_BATCH_URL", sc.get("report_batch_url", default_batch))
+    sc["report_flush_interval"] = float(os.getenv("REPORT_FLUSH_INTERVAL", sc.get("report_flush_interval", 2.0)))
+    sc["report_flush_count"] = int(os.getenv("REPORT_FLUSH_COUNT", sc.get("report_flush_count", 500)))
+    sc["report_max_pending"] = int(os.getenv("REPORT_MAX_PENDING", sc.get("report_max_pending", 10000)))
+    sc["report_max_retries"] = int(os.getenv("REPORT_MAX_RETRIES", sc.get("report_max_retries", 5)))
+    # entries per batch request; keep at or below the backend's MAX_REPORT_BATCH
+    sc["report_max_batch"] = int(os.getenv("REPORT_MAX_BATCH", sc.get("report_max_batch", 5000)))
+    # flood protection: rate limits, line cap, timeouts, bans (see stratum_guard.py for the keys)
+    sc["guard"] = load_guard_config(sc.get("guard"))
+    sc["report_spill_path"] = os.getenv("REPORT_SPILL_PATH", sc.get("report_spill_path", os.path.join(os.path.dirname(__file__), "data", "share_spill.jsonl")))
     return sc
 
 CONFIG = load_config()
 
-# Helper: call bitcoind JSON-RPC
-def bitcoind_rpc(rpc_url, method, params=None):
-    try:
-        if params is None:
-            params = []
-        from urllib.parse import urlparse, urlunparse
-        parsed = urlparse(rpc_url)
-        netloc = parsed.hostname
-        if parsed.port:
-            netloc = f"{netloc}:{parsed.port}"
-        rpc_endpoint = urlunparse((parsed.scheme, netloc, parsed.path or "/", "", "", ""))
-        auth = None
-        if parsed.username:
-            auth = (parsed.username, parsed.password or "")
-        payload = {"jsonrpc":"1.0","id":"stratum-"+str(uuid.uuid4()), "method": method, "params": params}
-        headers = {"content-type":"application/json"}
-        resp = requests.post(rpc_endpoint, auth=auth, json=payload, headers=headers, timeout=10)
-        resp.raise_for_status()
-        return resp.json()
-    except Exception as e:
-        return {"error": str(e)}
-
 # Convert getblocktemplate -> simplified job dict for miners
 def make_job_from_gbt(gbt_result):
     # gbt_result expected as dict from bitcoind getblocktemplate 'result' field
     if not gbt_result:
         return None
-    # Simplify: include blockhash/template info, coinbase value, height, target (bits)
+    # Simplify: include blockhash/template info, coinbase value, height, target (bits).
+    # The raw template is kept by the broadcaster, not copied into every job.
     job = {
         "job_id": str(uuid.uuid4()),
         "height": gbt_result.get("height"),
         "previousblockhash": gbt_result.get("previousblockhash"),
         "coinbase_tx": gbt_result.get("coinbasevalue"),
         "target": gbt_result.get("target") or gbt_result.get("bits",""),
+        "bits": gbt_result.get("bits"),
+        "curtime": gbt_result.get("curtime"),
+        "version": gbt_result.get("version"),
         "timestamp": int(time.time()),
-        "data": gbt_result  # include raw for advanced clients
     }
     return job
 
+def template_txids(gbt_result):
+    txids = []
+    for t in gbt_result.get('transactions', []):
+        tid = t.get('txid') if isinstance(t, dict) else t
+        if tid:
+            txids.append(tid)
+    return txids
+
+def template_signature(gbt_result):
+    """(prev-hash, fee total, tx set) used to decide whether a new template needs a new job."""
+    fees = sum((t.get('fee') or 0) for t in gbt_result.get('transactions', []) if isinstance(t, dict))
+    return (gbt_result.get("previousblockhash"), fees, frozenset(template_txids(gbt_result)))
+
+def encode_notify(job, clean_jobs):
+    """Pre-encode the mining.notify frame once per job; every connection gets the same bytes."""
+    return codec.notify(job["job_id"], {
+        "target": job.get("target"),
+        "height": job.get("height"),
+        "prevhash": job.get("previousblockhash"),
+        "merkle_branch": job.get("merkle_branch", []),
+        "coinb1": job.get("coinb1"),
+        "coinb2": job.get("coinb2"),
+        "version": job.get("version"),
+        "nbits": job.get("bits"),
+        "ntime": job.get("curtime"),
+    }, clean_jobs)
+
+# Counters exported on the stats endpoint
+METRICS = {
+    "broadcasts": 0,
+    "last_broadcast_clients": 0,
+    "last_broadcast_ms": 0.0,       # until every client's frame was flushed to the socket
+    "last_broadcast_p99_ms": 0.0,   # p99 of per-client flush latency in the last broadcast
+    "slow_peers_evicted": 0,
+    "longpoll_failures": 0,
+    "templates_deferred": 0,
+    "shares_accepted": 0,
+    "shares_rejected": 0,
+}
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
 # Broadcast jobs to all connected workers
 class JobBroadcaster:
     def __init__(self):
         self.job = None
         self.clients = set()
-        self.lock = asyncio.Lock()
+        self.merkle = MerkleEngine()
+        self.template = None
+        self.signature = None
+        self.longpollid = None
+        self.longpoll = CONFIG.get("longpoll", True)
+        self.deferred = None  # newest template held back by job_refresh_interval
+        self.deferred_timer = None
+        self.refresh_task = None
+        self.rpc = None  # AsyncBitcoindRPC, created on first use inside the event loop
+        self.jobs = OrderedDict()  # job_id -> job, for validating submits against recent jobs
+        self.seq = 0  # sequence number of the current job (VardiffController.job_difficulty)
+        self.publish = None  # set by the Supervisor: new jobs go to the worker processes instead
 
-    async def update_job_from_rpc(self):
-        rpc = CONFIG.get("rpc_url")
-        if not rpc:
-            return
-        res = bitcoind_rpc(rpc, "getblocktemplate", [{"rules": ["segwit"]}])
-        if res.get("error"):
-            return
-        result = res.get("result") or res
+    def build_job(self, result, clean_jobs):
         new_job = make_job_from_gbt(result)
-            # attempt basic job assembly: build coinbase and merkle root if txids present
-            try:
-                txids = [t.get('txid') if isinstance(t, dict) else t for t in result.get('transactions', [])]
-                # fallback txid extraction
-                txid_list = []
-                for t in txids:
-                    if not t:
-                        continue
-                    if isinstance(t, dict):
-                        tid = t.get('txid')
-                    else:
-                        tid = t
-                    if tid:
-                        txid_list.append(tid)
-                if txid_list:
-                    mr = merkle_root(txid_list)
-                    cb = build_coinbase('', '00000000', '00', result.get('height'))
-                    header_hex, header_hash = assemble_block_header(result.get('previousblockhash','00'*32), mr, result.get('curtime'), result.get('bits'))
-                    new_job['merkle_root'] = mr
-                    new_job['coinbase'] = cb
-                    new_job['header'] = header_hex
-            except Exception as e:
-                pass
+        # coinbase halves and merkle branch (cached across templates) first: validate_share needs
+        # them, the sample coinbase / header below are informational only
+        new_job['coinb1'], new_job['coinb2'] = split_coinbase('', result.get('height'), 4, CONFIG.get("extranonce2_size", 4))
+        branch = self.merkle.branch(template_txids(result))
+        new_job['merkle_branch'] = [binascii.hexlify(h).decode() for h in branch]
+        try:
+            cb = build_coinbase('', '00000000', '00', result.get('height'))
+            mr = merkle_root_from_branch(binascii.unhexlify(txid_from_raw(cb))[::-1], branch)
+            mr = binascii.hexlify(mr[::-1]).decode()
+            # bitcoind sends bits as a hex string ("1d00ffff")
+            header_hex, header_hash = assemble_block_header(result.get('previousblockhash','00'*32), mr, result.get('curtime'),
+                                                            parse_bits(result.get('bits')), version=parse_bits(result.get('version')))
+            new_job['merkle_root'] = mr
+            new_job['coinbase'] = cb
+            new_job['header'] = header_hex
+        except Exception as e:
+            print("job assembly error", e)
+        new_job["clean_jobs"] = clean_jobs
+        new_job["seen"] = set()  # (extranonce1, extranonce2, ntime, nonce) already credited
+        new_job["notify_frame"] = encode_notify(new_job, clean_jobs)
+        return new_job
+
+    async def on_template(self, result):
+        """Diff a fresh template against the current one and broadcast only if it matters."""
+        sig = template_signature(result)
+        old = self.signature
+        if old is not None and sig == old:
+            return False
+        clean_jobs = old is None or sig[0] != old[0]
+        if not clean_jobs and self.job:
+            wait = CONFIG.get("job_refresh_interval", 5) - (time.time() - self.job["timestamp"])
+            if wait > 0:
+                # same prev-hash, only fees/txs moved: don't churn miners more often than
+                # job_refresh_interval, but send the newest such template once it has passed
+                self.defer(result, wait)
+                return False
+        self.deferred = None
+        self.template = result
+        self.signature = sig
+        job = self.build_job(result, clean_jobs)
+        if self.publish is not None:
+            self.job = job
+            self.publish(job)
+            return True
+        await self.install_job(job)
+        return True
+
+    def defer(self, result, wait):
+        self.deferred = result
+        METRICS["templates_deferred"] += 1
+        if self.deferred_timer is None:
+            self.deferred_timer = asyncio.get_running_loop().call_later(wait, self._refresh_deferred)
 
-        if new_job and (not self.job or new_job.get("height") != self.job.get("height")):
-            async with self.lock:
-                self.job = new_job
-                await self.broadcast_job(self.job)
+    def _refresh_deferred(self):
+        self.deferred_timer = None
+        # None when a newer job (e.g. a new block) went out in the meantime
+        result, self.deferred = self.deferred, None
+        if result is not None:
+            self.refresh_task = asyncio.create_task(self.on_template(result))
+
+    async def install_job(self, job):
+        """Make job current (also used by worker processes for jobs received from the supervisor)."""
+        self.seq += 1
+        job["seq"] = self.seq
+        self.job = job
+        if job["clean_jobs"]:
+            # shares for the previous block are stale now
+            self.jobs.clear()
+        self.jobs[job["job_id"]] = job
+        while len(self.jobs) > 16:
+            self.jobs.popitem(last=False)
+        await self.broadcast_job(job)
+
+    async def fetch_template(self, longpollid=None):
+        if self.rpc is None:
+            if not CONFIG.get("rpc_url"):
+                return None
+            self.rpc = AsyncBitcoindRPC(CONFIG["rpc_url"], timeout=10)
+        req = {"rules": ["segwit"]}
+        timeout = 10
+        if longpollid:
+            req["longpollid"] = longpollid
+            timeout = CONFIG.get("longpoll_timeout", 120)
+        try:
+            # long polls wait for a new template, so they must not be answered from the cache
+            return await self.rpc.call("getblocktemplate", [req], timeout=timeout, cache=not longpollid)
+        except RPCError as e:
+            print("getblocktemplate failed", e)
+            return None
+
+    async def update_job_from_rpc(self):
+        result = await self.fetch_template()
+        if result:
+            self.longpollid = result.get("longpollid")
+            await self.on_template(result)
 
     async def periodic_poll(self, interval=10):
+        """
+        Long-poll getblocktemplate when bitcoind supports it, otherwise poll every interval seconds.
+        A long poll that fails sooner than interval (an RPC error, not a timeout) is retried after
+        an exponential backoff; after longpoll_max_failures of those in a row long polling is
+        switched off and the template is polled every interval seconds.
+        """
+        failures = 0
         while True:
             try:
+                if self.longpoll and self.longpollid:
+                    started = time.monotonic()
+                    result = await self.fetch_template(self.longpollid)
+                    if result:
+                        failures = 0
+                        self.longpollid = result.get("longpollid")
+                        await self.on_template(result)
+                        continue
+                    # long poll failed or timed out: drop back to a plain poll
+                    self.longpollid = None
+                    if time.monotonic() - started < interval:
+                        failures += 1
+                        METRICS["longpoll_failures"] += 1
+                        if failures >= CONFIG.get("longpoll_max_failures", 5):
+                            print(f"long poll failed {failures} times in a row; polling every {interval}s instead")
+                            self.longpoll = False
+                        else:
+                            await asyncio.sleep(min(interval, 0.5 * 2 ** (failures - 1)))
                 await self.update_job_from_rpc()
             except Exception as e:
                 print("job poll error", e)
-            await asyncio.sleep(interval)
+                await asyncio.sleep(interval)
+                continue
+            if not (self.longpoll and self.longpollid):
+                await asyncio.sleep(interval)
+
+    def evict(self, w, reason):
+        self.clients.discard(w)
+        METRICS["slow_peers_evicted"] += 1
+        print("evicting slow miner", w.addr, reason)
+        try:
+            w.writer.transport.abort()
+        except Exception:
+            pass
 
     async def broadcast_job(self, job):
-        msg = json.dumps({"method":"mining.notify","params":[job["job_id"], {"target": job.get("target"), "height": job.get("height")}]})
-        to_remove = []
-        async with self.lock:
-            for w in list(self.clients):
-                try:
-                    await w.send_line(msg)
-                except Exception as e:
-                    to_remove.append(w)
-            for w in to_remove:
+        """
+        Write the pre-encoded frame to every transport without awaiting, then wait for the
+        clients that still have buffered output concurrently, each bounded by drain_timeout.
+        Clients over client_buffer_hwm or past the timeout are disconnected.
+        """
+        frame = job["notify_frame"]
+        hwm = CONFIG.get("client_buffer_hwm", 256 * 1024)
+        timeout = CONFIG.get("drain_timeout", 5.0)
+        start = time.perf_counter()
+        latencies = []
+        pending = []
+        for w in list(self.clients):
+            transport = w.writer.transport
+            if transport.is_closing():
+                self.clients.discard(w)
+                continue
+            if transport.get_write_buffer_size() > hwm:
+                self.evict(w, "output buffer over high-water mark")
+                continue
+            try:
+                w.writer.write(frame)
+            except Exception:
                 self.clients.discard(w)
+                continue
+            if transport.get_write_buffer_size():
+                pending.append(w)
+            else:
+                latencies.append(time.perf_counter() - start)
+
+        async def drain(w):
+            try:
+                await asyncio.wait_for(w.writer.drain(), timeout)
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                self.evict(w, "drain timeout")
+
+        if pending:
+            await asyncio.gather(*(drain(w) for w in pending))
+        METRICS["broadcasts"] += 1
+        METRICS["last_broadcast_clients"] = len(latencies)
+        METRICS["last_broadcast_ms"] = round((time.perf_counter() - start) * 1000.0, 3)
+        METRICS["last_broadcast_p99_ms"] = round(percentile(latencies, 99) * 1000.0, 3)
 
 BROADCASTER = JobBroadcaster()
 
+SHARES = ShareAggregator(
+    CONFIG.get("report_url"),
+    CONFIG.get("report_secret", "change_this_report_secret"),
+    batch_url=CONFIG.get("report_batch_url", ""),
+    flush_interval=CONFIG.get("report_flush_interval", 2.0),
+    flush_count=CONFIG.get("report_flush_count", 500),
+    max_pending=CONFIG.get("report_max_pending", 10000),
+    spill_path=CONFIG.get("report_spill_path", ""),
+    max_retries=CONFIG.get("report_max_retries", 5),
+    max_batch=CONFIG.get("report_max_batch", 5000),
+)
+
+# mining.authorize checks, cached (see stratum_auth.py)
+AUTH = Authorizer(
+    make_backend(CONFIG.get("auth_backend", "static"), auth_map=CONFIG.get("auth_map", {}), config_path=CFG_PATH,
+                 db_path=CONFIG.get("auth_db_path"), token_secret=CONFIG.get("auth_token_secret", "")),
+    CONFIG.get("auth_token_secret", ""),
+    ttl=CONFIG.get("auth_ttl", 300),
+    negative_ttl=CONFIG.get("auth_negative_ttl", 30),
+    max_entries=CONFIG.get("auth_cache_size", 100000),
+    threads=CONFIG.get("auth_threads", 4),
+    max_pending=CONFIG.get("auth_max_pending", 256),
+    cache_path=CONFIG.get("auth_cache_path", ""),
+    reload_interval=CONFIG.get("auth_reload_interval", 5),
+)
+
+# flood protection; every open WorkerConnection is in CONNECTIONS for the timeout sweep
+GUARD = StratumGuard(**CONFIG["guard"])
+CONNECTIONS = set()
+SWEEP_INTERVAL = 2.0
+PRUNE_INTERVAL = 60.0
+
+# 4-byte extranonce1 per connection, unique within this process
+EXTRANONCE1 = itertools.count(int.from_bytes(os.urandom(4), "big"))
+
+def next_extranonce1():
+    return "%08x" % (next(EXTRANONCE1) & 0xffffffff)
+
+def partition_extranonce1(index, count):
+    """Worker index of count only hands out values == index (mod count), from the lower half so they do not wrap."""
+    global EXTRANONCE1
+    start = int.from_bytes(os.urandom(4), "big") % (2 ** 31 // count) * count + index
+    EXTRANONCE1 = itertools.count(start, count)
+
 # Worker protocol handler
 class WorkerConnection:
-    def __init__(self, reader, writer):
+    def __init__(self, reader, writer, guard):
         self.reader = reader
         self.writer = writer
         self.addr = writer.get_extra_info("peername")
+        self.guard = guard  # stratum_guard.ConnectionState
         self.buffer = b""
         self.miner_id = None
         self.worker_name = None
         self.subscribed = False
         self.authorized = False
         self.extranonce_subscribed = False
+        self.extranonce1 = next_extranonce1()
+        self.vardiff = VardiffController(
+            initial=CONFIG.get("initial_difficulty", 1.0),
+            minimum=CONFIG.get("min_difficulty", 0.001),
+            maximum=CONFIG.get("max_difficulty", 2 ** 32),
+            target_interval=CONFIG.get("vardiff_target_interval", 10.0),
+            retarget_interval=CONFIG.get("vardiff_retarget_interval", 60.0),
+        )
 
     async def send_line(self, line):
+        if isinstance(line, bytes):
+            # pre-encoded frame (already newline terminated)
+            self.writer.write(line)
+            await self.writer.drain()
+            return
         if isinstance(line, dict):
-            line = json.dumps(line)
+            self.writer.write(codec.frame(line))
+            await self.writer.drain()
+            return
         if not line.endswith("\n"):
             line = line + "\n"
         self.writer.write(line.encode("utf-8"))
@@ -177,83 +485,124 @@ class WorkerConnection:
         method = obj.get("method")
         params = obj.get("params", [])
         if method == "mining.subscribe":
-            # respond with subscription and extranonce placeholder
+            # respond with subscriptions, extranonce1 and extranonce2 size
             self.subscribed = True
-            resp = {"id": req_id, "result": [str(uuid.uuid4()), "extranonce_placeholder"], "error": None}
+            sub_id = str(uuid.uuid4())
+            resp = {"id": req_id, "result": [[["mining.set_difficulty", sub_id], ["mining.notify", sub_id]],
+                                            self.extranonce1, CONFIG.get("extranonce2_size", 4)], "error": None}
             await self.send_line(resp)
+            await self.send_line(codec.set_difficulty(self.vardiff.difficulty))
             # send current job if available
             if BROADCASTER.job:
-                await self.send_line({"method":"mining.notify","params":[BROADCASTER.job["job_id"], {"target": BROADCASTER.job.get("target"), "height": BROADCASTER.job.get("height")}]})
+                await self.send_line(BROADCASTER.job["notify_frame"])
             return
         elif method == "mining.extranonce.subscribe":
             self.extranonce_subscribed = True
             await self.send_line({"id": req_id, "result": [True], "error": None})
             return
         elif method == "mining.authorize":
-            # params: [user, password]; validate against auth_map
+            # params: [user, password]; checked by the configured backend (cached)
+            if not isinstance(params, list) or not all(isinstance(p, str) for p in params[:2]):
+                GUARD.strike(self.guard, "invalid credentials")
+                await self.send_line(codec.error(req_id, "invalid credentials"))
+                return
             user = params[0] if len(params)>0 else ""
             pwd = params[1] if len(params)>1 else ""
-            auth_map = CONFIG.get("auth_map", {})
-            ok = False
-            if user and pwd:
-                if user in auth_map and auth_map[user] == pwd:
-                    ok = True
-                else:
-                    # allow any non-empty for testing if auth_map empty
-                    if not auth_map:
-                        ok = True
+            ok, err = await AUTH.authorize(user, pwd)
             self.worker_name = user
             self.miner_id = user
             self.authorized = ok
-            await self.send_line({"id": req_id, "result": ok, "error": None if ok else "auth failed"})
-            if ok:
+            self.guard.authorized = ok
+            await self.send_line(codec.ack(req_id) if ok else codec.error(req_id, err))
+            if not ok and err != BUSY:
+                GUARD.strike(self.guard, err)
+            elif ok:
                 # register in broadcaster
                 BROADCASTER.clients.add(self)
             return
         elif method == "mining.submit":
-            # params: [worker, job_id, nonce, extra]
+            # params: [worker, job_id, extranonce2, ntime, nonce]
             if not self.authorized:
-                await self.send_line({"id": req_id, "result": False, "error": "unauthorized"})
+                GUARD.strike(self.guard, "unauthorized submit")
+                await self.send_line(codec.error(req_id, "unauthorized"))
                 return
-            try:
-                worker = params[0]
-                job_id = params[1]
-                nonce = params[2] if len(params)>2 else ""
-                shares = 1
-            except Exception:
-                await self.send_line({"id": req_id, "result": False, "error": "invalid"})
+            submit = parse_submit(params)
+            if submit is None:
+                GUARD.strike(self.guard, "invalid submit")
+                await self.send_line(codec.error(req_id, "invalid"))
                 return
-            # Report share to backend /api/report_share with HMAC signing
-            payload = {"miner_id": self.miner_id or "unknown", "worker_name": self.worker_name or "", "shares": shares}
-            body = json.dumps(payload).encode("utf-8")
-            sig = hmac.new(CONFIG.get("report_secret","change_this_report_secret").encode("utf-8"), body, hashlib.sha256).hexdigest()
-            headers = {'Content-Type':'application/json', 'X-REPORT-SIG': sig}
-            try:
-                r = requests.post(CONFIG.get("report_url"), headers=headers, data=body, timeout=5)
-                if r.status_code == 200:
-                    await self.send_line({"id": req_id, "result": True, "error": None})
-                else:
-                    await self.send_line({"id": req_id, "result": False, "error": f"report_error:{r.status_code}"})
-            except Exception as e:
-                await self.send_line({"id": req_id, "result": False, "error": "report_failed"})
+            _, job_id, extranonce2, ntime, nonce = submit
+            job = BROADCASTER.jobs.get(job_id)
+            if job is None:
+                METRICS["shares_rejected"] += 1
+                await self.send_line(codec.error(req_id, "stale job"))
+                return
+            key = (self.extranonce1, extranonce2, ntime, nonce)
+            if key in job["seen"]:
+                METRICS["shares_rejected"] += 1
+                GUARD.strike(self.guard, "duplicate share")
+                await self.send_line(codec.error(req_id, "duplicate share"))
+                return
+            # the difficulty the miner was working at: set_difficulty applies to jobs sent after it
+            difficulty = self.vardiff.job_difficulty(job["seq"])
+            ok, err, _ = validate_share(job, self.extranonce1, extranonce2, ntime, nonce, difficulty,
+                                        CONFIG.get("extranonce2_size", 4))
+            if not ok:
+                METRICS["shares_rejected"] += 1
+                GUARD.strike(self.guard, err)
+                await self.send_line(codec.error(req_id, err))
+                return
+            job["seen"].add(key)
+            METRICS["shares_accepted"] += 1
+            # Credit the share weighted by its difficulty via the batched reporter and accept
+            # immediately; delivery to the backend happens off the event loop.
+            SHARES.add(self.miner_id, self.worker_name, difficulty)
+            await self.send_line(codec.ack(req_id))
+            new_diff = self.vardiff.record_share(BROADCASTER.seq + 1)
+            if new_diff is not None:
+                await self.send_line(codec.set_difficulty(new_diff))
             return
         else:
-            await self.send_line({"id": req_id, "result": None, "error": "unknown method"})
+            GUARD.strike(self.guard, "unknown method")
+            await self.send_line(codec.error(req_id, "unknown method", result=None))
             return
 
     async def run(self):
+        guard = self.guard
+        CONNECTIONS.add(self)
         try:
-            while not self.reader.at_eof():
-                line = await self.reader.readline()
+            while not self.reader.at_eof() and guard.closing is None:
+                try:
+                    line = await self.reader.readline()
+                except ValueError:
+                    # no newline within the StreamReader limit (max_line)
+                    GUARD.oversized(guard)
+                    break
                 if not line:
                     break
+                # rate limits and cheap checks before any parsing
+                verdict = GUARD.check_line(guard, line)
+                if verdict is DROP:
+                    continue
+                if verdict is CLOSE:
+                    break
                 try:
-                    obj = json.loads(line.decode('utf-8').strip())
+                    obj = codec.loads(line)
                 except Exception as e:
-                    await self.send_line({"id": None, "result": None, "error": "invalid json"})
+                    if GUARD.strike(guard, "invalid json"):
+                        break
+                    await self.send_line(codec.error(None, "invalid json", result=None))
+                    continue
+                if type(obj) is not dict:
+                    if GUARD.strike(guard, "invalid request"):
+                        break
                     continue
                 await self.handle_request(obj)
+        except (ConnectionError, OSError):
+            pass  # reset by the peer or aborted by the timeout sweep
         finally:
+            CONNECTIONS.discard(self)
+            GUARD.release(guard)
             try:
                 BROADCASTER.clients.discard(self)
             except Exception:
@@ -264,12 +613,255 @@ class WorkerConnection:
             except Exception:
                 pass
 
+# Minimal HTTP stats endpoint: any GET returns the current counters as JSON
+def stats_snapshot():
+    if SUPERVISOR is not None:
+        return SUPERVISOR.snapshot()
+    stats = dict(METRICS)
+    stats["clients"] = len(BROADCASTER.clients)
+    stats["connections"] = len(CONNECTIONS)
+    stats["guard"] = dict(GUARD.stats)
+    stats["auth"] = AUTH.snapshot()
+    stats["shares"] = dict(SHARES.stats)
+    return stats
+
+async def handle_stats(reader, writer):
+    try:
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        body = json.dumps(stats_snapshot()).encode("utf-8")
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: "
+                     + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
 # Server entrypoint
 async def handle_client(reader, writer):
-    conn = WorkerConnection(reader, writer)
+    peer = writer.get_extra_info("peername")
+    guard = GUARD.admit(peer[0] if peer else "")
+    if guard is None:
+        # banned or too many connections from this address
+        writer.transport.abort()
+        return
+    conn = WorkerConnection(reader, writer, guard)
     await conn.run()
 
-async def start_server():
+async def guard_sweep():
+    """Close connections past the handshake / idle timeout; prune expired bans and idle IP buckets."""
+    last_prune = time.monotonic()
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        now = time.monotonic()
+        for conn in list(CONNECTIONS):
+            reason = GUARD.expired(conn.guard, now)
+            if reason:
+                conn.guard.closing = reason
+                conn.writer.transport.abort()
+        if now - last_prune >= PRUNE_INTERVAL:
+            GUARD.prune(now)
+            last_prune = now
+
+# --- multi-process mode ---
+STATS_INTERVAL = 1.0
+SEND_QUEUE = 8  # jobs waiting for one worker before it counts as stalled
+
+def combine_stats(snapshots):
+    """Sum the counters of every worker; latencies (*_ms) take the maximum."""
+    out = {}
+    for snap in snapshots:
+        for key, value in snap.items():
+            if isinstance(value, dict):
+                out[key] = combine_stats([out.get(key, {}), value])
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                if key.endswith("_ms"):
+                    out[key] = max(out.get(key, value), value)
+                else:
+                    out[key] = out.get(key, 0) + value
+    return out
+
+class WorkerLink:
+    """Supervisor side of one worker process: its pipe and a sender thread fed by a bounded queue."""
+    def __init__(self, index, proc, conn):
+        self.proc = proc
+        self.conn = conn
+        self.outbox = queue.Queue(SEND_QUEUE)
+        self.sending_since = None  # monotonic start of the pipe write in progress
+        self.closed = False
+        threading.Thread(target=self._send_loop, name=f"stratum-send-{index}", daemon=True).start()
+
+    def send(self, msg):
+        """Queue msg for the worker without blocking; False when its queue is full."""
+        try:
+            self.outbox.put_nowait(msg)
+            return True
+        except queue.Full:
+            return False
+
+    def _send_loop(self):
+        while not self.closed:
+            try:
+                msg = self.outbox.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            self.sending_since = time.monotonic()
+            try:
+                self.conn.send(msg)
+            except (OSError, ValueError):
+                return  # worker is gone; watch() restarts it
+            finally:
+                self.sending_since = None
+
+    def stalled(self, now, timeout):
+        since = self.sending_since
+        return self.outbox.full() or (since is not None and now - since > timeout)
+
+    def close(self):
+        self.closed = True
+        self.conn.close()
+
+class Supervisor:
+    """
+    Owns the bitcoind polling in multi-process mode: jobs are built once here and sent to every
+    worker process; per-worker counters come back on the same pipe.
+    """
+    def __init__(self, processes):
+        self.processes = processes
+        self.ctx = multiprocessing.get_context("spawn")
+        self.workers = {}  # index -> WorkerLink
+        self.stats = {}    # index -> latest stats_snapshot() of that worker
+        self.restarts = 0
+        self.stalls = 0
+        self.loop = None
+
+    def spawn(self, index):
+        parent, child = self.ctx.Pipe()
+        proc = self.ctx.Process(target=run_worker, args=(index, self.processes, child),
+                                name=f"stratum-worker-{index}", daemon=True)
+        proc.start()
+        child.close()
+        link = self.workers[index] = WorkerLink(index, proc, parent)
+        self.loop.add_reader(parent.fileno(), self.on_message, index)
+        if BROADCASTER.job:
+            link.send(("job", BROADCASTER.job))
+
+    def publish(self, job):
+        for link in list(self.workers.values()):
+            # a full queue means the worker stopped reading: watch() restarts it with the current job
+            link.send(("job", job))
+
+    def on_message(self, index):
+        conn = self.workers[index].conn
+        try:
+            while conn.poll():
+                kind, data = conn.recv()
+                if kind == "stats":
+                    self.stats[index] = data
+        except (EOFError, OSError):
+            self.loop.remove_reader(conn.fileno())
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            for index, link in list(self.workers.items()):
+                proc = link.proc
+                if proc.is_alive():
+                    if link.stalled(now, CONFIG.get("worker_stall_timeout", 10.0)):
+                        print(f"stratum worker {index} (pid {proc.pid}) is not reading jobs; killing it")
+                        proc.kill()
+                        self.stalls += 1
+                    continue
+                print(f"stratum worker {index} (pid {proc.pid}) exited with {proc.exitcode}; restarting")
+                self.loop.remove_reader(link.conn.fileno())
+                link.close()
+                self.stats.pop(index, None)
+                self.restarts += 1
+                self.spawn(index)
+
+    def snapshot(self):
+        stats = combine_stats(self.stats.values())
+        stats["processes"] = self.processes
+        stats["worker_restarts"] = self.restarts
+        stats["worker_stalls"] = self.stalls
+        stats["workers"] = {str(i): s for i, s in sorted(self.stats.items())}
+        return stats
+
+    def stop(self):
+        for link in self.workers.values():
+            link.proc.terminate()
+        for link in self.workers.values():
+            link.proc.join(5)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        for index in range(self.processes):
+            self.spawn(index)
+        print(f"Stratum supervisor started {self.processes} worker processes on port {CONFIG.get('port', 3333)}")
+        BROADCASTER.publish = self.publish
+        asyncio.create_task(BROADCASTER.periodic_poll(CONFIG.get("poll_interval", 10)))
+        asyncio.create_task(self.watch())
+        if CONFIG.get("stats_port"):
+            await asyncio.start_server(handle_stats, "127.0.0.1", CONFIG["stats_port"])
+            print("Stratum stats on http://127.0.0.1:%d/" % CONFIG["stats_port"])
+        stopped = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(sig, stopped.set)
+        try:
+            await stopped.wait()
+        finally:
+            self.stop()
+
+SUPERVISOR = None
+
+async def worker_link(pipe):
+    """Worker side of the supervisor pipe: install received jobs, send counters back."""
+    loop = asyncio.get_running_loop()
+    closed = asyncio.Event()
+
+    def on_readable():
+        try:
+            while pipe.poll():
+                kind, data = pipe.recv()
+                if kind == "job":
+                    asyncio.ensure_future(BROADCASTER.install_job(data))
+        except (EOFError, OSError):
+            # supervisor is gone
+            loop.remove_reader(pipe.fileno())
+            closed.set()
+
+    loop.add_reader(pipe.fileno(), on_readable)
+    while not closed.is_set():
+        try:
+            pipe.send(("stats", stats_snapshot()))
+        except OSError:
+            break
+        try:
+            await asyncio.wait_for(closed.wait(), STATS_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+def run_worker(index, count, pipe):
+    """Entry point of a worker process (multiprocessing spawn target)."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C is handled by the supervisor
+    partition_extranonce1(index, count)
+    if SHARES.spill_path:
+        # one spill file per worker: each replays only its own
+        root, ext = os.path.splitext(SHARES.spill_path)
+        SHARES.spill_path = f"{root}.w{index}{ext}"
+    if AUTH.cache_path:
+        # saved per worker; each loads all of them at startup
+        root, ext = os.path.splitext(AUTH.cache_path)
+        AUTH.cache_path = f"{root}.w{index}{ext}"
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except Exception:
+        pass
+    asyncio.run(start_server(pipe))
+
+async def start_server(pipe=None):
     host = CONFIG.get("host", "0.0.0.0")
     port = int(CONFIG.get("port", 3333))
     tls_cert = CONFIG.get("tls_cert", "") or os.getenv("STRATUM_TLS_CERT","")
@@ -279,21 +871,45 @@ async def start_server():
         ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
         ssl_ctx.load_cert_chain(certfile=tls_cert, keyfile=tls_key)
         print("TLS enabled for Stratum on", host, port)
-    server = await asyncio.start_server(handle_client, host, port, ssl=ssl_ctx, limit=2**16)
+    # saved auth cache and backend state ready before the first miner (re)connects
+    await AUTH.prepare()
+    server = await asyncio.start_server(handle_client, host, port, ssl=ssl_ctx, limit=GUARD.max_line,
+                                        reuse_port=pipe is not None)
     addr = server.sockets[0].getsockname()
-    print(f"Stratum async server listening on {addr} (TLS={'yes' if ssl_ctx else 'no'})")
+    print(f"Stratum async server listening on {addr} (TLS={'yes' if ssl_ctx else 'no'}, pid {os.getpid()})")
+    # start batched share reporter
+    asyncio.create_task(SHARES.run())
+    asyncio.create_task(guard_sweep())
+    asyncio.create_task(AUTH.run())
+    if pipe is not None:
+        # worker process: jobs come from the supervisor, which also serves the stats
+        async with server:
+            await worker_link(pipe)
+        return
     # start periodic job poller
     asyncio.create_task(BROADCASTER.periodic_poll(CONFIG.get("poll_interval",10)))
+    if CONFIG.get("stats_port"):
+        await asyncio.start_server(handle_stats, "127.0.0.1", CONFIG["stats_port"])
+        print("Stratum stats on http://127.0.0.1:%d/" % CONFIG["stats_port"])
     async with server:
         await server.serve_forever()
 
 def main():
+    global SUPERVISOR
     try:
         import uvloop
         asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     except Exception:
         pass
-    asyncio.run(start_server())
+    processes = CONFIG.get("processes", 1) or os.cpu_count() or 1
+    if processes > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        print("SO_REUSEPORT is not available on this platform; running a single process")
+        processes = 1
+    if processes > 1:
+        SUPERVISOR = Supervisor(processes)
+        asyncio.run(SUPERVISOR.run())
+    else:
+        asyncio.run(start_server())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""
+stratum_auth.py - Worker authorization for the Stratum server (mining.authorize).
+
+Backends (stratum_async "auth_backend" / STRATUM_AUTH_BACKEND):
+- static: worker/password pairs from config.json "stratum_async.auth_map" (an empty map accepts
+  any non-empty worker and password); the file is re-read when it changes
+- sqlite: the worker name is a miner id linked to an account with /api/user/link_miner
+  (user_miners) and the password is that account's password (bcrypt hash in users); new links
+  are picked up while running
+- token: the password is a token for the worker name signed with auth_token_secret, issued by
+  POST /api/user/miner_token (issue_token()); nothing is looked up
+
+Authorizer puts a cache in front of the backend so the event loop never waits on a slow check:
+- results are kept in a TTL + LRU cache keyed by a keyed hash of worker and password (passwords
+  are not stored): accepts for ttl seconds, rejects for negative_ttl seconds
+- slow backends (bcrypt) run on a small thread pool; concurrent logins with the same credentials
+  share one check, and at most max_pending distinct checks wait for the pool - more are answered
+  "busy" and the miner retries later, so a reconnect storm is spread out instead of queued
+- accepts are saved to cache_path and loaded at startup: miners reconnecting after a restart are
+  accepted from the cache instead of all running bcrypt at once (the file holds keyed hashes
+  only; the key is auth_token_secret). The backend's cursor() is saved with them, and entries of
+  workers changed since (changed_since()) are dropped when the file is loaded
+- every reload_interval seconds the backend reports changes (config edits; links added, moved or
+  removed, changed passwords); cached results for the affected workers are dropped
+"""
+
+import asyncio
+import base64
+import glob
+import hashlib
+import hmac
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from .db import get_pool
+except ImportError:
+    from db import get_pool
+
+BUSY = "busy, retry later"
+FAILED = "auth failed"
+ALL = "all"  # changes(): every cached result is stale
+
+
+# --- signed tokens ---
+
+def _token_sig(secret, worker, expires):
+    mac = hmac.new(secret.encode("utf-8"), f"{worker}:{expires:x}".encode("utf-8"), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(mac[:16]).rstrip(b"=").decode("ascii")
+
+
+def issue_token(secret, worker, ttl=0, now=None):
+    """Password for worker accepted by TokenAuth; ttl 0 = does not expire."""
+    expires = int((time.time() if now is None else now) + ttl) if ttl else 0
+    return f"{expires:x}.{_token_sig(secret, worker, expires)}"
+
+
+# --- backends: check(worker, password) -> bool, may raise on backend errors (not cached) ---
+
+class StaticAuth:
+    name = "static"
+    slow = False
+
+    def __init__(self, auth_map=None, config_path=None):
+        self.auth_map = dict(auth_map or {})
+        self.config_path = config_path
+        self.mtime = self._mtime()
+
+    def _mtime(self):
+        try:
+            return os.stat(self.config_path).st_mtime if self.config_path else None
+        except OSError:
+            return None
+
+    def check(self, worker, password):
+        if not self.auth_map:
+            # no credentials configured: accept any non-empty worker/password (testing)
+            return True
+        expected = self.auth_map.get(worker)
+        return expected is not None and hmac.compare_digest(str(expected).encode("utf-8"), password.encode("utf-8"))
+
+    def cursor(self):
+        return hashlib.sha256(json.dumps(self.auth_map, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def changed_since(self, cursor):
+        return None if cursor == self.cursor() else ALL
+
+    def changes(self):
+        mtime = self._mtime()
+        if mtime is None or mtime == self.mtime:
+            return None
+        try:
+            with open(self.config_path, "r") as f:
+                auth_map = json.load(f).get("stratum_async", {}).get("auth_map", {})
+        except (OSError, ValueError):
+            return None  # half-written file: try again next time
+        self.mtime = mtime
+        if auth_map == self.auth_map:
+            return None
+        self.auth_map = dict(auth_map)
+        print(f"stratum auth: reloaded {len(self.auth_map)} workers from {self.config_path}")
+        return ALL
+
+
+class SqliteAuth:
+    name = "sqlite"
+    slow = True
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.last_seq = None  # highest auth_changes seq seen by changes()
+
+    def _query(self, sql, args=()):
+        pool = get_pool(self.db_path)
+        conn = pool.acquire()
+        try:
+            return conn.execute(sql, args).fetchall()
+        finally:
+            pool.release(conn)
+
+    def check(self, worker, password):
+        from passlib.hash import bcrypt
+        rows = self._query("SELECT u.password_hash FROM user_miners um JOIN users u ON u.id = um.user_id "
+                           "WHERE um.miner_id = ?", (worker,))
+        for row in rows:
+            if row["password_hash"] and bcrypt.verify(password, row["password_hash"]):
+                return True
+        return False
+
+    def _since(self, seq):
+        """(changed workers, ALL or None; newest seq) after seq."""
+        # auth_changes is filled by triggers on users and user_miners (db.py migration 8)
+        rows = self._query("SELECT seq, miner_id FROM auth_changes WHERE seq >= ? ORDER BY seq", (seq,))
+        if rows and rows[0]["seq"] == seq:
+            rows = rows[1:]
+        elif seq:
+            # the last entry seen was pruned (or the database replaced): changes may have been missed
+            return ALL, (rows[-1]["seq"] if rows else 0)
+        if not rows:
+            return None, seq
+        return {row["miner_id"] for row in rows}, rows[-1]["seq"]
+
+    def cursor(self):
+        return self.last_seq
+
+    def changed_since(self, cursor):
+        if not isinstance(cursor, int):
+            return ALL
+        return self._since(cursor)[0]
+
+    def changes(self):
+        if self.last_seq is None:
+            self.last_seq = self._query("SELECT COALESCE(MAX(seq), 0) AS n FROM auth_changes")[0]["n"]
+            return None
+        changed, self.last_seq = self._since(self.last_seq)
+        return changed
+
+
+class TokenAuth:
+    name = "token"
+    slow = False
+
+    def __init__(self, secret):
+        self.secret = secret
+
+    def check(self, worker, password):
+        expires_hex, _, sig = password.partition(".")
+        try:
+            expires = int(expires_hex, 16)
+        except ValueError:
+            return False
+        if expires and expires < time.time():
+            return False
+        return hmac.compare_digest(sig, _token_sig(self.secret, worker, expires))
+
+    def cursor(self):
+        return None
+
+    def changed_since(self, cursor):
+        return None  # tokens carry their own expiry; a new secret changes every cache key
+
+    def changes(self):
+        return None
+
+
+def make_backend(name, auth_map=None, config_path=None, db_path=None, token_secret=""):
+    if name == "sqlite":
+        return SqliteAuth(db_path)
+    if name == "token":
+        return TokenAuth(token_secret)
+    return StaticAuth(auth_map, config_path)
+
+
+# --- cache ---
+
+class Authorizer:
+    def __init__(self, backend, secret, ttl=300.0, negative_ttl=30.0, max_entries=100000, threads=4,
+                 max_pending=256, cache_path="", reload_interval=5.0, save_interval=60.0, clock=time.time):
+        self.backend = backend
+        self.secret = secret.encode("utf-8")
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.max_pending = max_pending
+        self.cache_path = cache_path
+        self.reload_interval = reload_interval
+        self.save_interval = save_interval
+        self.clock = clock
+        self.cache = OrderedDict()  # key -> (ok, expires, worker), least recently used first
+        self.inflight = {}          # key -> Task running the backend check
+        self.executor = ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="stratum-auth")
+        self.dirty = False
+        self.stats = {"hits": 0, "negative_hits": 0, "misses": 0, "shared": 0, "checks": 0, "accepted": 0,
+                      "rejected": 0, "busy": 0, "errors": 0, "invalidated": 0, "check_ms_max": 0.0,
+                      "entries": 0, "loaded": 0}
+
+    def key(self, worker, password):
+        return hmac.new(self.secret, f"{worker}\0{password}".encode("utf-8"), hashlib.sha256).digest()
+
+    def _lookup(self, key, now):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return entry[0]
+
+    def _store(self, key, ok, worker, now):
+        self.cache[key] = (ok, now + (self.ttl if ok else self.negative_ttl), worker)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        self.dirty = self.dirty or ok
+
+    def _check(self, worker, password):
+        started = time.perf_counter()
+        try:
+            return self.backend.check(worker, password)
+        finally:
+            ms = (time.perf_counter() - started) * 1000.0
+            if ms > self.stats["check_ms_max"]:
+                self.stats["check_ms_max"] = round(ms, 3)
+
+    async def _run(self, key, worker, password):
+        try:
+            ok = await asyncio.get_running_loop().run_in_executor(self.executor, self._check, worker, password)
+        except Exception as e:
+            # backend down or broken: reject this attempt without caching it
+            self.stats["errors"] += 1
+            print(f"stratum auth: {self.backend.name} check failed for {worker!r}: {e}")
+            return False
+        finally:
+            self.inflight.pop(key, None)
+        self._store(key, ok, worker, self.clock())
+        return ok
+
+    async def authorize(self, worker, password):
+        """(ok, error) for mining.authorize; error is None, FAILED or BUSY."""
+        if not worker or not password or not isinstance(worker, str) or not isinstance(password, str):
+            self.stats["rejected"] += 1
+            return False, FAILED
+        key = self.key(worker, password)
+        now = self.clock()
+        ok = self._lookup(key, now)
+        if ok is not None:
+            self.stats["hits" if ok else "negative_hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            task = self.inflight.get(key)
+            if task is not None:
+                self.stats["shared"] += 1
+            elif not self.backend.slow:
+                self.stats["checks"] += 1
+                ok = self.backend.check(worker, password)
+                self._store(key, ok, worker, now)
+            elif len(self.inflight) >= self.max_pending:
+                self.stats["busy"] += 1
+                return False, BUSY
+            else:
+                self.stats["checks"] += 1
+                task = self.inflight[key] = asyncio.ensure_future(self._run(key, worker, password))
+            if ok is None:
+                # shield: a connection closing mid-check must not cancel the check shared with others
+                ok = await asyncio.shield(task)
+        self.stats["accepted" if ok else "rejected"] += 1
+        return ok, (None if ok else FAILED)
+
+    def invalidate(self, workers):
+        """Drop cached results for the given workers (ALL: everything)."""
+        if workers == ALL:
+            n = len(self.cache)
+            self.cache.clear()
+        else:
+            stale = [k for k, entry in self.cache.items() if entry[2] in workers]
+            for k in stale:
+                del self.cache[k]
+            n = len(stale)
+        self.stats["invalidated"] += n
+        self.dirty = True
+
+    # --- persistence of accepted entries ---
+
+    def load(self):
+        """Merge saved accepts from cache_path (and the per-worker-process siblings)."""
+        if not self.cache_path:
+            return 0
+        root, ext = os.path.splitext(self.cache_path)
+        root = re.sub(r"\.w\d+$", "", root)  # a worker process's own file: load its siblings too
+        now, loaded = self.clock(), 0
+        for path in sorted(set(glob.glob(root + "*" + ext))):
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if data.get("backend") != self.backend.name:
+                continue
+            try:
+                # changes made while the file was not being updated (server down): drop them
+                changed = self.backend.changed_since(data.get("cursor"))
+            except Exception as e:
+                print(f"stratum auth: cannot check {path} against {self.backend.name}: {e}")
+                changed = ALL
+            if changed == ALL:
+                continue
+            for key_hex, worker, expires in data.get("entries", []):
+                if expires > now and not (changed and worker in changed):
+                    self.cache[bytes.fromhex(key_hex)] = (True, expires, worker)
+                    loaded += 1
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        self.stats["loaded"] += loaded
+        return loaded
+
+    def _entries(self):
+        now = self.clock()
+        return [[k.hex(), worker, expires] for k, (ok, expires, worker) in self.cache.items() if ok and expires > now]
+
+    def _write(self, entries, cursor):
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        tmp = self.cache_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"backend": self.backend.name, "cursor": cursor, "entries": entries}, f)
+        os.replace(tmp, self.cache_path)
+
+    def save(self):
+        if self.cache_path:
+            self._write(self._entries(), self.backend.cursor())
+            self.dirty = False
+
+    def snapshot(self):
+        stats = dict(self.stats)
+        stats["entries"] = len(self.cache)
+        stats["inflight"] = len(self.inflight)
+        return stats
+
+    async def _changes(self):
+        if not self.backend.slow:
+            return self.backend.changes()  # a stat() or nothing: not worth a thread hop
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.backend.changes)
+
+    async def prepare(self):
+        """Note the backend's current state and load the saved cache; call before accepting miners."""
+        # state first: load() drops what changed up to at least this point, later changes are
+        # reported by run()
+        try:
+            await self._changes()
+        except Exception as e:
+            print(f"stratum auth: {self.backend.name} backend not readable yet: {e}")
+        self.load()
+
+    async def run(self):
+        """Poll the backend for changes and save the cache; run as a task next to the server."""
+        loop = asyncio.get_running_loop()
+        last_save = time.monotonic()
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                changed = await self._changes()
+            except Exception as e:
+                print(f"stratum auth: reload from {self.backend.name} failed: {e}")
+                changed = None
+            if changed:
+                self.invalidate(changed)
+            if self.cache_path and self.dirty and time.monotonic() - last_save >= self.save_interval:
+                # snapshot on the loop (the cache is not thread safe), write the file off it
+                entries, cursor, self.dirty = self._entries(), self.backend.cursor(), False
+                try:
+                    await loop.run_in_executor(None, self._write, entries, cursor)
+                except OSError as e:
+                    print(f"stratum auth: cannot save {self.cache_path}: {e}")
+                last_save = time.monotonic()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+stratum_codec.py - Encoding and decoding of Stratum (newline-delimited JSON-RPC) messages.
+
+- loads() parses a received line straight from bytes (no decode/strip), dumps() returns bytes
+- the JSON library is orjson or msgspec when installed, the stdlib json module otherwise
+  (STRATUM_JSON=orjson|msgspec|json forces one; use() switches at runtime)
+- the frames sent for almost every request are spliced from pre-encoded byte templates, only the
+  request id (and difficulty / error text) is encoded per message:
+    ack(req_id)                 {"id":N,"result":true,"error":null}
+    reply(req_id, result)       {"id":N,"result":<bool>,"error":null}
+    error(req_id, message)      {"id":N,"result":false,"error":"<message>"} (encoded once per message)
+    set_difficulty(difficulty)  {"id":null,"method":"mining.set_difficulty","params":[d]}
+    notify(job_id, params, clean_jobs)  mining.notify for a job, built once per job
+Every frame ends with a newline and is compact JSON (no spaces) whichever library is used.
+"""
+
+import json
+import os
+
+BACKENDS = ("orjson", "msgspec", "json")
+
+
+def _stdlib():
+    return "json", json.loads, lambda obj: json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def load_backend(name=None):
+    """(name, loads, dumps) for the named library, or the fastest installed one."""
+    for candidate in ([name] if name else BACKENDS):
+        if candidate == "orjson":
+            try:
+                import orjson
+                return "orjson", orjson.loads, orjson.dumps
+            except ImportError:
+                pass
+        elif candidate == "msgspec":
+            try:
+                import msgspec
+                return "msgspec", msgspec.json.decode, msgspec.json.encode
+            except ImportError:
+                pass
+        elif candidate == "json":
+            return _stdlib()
+    # requested library not installed
+    return _stdlib()
+
+
+BACKEND, loads, dumps = load_backend((os.getenv("STRATUM_JSON") or "").lower() or None)
+
+# one entry per distinct error text, built on first use
+_ERRORS = {}
+
+
+def use(name=None):
+    """Switch the JSON library (benchmarks, tests). Returns the name actually in use."""
+    global BACKEND, loads, dumps
+    BACKEND, loads, dumps = load_backend(name)
+    _ERRORS.clear()
+    return BACKEND
+
+
+def frame(obj):
+    """Any message as a newline-terminated frame."""
+    return dumps(obj) + b"\n"
+
+
+def encode_id(req_id):
+    # ints (what miners send) and null skip the JSON library
+    if req_id is None:
+        return b"null"
+    if type(req_id) is int:
+        return b"%d" % req_id
+    return dumps(req_id)
+
+
+_ACK_PREFIX = b'{"id":'
+_ACK_TRUE = b',"result":true,"error":null}\n'
+_ACK_FALSE = b',"result":false,"error":null}\n'
+
+
+def ack(req_id):
+    return _ACK_PREFIX + encode_id(req_id) + _ACK_TRUE
+
+
+def reply(req_id, result):
+    return _ACK_PREFIX + encode_id(req_id) + (_ACK_TRUE if result else _ACK_FALSE)
+
+
+def error(req_id, message, result=False):
+    key = (message, result)
+    suffix = _ERRORS.get(key)
+    if suffix is None:
+        suffix = _ERRORS[key] = (b',"result":' + dumps(result) + b',"error":' + dumps(message) + b"}\n")
+    return _ACK_PREFIX + encode_id(req_id) + suffix
+
+
+_DIFF_PREFIX = b'{"id":null,"method":"mining.set_difficulty","params":['
+_DIFF_SUFFIX = b"]}\n"
+
+
+def set_difficulty(difficulty):
+    if type(difficulty) is float and difficulty == difficulty and abs(difficulty) != float("inf"):
+        # repr() of a finite float is valid JSON
+        return _DIFF_PREFIX + repr(difficulty).encode("ascii") + _DIFF_SUFFIX
+    return _DIFF_PREFIX + dumps(difficulty) + _DIFF_SUFFIX
+
+
+def notify(job_id, params, clean_jobs):
+    """mining.notify frame; encode it once per job and send the same bytes to every connection."""
+    return (b'{"id":null,"method":"mining.notify","params":[' + dumps(job_id) + b"," + dumps(params)
+            + (b",true]}\n" if clean_jobs else b",false]}\n"))
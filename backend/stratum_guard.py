@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+stratum_guard.py - Per-connection and per-IP flood protection for the Stratum servers.
+
+Checks, cheapest first, so a misbehaving client costs as little event loop time as possible:
+- admit(): banned IPs and IPs over max_conns_per_ip are refused at accept time
+- check_line(): before a line is parsed, its length is capped (max_line), the IP ban list is
+  consulted and one token is taken from the connection's bucket and from its IP's bucket; lines
+  over either rate are dropped unparsed and counted as throttled (not struck: a fast rig before
+  its first vardiff retarget, or many rigs behind one NAT address, are not misbehaving); lines
+  that cannot be a JSON object (first byte not "{") are dropped as invalid
+- strike(): invalid JSON, unknown methods, malformed / unauthorized / duplicate / low-difficulty
+  submits spend the connection's error budget (error_rate per second, up to error_burst); when
+  it runs out the IP is banned for ban_seconds and the connection closed
+- expired(): connections that did not authorize within handshake_timeout or sent nothing for
+  idle_timeout seconds are closed (the servers sweep their connections every second)
+Addresses in exempt networks (loopback by default: local proxies and benchmarks) skip the per-IP
+limits and are never banned; the per-connection limits still apply. Rates of 0 disable a bucket.
+Every decision is counted in StratumGuard.stats.
+"""
+
+import os
+import threading
+import time
+from ipaddress import ip_address, ip_network
+
+DEFAULTS = {
+    "max_line": 8192,            # bytes per message
+    "conn_rate": 20.0,           # messages per second per connection
+    "conn_burst": 100.0,
+    "ip_rate": 500.0,            # messages per second summed over an IP's connections
+    "ip_burst": 2000.0,
+    "max_conns_per_ip": 1000,    # 0 = unlimited
+    "error_rate": 0.2,           # strikes forgiven per second
+    "error_burst": 20.0,
+    "ban_seconds": 600.0,
+    "handshake_timeout": 30.0,   # seconds until mining.authorize
+    "idle_timeout": 600.0,       # seconds without a message
+    "exempt": "127.0.0.0/8,::1/128",
+}
+ENV = {key: "STRATUM_" + key.upper() for key in DEFAULTS}
+ENV["exempt"] = "STRATUM_GUARD_EXEMPT"
+
+
+def load_guard_config(section=None):
+    """Guard settings: env STRATUM_<KEY> over the given config section (e.g. config.json) over DEFAULTS."""
+    section = section or {}
+    cfg = {}
+    for key, default in DEFAULTS.items():
+        value = os.getenv(ENV[key], section.get(key, default))
+        cfg[key] = value if isinstance(default, str) else type(default)(value)
+    return cfg
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now, cost=1.0):
+        """Spend cost tokens if available. A bucket with rate 0 never runs out."""
+        if self.rate <= 0:
+            return True
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if tokens < cost:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - cost
+        return True
+
+    def full(self, now):
+        return self.rate <= 0 or self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class ConnectionState:
+    __slots__ = ("ip", "exempt", "bucket", "errors", "opened", "last_active", "authorized", "closing")
+
+    def __init__(self, ip, exempt, cfg, now):
+        self.ip = ip
+        self.exempt = exempt
+        self.bucket = TokenBucket(cfg["conn_rate"], cfg["conn_burst"], now)
+        self.errors = TokenBucket(cfg["error_rate"], cfg["error_burst"], now)
+        self.opened = now
+        self.last_active = now
+        self.authorized = False
+        self.closing = None  # reason, once the connection must be dropped
+
+
+# check_line() verdicts
+OK, DROP, CLOSE = "ok", "drop", "close"
+
+
+class StratumGuard:
+    def __init__(self, **cfg):
+        self.cfg = dict(DEFAULTS, **cfg)
+        self.max_line = int(self.cfg["max_line"])
+        self.exempt_nets = [ip_network(n.strip(), strict=False) for n in str(self.cfg["exempt"]).split(",") if n.strip()]
+        self.ip_buckets = {}   # ip -> TokenBucket
+        self.ip_conns = {}     # ip -> open connections
+        self.bans = {}         # ip -> ban expiry (time.monotonic)
+        self.lock = threading.Lock()  # the threaded server calls in from every connection thread
+        self.stats = {"accepted": 0, "refused_banned": 0, "refused_conn_limit": 0, "throttled": 0,
+                      "oversized": 0, "invalid": 0, "strikes": 0, "bans": 0, "closed_banned": 0,
+                      "handshake_timeouts": 0, "idle_timeouts": 0, "active_bans": 0}
+        self._exempt_cache = {}
+
+    def is_exempt(self, ip):
+        exempt = self._exempt_cache.get(ip)
+        if exempt is None:
+            try:
+                addr = ip_address(ip)
+                exempt = any(addr in net for net in self.exempt_nets)
+            except ValueError:
+                exempt = False
+            if len(self._exempt_cache) > 100000:
+                self._exempt_cache.clear()
+            self._exempt_cache[ip] = exempt
+        return exempt
+
+    def _banned(self, ip, now):
+        expiry = self.bans.get(ip)
+        if expiry is None:
+            return False
+        if expiry > now:
+            return True
+        self.bans.pop(ip, None)
+        return False
+
+    # --- connection lifecycle ---
+
+    def admit(self, ip, now=None):
+        """ConnectionState for a new connection from ip, or None when it must be refused."""
+        now = time.monotonic() if now is None else now
+        exempt = self.is_exempt(ip)
+        with self.lock:
+            if not exempt:
+                if self._banned(ip, now):
+                    self.stats["refused_banned"] += 1
+                    return None
+                limit = self.cfg["max_conns_per_ip"]
+                if limit and self.ip_conns.get(ip, 0) >= limit:
+                    self.stats["refused_conn_limit"] += 1
+                    return None
+            self.ip_conns[ip] = self.ip_conns.get(ip, 0) + 1
+            self.stats["accepted"] += 1
+        return ConnectionState(ip, exempt, self.cfg, now)
+
+    def release(self, state):
+        with self.lock:
+            n = self.ip_conns.get(state.ip, 0) - 1
+            if n > 0:
+                self.ip_conns[state.ip] = n
+            else:
+                self.ip_conns.pop(state.ip, None)
+
+    # --- per message ---
+
+    def check_line(self, state, line, now=None):
+        """OK to parse the line, DROP it unparsed, or CLOSE the connection (see state.closing)."""
+        now = time.monotonic() if now is None else now
+        state.last_active = now
+        if len(line) > self.max_line:
+            return self.oversized(state, now)
+        if not state.exempt:
+            # the IP tables are shared by every connection thread of the threaded server
+            with self.lock:
+                if self.bans and self._banned(state.ip, now):
+                    self.stats["closed_banned"] += 1
+                    state.closing = "banned"
+                    return CLOSE
+                bucket = self.ip_buckets.get(state.ip)
+                if bucket is None:
+                    bucket = self.ip_buckets[state.ip] = TokenBucket(self.cfg["ip_rate"], self.cfg["ip_burst"], now)
+                allowed = bucket.take(now)
+            if not allowed:
+                self.stats["throttled"] += 1
+                return DROP
+        if not state.bucket.take(now):
+            self.stats["throttled"] += 1
+            return DROP
+        first = line.lstrip()[:1]
+        if first != b"{":
+            if not first:
+                return DROP  # blank keepalive line
+            self.stats["invalid"] += 1
+            return CLOSE if self.strike(state, "invalid json", now) else DROP
+        return OK
+
+    def oversized(self, state, now=None):
+        """A line over max_line (also raised by the asyncio StreamReader limit): close and ban."""
+        self.stats["oversized"] += 1
+        self.strike(state, "line too long", now, fatal=True)
+        return CLOSE
+
+    def strike(self, state, reason, now=None, fatal=False):
+        """Spend the connection's error budget; True (and state.closing set) when it must be closed."""
+        now = time.monotonic() if now is None else now
+        self.stats["strikes"] += 1
+        if not fatal and state.errors.take(now):
+            return False
+        state.closing = reason
+        if not state.exempt:
+            with self.lock:
+                if not self._banned(state.ip, now):
+                    self.bans[state.ip] = now + self.cfg["ban_seconds"]
+                    self.stats["bans"] += 1
+                    print(f"stratum guard: banned {state.ip} for {self.cfg['ban_seconds']:g}s ({reason})")
+        return True
+
+    # --- housekeeping ---
+
+    def timeout_for(self, state, now=None):
+        """Seconds until expired() closes the connection if nothing arrives (threaded server socket timeout), None if never."""
+        now = time.monotonic() if now is None else now
+        deadlines = []
+        if not state.authorized and self.cfg["handshake_timeout"]:
+            deadlines.append(state.opened + self.cfg["handshake_timeout"])
+        if self.cfg["idle_timeout"]:
+            deadlines.append(state.last_active + self.cfg["idle_timeout"])
+        return max(0.01, min(deadlines) - now) if deadlines else None
+
+    def expired(self, state, now=None):
+        """Reason to close a connection that stayed silent or never authorized, else None."""
+        now = time.monotonic() if now is None else now
+        if not state.authorized:
+            limit = self.cfg["handshake_timeout"]
+            if limit and now - state.opened > limit:
+                self.stats["handshake_timeouts"] += 1
+                return "handshake timeout"
+        limit = self.cfg["idle_timeout"]
+        if limit and now - state.last_active > limit:
+            self.stats["idle_timeouts"] += 1
+            return "idle timeout"
+        return None
+
+    def prune(self, now=None):
+        """Drop expired bans and full buckets of IPs without connections."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            for ip in [ip for ip, expiry in self.bans.items() if expiry <= now]:
+                del self.bans[ip]
+            for ip in [ip for ip, b in self.ip_buckets.items() if ip not in self.ip_conns and b.full(now)]:
+                del self.ip_buckets[ip]
+            self.stats["active_bans"] = len(self.bans)
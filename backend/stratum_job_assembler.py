@@ -4,6 +4,7 @@ stratum_job_assembler.py - Build full Stratum-style job templates (simplified) f
 This module contains helper functions to:
  - build a coinbase transaction with extranonce
  - compute merkle root from txids
+ - compute the Stratum merkle branch for the coinbase (MerkleEngine, cached between templates)
  - assemble a simplified block header (little-endian fields handling)
 Note: This is a careful approximation for educational/demo use; for production ensure full consensus-valid assembly.
 """
@@ -31,6 +32,83 @@ def merkle_root(txid_list):
     # return hex little-endian
     return binascii.hexlify(nodes[0][::-1]).decode()
 
+def merkle_root_from_branch(coinbase_hash, branch):
+    """
+    Fold a Stratum merkle branch into the coinbase hash (both internal byte order) and return
+    the merkle root as bytes (internal byte order). This is what a miner does for every extranonce2.
+    """
+    root = coinbase_hash
+    for step in branch:
+        root = sha256d(root + step)
+    return root
+
+class MerkleEngine:
+    """
+    Computes the Stratum merkle branch for a coinbase at index 0, which is what miners need:
+    root = fold(sha256d(coinbase), branch). Interior nodes of the last template are cached, so a
+    template that shares a prefix with the previous one (e.g. bitcoind only appended transactions)
+    only rehashes the right edge of the tree.
+
+    Level k is stored as [None, n1, n2, ...] where index 0 stands for the (unknown) coinbase path;
+    branch[k] is level[k][1] and level[k+1][j] = sha256d(level[k][2j] + level[k][2j+1]).
+    """
+
+    def __init__(self):
+        self.txids = ()
+        self.levels = []
+        self.branch_bytes = []
+        self.stats = {"calls": 0, "hashes": 0, "reused": 0}
+
+    def branch(self, txid_list):
+        """Return the merkle branch (list of 32-byte nodes, internal byte order) for txid_list."""
+        self.stats["calls"] += 1
+        txids = tuple(txid_list)
+        if txids == self.txids:
+            return self.branch_bytes
+        # length of the unchanged prefix, in level-0 indices (index 0 is the coinbase slot)
+        common = 0
+        old = self.txids
+        limit = min(len(old), len(txids))
+        while common < limit and old[common] == txids[common]:
+            common += 1
+        first_changed = common + 1
+        old_levels = self.levels
+
+        # hex little-endian txids -> internal byte order, converted in one pass
+        raw = bytes.fromhex("".join(txids[common:]))
+        fresh = [raw[i:i + 32][::-1] for i in range(0, len(raw), 32)]
+        level = (old_levels[0][:first_changed] if old_levels else [None]) + fresh
+
+        sha256 = hashlib.sha256
+        levels = [level]
+        branch = []
+        k = 0
+        while len(level) > 1:
+            branch.append(level[1])
+            if len(level) % 2 == 1:
+                level = level + [level[-1]]
+            # parents whose two children are both unchanged are copied from the cached level above
+            keep = first_changed // 2
+            prev = old_levels[k + 1] if k + 1 < len(old_levels) else None
+            parents = prev[:keep] if prev is not None and keep > 1 else [None]
+            first_changed = len(parents)
+            self.stats["reused"] += first_changed - 1
+            start = 2 * first_changed
+            parents += [sha256(sha256(level[i] + level[i + 1]).digest()).digest() for i in range(start, len(level), 2)]
+            self.stats["hashes"] += len(parents) - first_changed
+            level = parents
+            levels.append(level)
+            k += 1
+
+        self.txids = txids
+        self.levels = levels
+        self.branch_bytes = branch
+        return branch
+
+    def branch_hex(self, txid_list):
+        """Merkle branch as hex strings (internal byte order), as sent in mining.notify."""
+        return [binascii.hexlify(h).decode() for h in self.branch(txid_list)]
+
 def build_coinbase(coinbase_script_hex, extranonce1_hex, extranonce2_hex, height):
     """
     Build a simple coinbase transaction hex. This is a minimal coinbase with:
@@ -57,11 +135,23 @@ def build_coinbase(coinbase_script_hex, extranonce1_hex, extranonce2_hex, height
     raw = version + in_count + prev + script_len + script + sequence + out_count + value + out_script_len + locktime
     return binascii.hexlify(raw).decode()
 
-def assemble_block_header(previousblockhash_hex, merkle_root_hex, ntime=None, nbits=None, nonce=0):
+def split_coinbase(coinbase_script_hex, height, extranonce1_size=4, extranonce2_size=4):
+    """
+    Split the coinbase built by build_coinbase() around the extranonce bytes, Stratum style:
+    coinbase = coinb1 + extranonce1 + extranonce2 + coinb2. Sizes are in bytes.
+    """
+    placeholder1 = "00" * extranonce1_size
+    placeholder2 = "00" * extranonce2_size
+    cb = build_coinbase(coinbase_script_hex, placeholder1, placeholder2, height)
+    # the extranonces follow version, input count, prevout, script length and the height push
+    offset = (4 + 1 + 36 + 1 + 1 + len(str(height))) * 2
+    return cb[:offset], cb[offset + len(placeholder1) + len(placeholder2):]
+
+def assemble_block_header(previousblockhash_hex, merkle_root_hex, ntime=None, nbits=None, nonce=0, version=None):
     # previousblockhash_hex is big-endian hex or as returned by bitcoind; convert to little-endian bytes
     prev = binascii.unhexlify(previousblockhash_hex)[::-1]
     merkle = binascii.unhexlify(merkle_root_hex)[::-1]
-    version = struct.pack("<I", 536870912)  # example: version with segwit/modern flags
+    version = struct.pack("<I", int(version if version is not None else 536870912))  # default: version with segwit/modern flags
     ntime = struct.pack("<I", int(ntime if ntime is not None else time.time()))
     nbits = struct.pack("<I", int(nbits if nbits is not None else 0x1d00ffff))
     nonce = struct.pack("<I", int(nonce))
@@ -74,3 +164,6 @@ if __name__ == "__main__":
     # simple test
     txids = ['00'*32]
     print("merkle:", merkle_root(txids))
+    cb = txid_from_raw(build_coinbase('', '00000000', '00', 1))
+    root = merkle_root_from_branch(binascii.unhexlify(cb)[::-1], MerkleEngine().branch(txids))
+    print("merkle via branch:", binascii.hexlify(root[::-1]).decode(), "==", merkle_root([cb] + txids))
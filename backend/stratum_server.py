@@ -4,160 +4,522 @@ stratum_server.py - Minimal educational Stratum-like server (JSON over TCP)
 - Accepts TCP connections from miners
 - Performs a simplified handshake ("mining.subscribe" / "mining.authorize")
 - Issues simple work jobs (simulated) and accepts "mining.submit" as share submissions
-- On valid share, it records shares via the /api/report_share HTTP endpoint (HMAC signing required).
+- Validates each submit against its job and the connection's difficulty (share_validator.py);
+  difficulty is adjusted per connection by a vardiff controller
+- Valid shares are acknowledged immediately and credited, weighted by difficulty, through a
+  share_aggregator.ShareAggregator running on its own reporter thread (batched, HMAC-signed
+  /api/report_shares requests with retries and a disk spill)
+- Two connection modes (STRATUM_MODE or --mode):
+  threaded: one thread per miner, blocking sockets (the original design)
+  selector: one thread for every connection, non-blocking sockets on a selectors loop (epoll on
+            Linux); each connection has an output queue, written when the socket is writable, and
+            is dropped when it holds more than STRATUM_CLIENT_BUFFER_HWM bytes
+  Both read newline-delimited JSON through LineBuffer (bytearray + read cursor, so a burst of
+  lines is split in linear time).
+- Flood protection (stratum_guard.py, STRATUM_* env): per-connection and per-IP message rates
+  checked before a line is parsed, a line length cap, handshake and idle timeouts (socket
+  timeouts in threaded mode, a sweep every few seconds in selector mode) and temporary IP bans
+  for clients that keep sending garbage. Counters are logged every STRATUM_STATS_LOG_INTERVAL s.
 Notes:
 - This is NOT a production Stratum implementation.
 - For real mining pools use battle-tested pool software (node-stratum-pool, poolsoftware), or run as a relay/proxy.
 """
 
-import socket, threading, json, uuid, time, hmac, hashlib, requests, os
-from datetime import datetime
+import socket, selectors, threading, uuid, time, os, itertools, argparse
+from collections import deque
+from stratum_job_assembler import split_coinbase
+from share_validator import validate_share, parse_submit, VardiffController
+from share_aggregator import ShareAggregator
+import stratum_codec as codec
+from stratum_guard import StratumGuard, load_guard_config, CLOSE, DROP
 
 HOST = "0.0.0.0"
 PORT = int(os.getenv("STRATUM_PORT") or 3333)
 REPORT_URL = os.getenv("REPORT_URL") or "http://127.0.0.1:5000/api/report_share"
 REPORT_SECRET = os.getenv("REPORT_SHARED_SECRET") or "change_this_report_secret"
 PAYOUT_PER_SHARE = float(os.getenv("MINING_PAYOUT_RATE_PER_SHARE") or 1e-10)
+EXTRANONCE2_SIZE = 4
+INITIAL_DIFFICULTY = float(os.getenv("STRATUM_INITIAL_DIFFICULTY") or 1.0)
+MIN_DIFFICULTY = float(os.getenv("STRATUM_MIN_DIFFICULTY") or 0.001)
+MAX_DIFFICULTY = float(os.getenv("STRATUM_MAX_DIFFICULTY") or 2 ** 32)
+VARDIFF_TARGET = float(os.getenv("STRATUM_VARDIFF_TARGET") or 10.0)
+VARDIFF_RETARGET = float(os.getenv("STRATUM_VARDIFF_RETARGET") or 60.0)
+MODE = os.getenv("STRATUM_MODE") or "threaded"
+GUARD = StratumGuard(**load_guard_config())
+MAX_LINE = GUARD.max_line
+SWEEP_INTERVAL = 2.0
+STATS_LOG_INTERVAL = float(os.getenv("STRATUM_STATS_LOG_INTERVAL") or 60.0)
+CLIENT_BUFFER_HWM = int(os.getenv("STRATUM_CLIENT_BUFFER_HWM") or 256 * 1024)
 
-# Simple per-connection worker state
-class WorkerHandler(threading.Thread):
-    def __init__(self, conn, addr):
-        super().__init__(daemon=True)
-        self.conn = conn
+# batch endpoint next to REPORT_URL unless configured explicitly (set REPORT_BATCH_URL="" to disable)
+_default_batch = REPORT_URL + "s" if REPORT_URL.endswith("/api/report_share") else ""
+REPORTER = ShareAggregator(
+    REPORT_URL,
+    REPORT_SECRET,
+    batch_url=os.getenv("REPORT_BATCH_URL", _default_batch),
+    flush_interval=float(os.getenv("REPORT_FLUSH_INTERVAL") or 2.0),
+    flush_count=int(os.getenv("REPORT_FLUSH_COUNT") or 500),
+    max_pending=int(os.getenv("REPORT_MAX_PENDING") or 10000),
+    spill_path=os.getenv("REPORT_SPILL_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "share_spill_stratum_server.jsonl"),
+    max_retries=int(os.getenv("REPORT_MAX_RETRIES") or 5),
+    max_batch=int(os.getenv("REPORT_MAX_BATCH") or 5000),
+)
+
+EXTRANONCE1 = itertools.count(int.from_bytes(os.urandom(4), "big"))
+
+def make_demo_job():
+    # Simulated work: random prev-hash, no transactions (empty merkle branch), demo coinbase
+    height = 1
+    coinb1, coinb2 = split_coinbase('', height, 4, EXTRANONCE2_SIZE)
+    return {
+        "job_id": str(uuid.uuid4()),
+        "previousblockhash": os.urandom(32).hex(),
+        "height": height,
+        "bits": "1d00ffff",
+        "version": 536870912,
+        "curtime": int(time.time()),
+        "merkle_branch": [],
+        "coinb1": coinb1,
+        "coinb2": coinb2,
+    }
+
+class LineTooLong(ValueError):
+    pass
+
+class LineBuffer:
+    """
+    Newline-delimited frames read from a bytearray with a cursor: each received byte is scanned
+    once and the consumed prefix is dropped once per feed(), instead of copying the rest of the
+    buffer for every line.
+    """
+    def __init__(self, max_line=MAX_LINE):
+        self.buf = bytearray()
+        self.pos = 0    # start of the next line
+        self.scan = 0   # bytes before this offset hold no newline
+        self.max_line = max_line
+
+    def feed(self, data):
+        self.buf += data
+
+    def lines(self):
+        buf = self.buf
+        while True:
+            end = buf.find(b"\n", max(self.pos, self.scan))
+            if end < 0:
+                break
+            line = bytes(buf[self.pos:end])
+            self.pos = self.scan = end + 1
+            yield line
+        if self.pos:
+            del buf[:self.pos]
+            self.pos = 0
+        self.scan = len(buf)
+        if len(buf) > self.max_line:
+            raise LineTooLong("line too long")
+
+# Protocol state of one miner connection; the transport (thread or selector loop) provides write()
+class StratumSession:
+    def __init__(self, addr, guard):
         self.addr = addr
-        self.buffer = b""
+        self.guard = guard  # stratum_guard.ConnectionState
+        self.lines = LineBuffer()
         self.worker_name = None
         self.miner_id = None
         self.subscribed = False
         self.authorized = False
-        self.running = True
+        self.extranonce1 = "%08x" % (next(EXTRANONCE1) & 0xffffffff)
+        self.jobs = {}  # job_id -> job, most recent last
+        self.vardiff = VardiffController(INITIAL_DIFFICULTY, MIN_DIFFICULTY, MAX_DIFFICULTY, VARDIFF_TARGET, VARDIFF_RETARGET)
+
+    def write(self, data):
+        raise NotImplementedError
 
     def send_json(self, obj):
-        data = (json.dumps(obj) + "\n").encode("utf-8")
-        try:
-            self.conn.sendall(data)
-        except Exception as e:
-            print("send error", e)
-            self.running = False
+        self.write(codec.frame(obj))
 
     def handle_subscribe(self, req_id, params):
-        # respond with a subscription and job_id
-        job_id = str(uuid.uuid4())
+        # respond with subscriptions, extranonce1 and extranonce2 size
+        sub_id = str(uuid.uuid4())
         self.subscribed = True
-        resp = {"id": req_id, "result": [job_id, "mining.set_difficulty"], "error": None}
+        resp = {"id": req_id, "result": [[["mining.set_difficulty", sub_id], ["mining.notify", sub_id]], self.extranonce1, EXTRANONCE2_SIZE], "error": None}
         self.send_json(resp)
+        self.write(codec.set_difficulty(self.vardiff.difficulty))
         # issue initial job
-        self.issue_job(job_id)
+        self.issue_job()
 
     def handle_authorize(self, req_id, params):
         # params: [user, password]
-        if len(params) >= 1:
+        if not isinstance(params, list) or not all(isinstance(p, str) for p in params[:2]):
+            GUARD.strike(self.guard, "invalid credentials")
+            self.write(codec.error(req_id, "invalid credentials"))
+        elif len(params) >= 1:
             self.worker_name = params[0]
             # For simplicity, use worker_name as miner_id
             self.miner_id = self.worker_name
-            self.authorized = True
-            resp = {"id": req_id, "result": True, "error": None}
-            self.send_json(resp)
+            self.authorized = self.guard.authorized = True
+            self.write(codec.ack(req_id))
         else:
-            resp = {"id": req_id, "result": False, "error": "missing credentials"}
-            self.send_json(resp)
+            GUARD.strike(self.guard, "missing credentials")
+            self.write(codec.error(req_id, "missing credentials"))
 
-    def issue_job(self, job_id):
+    def issue_job(self, clean_jobs=True):
         # In a real pool, job contains block header parts, merkle branches, target, etc.
-        # Here we create a simulated 'job' containing a random nonce target difficulty
-        job = {
-            "method": "mining.notify",
-            "params": [job_id, {"job_id": job_id, "target": "0000ffff", "data": str(uuid.uuid4())}]
-        }
-        self.send_json(job)
+        # Here we create a simulated job with the same fields stratum_async sends
+        if clean_jobs or not self.jobs:
+            job = make_demo_job()
+            job["seen"] = set()  # (extranonce2, ntime, nonce) already credited
+            self.jobs = {}
+        else:
+            # same work under a new job id (a new difficulty applies to the jobs sent after it);
+            # shares the seen set, so a share cannot be credited again under the new id
+            job = dict(list(self.jobs.values())[-1], job_id=str(uuid.uuid4()))
+        job["difficulty"] = self.vardiff.difficulty
+        self.jobs[job["job_id"]] = job
+        for old in list(self.jobs)[:-16]:
+            del self.jobs[old]
+        self.write(codec.notify(job["job_id"], {
+            "job_id": job["job_id"], "target": "0000ffff", "height": job["height"],
+            "prevhash": job["previousblockhash"], "merkle_branch": job["merkle_branch"],
+            "coinb1": job["coinb1"], "coinb2": job["coinb2"], "version": job["version"],
+            "nbits": job["bits"], "ntime": job["curtime"]}, clean_jobs))
 
     def process_submit(self, req_id, params):
-        # params: [worker_name, job_id, nonce, extra]
-        # Validate basic structure and record share via HTTP report
+        # params: [worker_name, job_id, extranonce2, ntime, nonce]
+        # Validate the share against its job and record it via HTTP report
         if not self.authorized or not self.miner_id:
-            resp = {"id": req_id, "result": False, "error": "unauthorized"}
-            self.send_json(resp)
+            GUARD.strike(self.guard, "unauthorized submit")
+            self.write(codec.error(req_id, "unauthorized"))
             return
 
-        try:
-            worker_name = params[0]
-            job_id = params[1]
-            nonce = params[2] if len(params) > 2 else ""
-            shares = 1  # each submit counts as 1 share in this simple demo
-        except Exception as e:
-            resp = {"id": req_id, "result": False, "error": "invalid submit"}
-            self.send_json(resp)
+        submit = parse_submit(params)
+        if submit is None:
+            GUARD.strike(self.guard, "invalid submit")
+            self.write(codec.error(req_id, "invalid submit"))
             return
+        worker_name, job_id, extranonce2, ntime, nonce = submit
 
-        # Build report payload
-        payload = {"miner_id": self.miner_id, "worker_name": worker_name, "shares": shares}
-        body = json.dumps(payload).encode('utf-8')
-        sig = hmac.new(REPORT_SECRET.encode('utf-8'), body, hashlib.sha256).hexdigest()
-        headers = {'Content-Type': 'application/json', 'X-REPORT-SIG': sig}
+        job = self.jobs.get(job_id)
+        if job is None:
+            self.write(codec.error(req_id, "stale job"))
+            return
+        key = (extranonce2, ntime, nonce)
+        if key in job["seen"]:
+            GUARD.strike(self.guard, "duplicate share")
+            self.write(codec.error(req_id, "duplicate share"))
+            return
+        # validated at the difficulty the job was sent with, not a later vardiff retarget
+        difficulty = job["difficulty"]
+        ok, err, _ = validate_share(job, self.extranonce1, extranonce2, ntime, nonce, difficulty, EXTRANONCE2_SIZE)
+        if not ok:
+            GUARD.strike(self.guard, err)
+            self.write(codec.error(req_id, err))
+            return
+        job["seen"].add(key)
 
+        # Shares are weighted by the difficulty they were found at; the reporter thread delivers them
+        REPORTER.add(self.miner_id, worker_name, difficulty)
+        self.write(codec.ack(req_id))
+        new_diff = self.vardiff.record_share()
+        if new_diff is not None:
+            self.write(codec.set_difficulty(new_diff))
+            self.issue_job(clean_jobs=False)
+
+    def handle_data(self, data):
+        """
+        Feed received bytes; Stratum uses newline-delimited JSON-RPC. Returns False once the
+        connection must be closed (the reason is in self.guard.closing).
+        """
+        guard = self.guard
+        self.lines.feed(data)
         try:
-            r = requests.post(REPORT_URL, headers=headers, data=body, timeout=5)
-            if r.status_code == 200:
-                resp = {"id": req_id, "result": True, "error": None}
-            else:
-                resp = {"id": req_id, "result": False, "error": f"report_error:{r.status_code}"}
-        except Exception as e:
-            resp = {"id": req_id, "result": False, "error": "report_failed"}
+            for line in self.lines.lines():
+                # rate limits and cheap checks before any parsing
+                verdict = GUARD.check_line(guard, line)
+                if verdict is DROP:
+                    continue
+                if verdict is CLOSE:
+                    return False
+                try:
+                    obj = codec.loads(line)
+                except Exception:
+                    if GUARD.strike(guard, "invalid json"):
+                        return False
+                    continue
+                if type(obj) is not dict:
+                    if GUARD.strike(guard, "invalid request"):
+                        return False
+                    continue
+                self.dispatch(obj)
+                if guard.closing is not None:
+                    return False
+        except LineTooLong:
+            GUARD.oversized(guard)
+            return False
+        return True
 
-        self.send_json(resp)
+    def dispatch(self, obj):
+        """Handle one JSON-RPC request (fields: id, method, params)."""
+        req_id = obj.get("id")
+        method = obj.get("method")
+        params = obj.get("params", [])
+        if method == "mining.subscribe":
+            self.handle_subscribe(req_id, params)
+        elif method == "mining.authorize":
+            self.handle_authorize(req_id, params)
+        elif method == "mining.submit":
+            self.process_submit(req_id, params)
+        else:
+            # unknown method - reply with error
+            GUARD.strike(self.guard, "unknown method")
+            self.write(codec.error(req_id, "unknown method", result=None))
+
+# --- threaded mode: one thread per connection ---
+class WorkerHandler(StratumSession, threading.Thread):
+    def __init__(self, conn, addr, guard):
+        threading.Thread.__init__(self, daemon=True)
+        StratumSession.__init__(self, addr, guard)
+        self.conn = conn
+        self.running = True
+
+    def write(self, data):
+        try:
+            self.conn.sendall(data)
+        except Exception as e:
+            print("send error", e)
+            self.running = False
 
     def run(self):
         try:
             while self.running:
-                data = self.conn.recv(4096)
+                # handshake / idle timeout as a socket timeout, recomputed before every read
+                self.conn.settimeout(GUARD.timeout_for(self.guard))
+                try:
+                    data = self.conn.recv(4096)
+                except socket.timeout:
+                    reason = GUARD.expired(self.guard)
+                    if reason:
+                        print("closing", self.addr, reason)
+                        break
+                    continue
                 if not data:
                     break
-                self.buffer += data
-                # Stratum uses newline-delimited JSON-RPC
-                while b"\n" in self.buffer:
-                    line, self.buffer = self.buffer.split(b"\n", 1)
-                    if not line.strip():
-                        continue
-                    try:
-                        obj = json.loads(line.decode("utf-8"))
-                    except Exception as e:
-                        print("invalid json", e)
-                        continue
-                    # handle JSON-RPC with fields: id, method, params
-                    req_id = obj.get("id")
-                    method = obj.get("method")
-                    params = obj.get("params", [])
-                    if method == "mining.subscribe":
-                        self.handle_subscribe(req_id, params)
-                    elif method == "mining.authorize":
-                        self.handle_authorize(req_id, params)
-                    elif method == "mining.submit":
-                        self.process_submit(req_id, params)
-                    else:
-                        # unknown method - reply with error
-                        resp = {"id": req_id, "result": None, "error": "unknown method"}
-                        self.send_json(resp)
+                if not self.handle_data(data):
+                    print("closing", self.addr, self.guard.closing)
+                    break
+        except (OSError, ValueError) as e:
+            print("connection error", self.addr, e)
         finally:
+            GUARD.release(self.guard)
             try:
                 self.conn.close()
             except:
                 pass
             print("connection closed", self.addr)
 
-def serve():
-    print("Starting minimal Stratum server on port", PORT)
+def listen_socket():
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     s.bind((HOST, PORT))
-    s.listen(100)
+    s.listen(socket.SOMAXCONN)
+    return s
+
+def serve_threaded():
+    print("Starting minimal Stratum server on port", PORT, "(threaded)")
+    s = listen_socket()
+    next_prune = time.monotonic() + 60
     try:
         while True:
             conn, addr = s.accept()
+            if time.monotonic() >= next_prune:
+                GUARD.prune()
+                next_prune = time.monotonic() + 60
+            guard = GUARD.admit(addr[0])
+            if guard is None:
+                # banned or too many connections from this address
+                conn.close()
+                continue
             print("connection from", addr)
-            handler = WorkerHandler(conn, addr)
+            handler = WorkerHandler(conn, addr, guard)
             handler.start()
     finally:
         s.close()
 
+# --- selector mode: every connection on one thread ---
+class SelectorConnection(StratumSession):
+    def __init__(self, server, sock, addr, guard):
+        super().__init__(addr, guard)
+        self.server = server
+        self.sock = sock
+        self.out = deque()   # pending output, oldest first
+        self.out_bytes = 0
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            return
+        if not self.out:
+            # nothing queued: try to send right away, queue only what the socket did not take
+            try:
+                sent = self.sock.send(data)
+            except BlockingIOError:
+                sent = 0
+            except OSError as e:
+                self.server.close(self, f"send error {e}")
+                return
+            if sent == len(data):
+                return
+            data = data[sent:]
+        self.out.append(data)
+        self.out_bytes += len(data)
+        if self.out_bytes > CLIENT_BUFFER_HWM:
+            self.server.close(self, "output buffer over high-water mark")
+            return
+        self.server.want_write(self, True)
+
+    def on_writable(self):
+        while self.out:
+            data = self.out[0]
+            try:
+                sent = self.sock.send(data)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                self.server.close(self, f"send error {e}")
+                return
+            self.out_bytes -= sent
+            if sent < len(data):
+                self.out[0] = data[sent:]
+                return
+            self.out.popleft()
+        self.server.want_write(self, False)
+
+    def on_readable(self):
+        try:
+            data = self.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.server.close(self, f"recv error {e}")
+            return
+        if not data:
+            self.server.close(self)
+            return
+        try:
+            if not self.handle_data(data):
+                self.server.close(self, self.guard.closing)
+        except ValueError as e:
+            self.server.close(self, str(e))
+        except Exception as e:
+            # a bug triggered by one miner's input must not stop the loop serving all the others
+            self.server.close(self, f"internal error {e!r}")
+
+class SelectorServer:
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.listener = listen_socket()
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, None)
+        self.clients = set()
+        self.writing = set()
+
+    def accept(self):
+        # drain the accept queue: a connection burst is handled in one wakeup
+        while True:
+            try:
+                sock, addr = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print("accept error", e)  # e.g. out of file descriptors
+                return
+            guard = GUARD.admit(addr[0])
+            if guard is None:
+                # banned or too many connections from this address
+                sock.close()
+                continue
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = SelectorConnection(self, sock, addr, guard)
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+            self.clients.add(conn)
+
+    def want_write(self, conn, enabled):
+        if conn.closed or enabled == (conn in self.writing):
+            return
+        if enabled:
+            self.writing.add(conn)
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE
+        else:
+            self.writing.discard(conn)
+            events = selectors.EVENT_READ
+        self.selector.modify(conn.sock, events, conn)
+
+    def close(self, conn, reason=None):
+        if conn.closed:
+            return
+        conn.closed = True
+        self.writing.discard(conn)
+        self.clients.discard(conn)
+        GUARD.release(conn.guard)
+        if reason:
+            print("closing", conn.addr, reason)
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+
+    def sweep(self, now):
+        """Close connections past the handshake / idle timeout; prune the guard's tables."""
+        for conn in list(self.clients):
+            reason = GUARD.expired(conn.guard, now)
+            if reason:
+                self.close(conn, reason)
+        GUARD.prune(now)
+
+    def serve_forever(self):
+        print("Starting minimal Stratum server on port", PORT, f"(selector: {type(self.selector).__name__})")
+        next_sweep = time.monotonic() + SWEEP_INTERVAL
+        while True:
+            now = time.monotonic()
+            if now >= next_sweep:
+                self.sweep(now)
+                next_sweep = now + SWEEP_INTERVAL
+            for key, events in self.selector.select(timeout=1.0):
+                conn = key.data
+                if conn is None:
+                    self.accept()
+                    continue
+                if events & selectors.EVENT_WRITE:
+                    conn.on_writable()
+                if events & selectors.EVENT_READ and not conn.closed:
+                    conn.on_readable()
+
+def log_stats():
+    """Print the guard counters every STATS_LOG_INTERVAL seconds while they change."""
+    last = None
+    while True:
+        time.sleep(STATS_LOG_INTERVAL)
+        stats = dict(GUARD.stats)
+        if stats != last:
+            print("stratum guard:", " ".join(f"{k}={v}" for k, v in stats.items()))
+            last = stats
+
+def serve(mode=None):
+    REPORTER.start()
+    if STATS_LOG_INTERVAL > 0:
+        threading.Thread(target=log_stats, name="stratum-stats", daemon=True).start()
+    if (mode or MODE) == "selector":
+        SelectorServer().serve_forever()
+    else:
+        serve_threaded()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=("threaded", "selector"), default=MODE,
+                        help='Connection handling (default STRATUM_MODE or threaded)')
+    args = parser.parse_args()
+    serve(args.mode)
+
 if __name__ == "__main__":
-    serve()
+    main()
@@ -0,0 +1,10 @@
+"""
+wsgi.py - WSGI entry point for production servers.
+  gunicorn -c gunicorn.conf.py wsgi:app
+Any WSGI server works the same way (e.g. waitress-serve wsgi:app); each worker process imports
+this module, which migrates the schema and starts that process's background threads.
+"""
+
+from server import create_app
+
+app = create_app()
@@ -168,9 +168,11 @@ document.addEventListener('DOMContentLoaded', function() {
       submitBtn.disabled = true;
       submitBtn.innerHTML = '<span class="spinner"></span> Processing...';
       
+      // same key on a resubmit, so a retried request cannot create a second withdrawal
+      const idemKey = form.dataset.idempotencyKey || (form.dataset.idempotencyKey = (crypto.randomUUID ? crypto.randomUUID() : String(Date.now()) + Math.random()));
       const resp = await fetch('/api/withdraw', {
         method:'POST', 
-        headers:{'Content-Type':'application/json'}, 
+        headers:{'Content-Type':'application/json', 'Idempotency-Key': idemKey}, 
         body: JSON.stringify({currency:'BTC', amount: amount, to_address: to})
       });
       
@@ -179,9 +181,10 @@ document.addEventListener('DOMContentLoaded', function() {
       if (j.ok) {
         const message = j.txid 
           ? `Withdrawal successful! Transaction ID: ${j.txid.substring(0, 16)}...`
-          : `Withdrawal requested. ID: ${j.id.substring(0, 8)}... (Pending admin processing)`;
+          : `Withdrawal requested. ID: ${j.id.substring(0, 8)}... (Status: ${j.status || 'pending'})`;
         showAlert(message, 'success');
         form.reset();
+        delete form.dataset.idempotencyKey;
       } else {
         showAlert('Error: ' + (j.error || 'Failed to process withdrawal'), 'error');
       }
@@ -1,12 +1,45 @@
+// CACHE_NAME and PRECACHE_URLS are filled in by tools/build_static.py with the content-hashed
+// assets of the build; served unbuilt, the list is empty and requests just go to the network.
+const CACHE_NAME = 'mining-static-dev';
+const PRECACHE_URLS = [];
+const PRECACHED = new Set(PRECACHE_URLS);
+
 self.addEventListener('install', function(event) {
-  event.waitUntil(self.skipWaiting());
+  event.waitUntil(caches.open(CACHE_NAME).then(function(cache) {
+    return cache.addAll(PRECACHE_URLS);
+  }).then(function() {
+    return self.skipWaiting();
+  }));
 });
+
 self.addEventListener('activate', function(event) {
-  event.waitUntil(self.clients.claim());
+  // drop the caches of previous builds
+  event.waitUntil(caches.keys().then(function(names) {
+    return Promise.all(names.filter(function(name) {
+      return name.indexOf('mining-static-') === 0 && name !== CACHE_NAME;
+    }).map(function(name) {
+      return caches.delete(name);
+    }));
+  }).then(function() {
+    return self.clients.claim();
+  }));
 });
+
 self.addEventListener('fetch', function(event) {
-  // Basic network-first strategy
-  event.respondWith(fetch(event.request).catch(function() {
-    return caches.match(event.request);
-  }));
+  const request = event.request;
+  if (request.method !== 'GET') return;
+  const url = new URL(request.url);
+  if (url.origin !== self.location.origin) return;
+  if (PRECACHED.has(url.pathname)) {
+    // hashed assets never change under the same URL: serve from the cache
+    event.respondWith(caches.match(request).then(function(hit) {
+      return hit || fetch(request);
+    }));
+  } else if (request.mode === 'navigate') {
+    // pages stay fresh; the precached entry point is the offline fallback
+    event.respondWith(fetch(request).catch(function() {
+      return caches.match('/index.html');
+    }));
+  }
+  // everything else (API calls, SSE) goes straight to the network
 });
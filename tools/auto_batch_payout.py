@@ -23,16 +23,20 @@ if not args.admin_key:
 
 hdrs = {'X-API-KEY': args.admin_key, 'Content-Type': 'application/json'}
 
-# fetch miners
-resp = requests.get(args.server + '/api/admin/miners', headers=hdrs, timeout=20)
+# fetch only miners at or above the threshold, streamed as NDJSON (one miner per line)
+resp = requests.get(args.server + '/api/admin/miners', headers=hdrs, timeout=20, stream=True,
+                    params={'min_balance': args.threshold, 'format': 'ndjson', 'limit': 0})
 if resp.status_code != 200:
     print("Failed to fetch miners:", resp.status_code, resp.text); exit(1)
-data = resp.json()
-miners = data.get('miners', [])
 
 payments = []
 count = 0
-for m in miners:
+for line in resp.iter_lines():
+    if not line:
+        continue
+    m = json.loads(line)
+    if 'next_cursor' in m:
+        break  # trailer line
     try:
         bal = float(m.get('balance', 0) or 0)
     except:
@@ -47,6 +51,9 @@ for m in miners:
         amt = math.floor(bal * 1e8) / 1e8  # truncate to sat precision approx
         payments.append({'to_address': addr, 'amount': amt})
         count += 1
+    if count >= args.max:
+        break
+resp.close()
 
 if not payments:
     print("No payments to process")
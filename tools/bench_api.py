@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+bench_api.py - load benchmark for the Flask backend (backend/server.py).
+Starts the app in this process (threaded HTTP/1.1 server) against a temporary SQLite database seeded
+with --miners miners, --credits credits and --withdrawals withdrawals, then runs each scenario for
+--duration seconds from client processes holding --concurrency keep-alive connections in total:
+  status             GET /api/status for one of the simulated accounts
+  report_share       POST /api/report_share with a valid HMAC signature
+  withdraw           POST /api/withdraw (accounts are seeded with balance; payout workers run)
+  admin_withdrawals  GET /api/admin/withdrawals   (also admin_miners, admin_credits)
+  mixed              weighted mix of all of the above
+Per scenario it reports req/s, status codes, a latency histogram with percentiles, SQLite lock waits
+(DB_TRACK_LOCKS accounting in db.py) and pool waits, and server RSS. Results go to --out as JSON.
+Regression mode: --baseline <previous.json> --threshold 10 exits with status 1 when a scenario's
+req/s dropped or its p99 latency grew by more than 10%, or when it returned errors the baseline did not.
+Usage:
+  python tools/bench_api.py --concurrency 16 --duration 10
+  python tools/bench_api.py --scenarios status,report_share --baseline bench_api.json --threshold 10
+"""
+import argparse, hashlib, hmac, http.client, json, multiprocessing, os, random, socket, sys, tempfile
+import threading, time, uuid
+
+PROJ = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+BACKEND = os.path.join(PROJ, "backend")
+SECRET = "bench_report_secret"
+API_KEY = "bench_api_key"
+SCENARIOS = ["status", "report_share", "withdraw", "admin_withdrawals", "admin_miners", "admin_credits", "mixed"]
+MIX = [("status", 55), ("report_share", 25), ("withdraw", 5), ("admin_withdrawals", 5), ("admin_miners", 5),
+       ("admin_credits", 5)]
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]
+
+
+# --- client side (runs in each client process) ---
+
+def make_request(kind, rng, opts):
+    """Returns (method, path, body, headers)."""
+    account = f"bench{rng.randrange(opts['accounts'])}"
+    if kind == "status":
+        return "GET", f"/api/status?account={account}", None, {}
+    if kind == "report_share":
+        body = json.dumps({"miner_id": f"miner{rng.randrange(opts['miners'])}", "worker_name": "w1",
+                           "shares": 1}).encode("utf-8")
+        sig = hmac.new(SECRET.encode("utf-8"), body, hashlib.sha256).hexdigest()
+        return "POST", "/api/report_share", body, {"Content-Type": "application/json", "X-REPORT-SIG": sig}
+    if kind == "withdraw":
+        body = json.dumps({"amount": 0.000001, "to_address": "tb1qbench", "account": account}).encode("utf-8")
+        return "POST", "/api/withdraw", body, {"Content-Type": "application/json",
+                                               "Idempotency-Key": uuid.uuid4().hex}
+    table = kind.split("_", 1)[1]
+    return "GET", f"/api/admin/{table}?limit=50", None, {"X-API-KEY": API_KEY}
+
+
+def client_thread(port, scenario, opts, start, stop, seed, out):
+    rng = random.Random(seed)
+    kinds, weights = zip(*MIX)
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    latencies, codes = [], {}
+    start.wait()
+    while not stop.is_set():
+        kind = rng.choices(kinds, weights)[0] if scenario == "mixed" else scenario
+        method, path, body, headers = make_request(kind, rng, opts)
+        t0 = time.perf_counter()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            code = str(resp.status)
+        except (OSError, http.client.HTTPException) as e:
+            code = type(e).__name__
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        latencies.append(time.perf_counter() - t0)
+        codes[code] = codes.get(code, 0) + 1
+    conn.close()
+    out.append((latencies, codes))
+
+
+def client_process(port, scenario, threads, opts, ready, go, duration, seed, results):
+    start, stop, out = threading.Event(), threading.Event(), []
+    workers = [threading.Thread(target=client_thread, args=(port, scenario, opts, start, stop, seed * 1000 + i, out))
+               for i in range(threads)]
+    for w in workers:
+        w.start()
+    ready.put(1)
+    go.wait()
+    start.set()
+    time.sleep(duration)
+    stop.set()
+    for w in workers:
+        w.join()
+    latencies = [x for lat, _ in out for x in lat]
+    codes = {}
+    for _, c in out:
+        for k, v in c.items():
+            codes[k] = codes.get(k, 0) + v
+    results.put((latencies, codes))
+
+
+# --- server side (this process) ---
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def seed(db, args):
+    """Seed miners, credits, withdrawals and funded simulated accounts in one transaction."""
+    now = int(time.time())
+    conn = db.connect(os.environ["MINING_DB_PATH"])
+    conn.executemany("INSERT INTO miners (id,owner,worker_name,balance,shares,created_at) VALUES (?,?,?,?,?,?)",
+                     [(f"miner{i}", "", "w1", 0.001, 100, now - i) for i in range(args.miners)])
+    conn.executemany("INSERT INTO credits (id,miner_id,shares,amount,created_at) VALUES (?,?,?,?,?)",
+                     [(str(uuid.uuid4()), f"miner{i % max(1, args.miners)}", 1, 1e-8, now - i)
+                      for i in range(args.credits)])
+    statuses = ("completed", "completed", "completed", "pending", "error")
+    conn.executemany("INSERT INTO withdrawals (id,currency,amount,to_address,txid,status,created_at) VALUES (?,?,?,?,?,?,?)",
+                     [(str(uuid.uuid4()), "BTC", 0.0001, "tb1qseed", "", statuses[i % len(statuses)], now - i)
+                      for i in range(args.withdrawals)])
+    conn.executemany("INSERT INTO sim_accounts (id, base_balance, since, hashrate, running) VALUES (?,?,?,?,?)",
+                     [(f"bench{i}", 1000.0, time.time(), 800.0, 1) for i in range(args.accounts)])
+    conn.commit()
+    conn.close()
+
+
+def histogram(latencies):
+    counts = [0] * (len(BUCKETS_MS) + 1)
+    for x in latencies:
+        ms = x * 1000.0
+        for i, edge in enumerate(BUCKETS_MS):
+            if ms <= edge:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+    labels = [f"<={b}ms" for b in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}ms"]
+    return dict(zip(labels, counts))
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))] * 1000.0, 3)
+    return {"p50": pct(50), "p90": pct(90), "p99": pct(99), "max": round(ordered[-1] * 1000.0, 3)}
+
+
+def run_scenario(scenario, port, args, opts, db):
+    ctx = multiprocessing.get_context("spawn")
+    ready, go, results = ctx.Queue(), ctx.Event(), ctx.Queue()
+    per_proc = [args.concurrency // args.processes + (1 if i < args.concurrency % args.processes else 0)
+                for i in range(args.processes)]
+    procs = [ctx.Process(target=client_process, args=(port, scenario, n, opts, ready, go, args.duration, i + 1, results),
+                         daemon=True) for i, n in enumerate(per_proc) if n]
+    for p in procs:
+        p.start()
+    for _ in procs:
+        ready.get(timeout=60)
+    db.reset_lock_stats()
+    rss_before = rss_mb()
+    peak = [rss_before or 0.0]
+    sampling = threading.Event()
+
+    def sample():
+        while not sampling.wait(0.25):
+            peak[0] = max(peak[0], rss_mb() or 0.0)
+    threading.Thread(target=sample, daemon=True).start()
+    started = time.perf_counter()
+    go.set()
+    collected = [results.get(timeout=args.duration + 120) for _ in procs]
+    elapsed = time.perf_counter() - started
+    sampling.set()
+    for p in procs:
+        p.join(10)
+    latencies = [x for lat, _ in collected for x in lat]
+    codes = {}
+    for _, c in collected:
+        for k, v in c.items():
+            codes[k] = codes.get(k, 0) + v
+    errors = sum(v for k, v in codes.items() if not k.startswith("2"))
+    lock_stats = dict(db.LOCK_STATS)
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / min(elapsed, args.duration), 1),
+        "errors": errors,
+        "status_codes": codes,
+        "latency_ms": percentiles(latencies),
+        "histogram": histogram(latencies),
+        "sqlite": {k: round(v, 4) if isinstance(v, float) else v for k, v in lock_stats.items()},
+        "rss_mb": {"before": round(rss_before, 1) if rss_before else None, "peak": round(peak[0], 1),
+                   "after": round(rss_mb() or 0.0, 1)},
+    }
+
+
+def print_result(name, r):
+    lat = r["latency_ms"]
+    print(f"\n{name}: {r['rps']} req/s, {r['requests']} requests, {r['errors']} errors {r['status_codes']}")
+    if lat:
+        print(f"  latency ms: p50 {lat['p50']}  p90 {lat['p90']}  p99 {lat['p99']}  max {lat['max']}")
+    total = max(1, r["requests"])
+    for label, n in r["histogram"].items():
+        if n:
+            print(f"  {label:>9} {n:>8} {'#' * max(1, int(50 * n / total))}")
+    s = r["sqlite"]
+    print(f"  sqlite: {s['lock_waits']} lock waits ({s['lock_wait_seconds']}s), {s['lock_timeouts']} timeouts, "
+          f"{s['pool_waits']} pool waits ({s['pool_wait_seconds']}s)")
+    print(f"  rss MB: {r['rss_mb']}")
+
+
+def check_regressions(baseline, results, threshold):
+    failures = []
+    for name, r in results["scenarios"].items():
+        b = baseline.get("scenarios", {}).get(name)
+        if not b:
+            continue
+        if b["rps"] and r["rps"] < b["rps"] * (1 - threshold / 100.0):
+            failures.append(f"{name}: req/s {b['rps']} -> {r['rps']}")
+        bp99, p99 = b.get("latency_ms", {}).get("p99"), r.get("latency_ms", {}).get("p99")
+        if bp99 and p99 and p99 > bp99 * (1 + threshold / 100.0):
+            failures.append(f"{name}: p99 {bp99}ms -> {p99}ms")
+        if r["errors"] and not b["errors"]:
+            failures.append(f"{name}: {r['errors']} errors (baseline had none)")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', default=",".join(SCENARIOS), help='Comma separated: ' + ",".join(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=16, help='Concurrent keep-alive connections')
+    parser.add_argument('--processes', type=int, default=2, help='Client processes sharing the connections')
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds per scenario')
+    parser.add_argument('--miners', type=int, default=1000, help='Seeded miners')
+    parser.add_argument('--credits', type=int, default=50000, help='Seeded credits')
+    parser.add_argument('--withdrawals', type=int, default=5000, help='Seeded withdrawals')
+    parser.add_argument('--accounts', type=int, default=100, help='Funded simulated accounts')
+    parser.add_argument('--out', default='bench_api.json', help='JSON results file')
+    parser.add_argument('--baseline', default=None, help='Previous results file for regression checks')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Allowed regression in percent')
+    args = parser.parse_args()
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {unknown}")
+    args.processes = max(1, min(args.processes, args.concurrency))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    tmp = tempfile.mkdtemp(prefix="bench_api_")
+    os.environ.update({"MINING_DB_PATH": os.path.join(tmp, "bench.db"), "USE_RATE_LIMIT": "false",
+                       "REPORT_SHARED_SECRET": SECRET, "MINING_SERVER_API_KEY": API_KEY, "DB_TRACK_LOCKS": "1"})
+    sys.path.insert(0, BACKEND)
+    import logging
+    import db
+    import server
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    logging.getLogger("mining_backend").setLevel(logging.WARNING)
+
+    app = server.create_app()
+    seed(db, args)
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"  # keep-alive
+    port = free_port()
+    httpd = make_server("127.0.0.1", port, app, threaded=True, request_handler=WSGIRequestHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"Seeded {args.miners} miners, {args.credits} credits, {args.withdrawals} withdrawals; "
+          f"{args.concurrency} connections from {args.processes} process(es), {args.duration}s per scenario, "
+          f"{os.cpu_count()} CPU(s)")
+
+    opts = {"miners": args.miners, "accounts": args.accounts}
+    results = {"meta": {k: getattr(args, k) for k in ("concurrency", "processes", "duration", "miners", "credits",
+                                                      "withdrawals", "accounts")},
+               "scenarios": {}}
+    results["meta"].update({"cpu_count": os.cpu_count(), "timestamp": int(time.time())})
+    try:
+        for name in scenarios:
+            results["scenarios"][name] = r = run_scenario(name, port, args, opts, db)
+            print_result(name, r)
+    finally:
+        httpd.shutdown()
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nresults written to {args.out}")
+
+    if baseline is not None:
+        failures = check_regressions(baseline, results, args.threshold)
+        if failures:
+            print(f"\nREGRESSION (threshold {args.threshold}%) against {args.baseline}:")
+            for line in failures:
+                print("  " + line)
+            sys.exit(1)
+        print(f"\nno regressions beyond {args.threshold}% against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
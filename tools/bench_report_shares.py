@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+bench_report_shares.py - compare share crediting throughput of /api/report_share (one miner per
+request, one commit each) against /api/report_shares (one signed batch, one commit).
+Runs the Flask app in-process with its test client against a temporary SQLite database.
+Usage:
+  python tools/bench_report_shares.py --reports 2000 --miners 200 --batch 500
+"""
+import argparse, hashlib, hmac, json, os, sys, tempfile, time
+
+PROJ = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+BACKEND = os.path.join(PROJ, "backend")
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--reports', type=int, default=2000, help='Number of share reports to credit per mode')
+parser.add_argument('--miners', type=int, default=200, help='Distinct miner ids')
+parser.add_argument('--batch', type=int, default=500, help='Entries per /api/report_shares request')
+args = parser.parse_args()
+
+SECRET = "bench_report_secret"
+os.environ["REPORT_SHARED_SECRET"] = SECRET
+os.environ["USE_RATE_LIMIT"] = "false"
+sys.path.insert(0, BACKEND)
+import server  # noqa: E402
+
+
+def signed(payload):
+    body = json.dumps(payload).encode("utf-8")
+    sig = hmac.new(SECRET.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return body, {"Content-Type": "application/json", "X-REPORT-SIG": sig}
+
+
+def fresh_db():
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    server.DB_PATH = path
+    server.init_db()
+    return path
+
+
+def entries():
+    return [{"miner_id": f"miner{i % args.miners}", "worker_name": "w1", "shares": 1} for i in range(args.reports)]
+
+
+def bench_single(client):
+    start = time.perf_counter()
+    for e in entries():
+        body, headers = signed(e)
+        r = client.post("/api/report_share", data=body, headers=headers)
+        assert r.status_code == 200, r.data
+    return time.perf_counter() - start
+
+
+def bench_batch(client):
+    items = entries()
+    start = time.perf_counter()
+    for i in range(0, len(items), args.batch):
+        body, headers = signed({"reports": items[i:i + args.batch]})
+        r = client.post("/api/report_shares", data=body, headers=headers)
+        assert r.status_code == 200, r.data
+    return time.perf_counter() - start
+
+
+def check(path):
+    import sqlite3
+    db = sqlite3.connect(path)
+    shares = db.execute("SELECT SUM(shares) FROM miners").fetchone()[0]
+    credits = db.execute("SELECT COUNT(*) FROM credits").fetchone()[0]
+    db.close()
+    return shares, credits
+
+
+def main():
+    client = server.app.test_client()
+    results = {}
+    for name, fn in (("single", bench_single), ("batch", bench_batch)):
+        path = fresh_db()
+        elapsed = fn(client)
+        shares, credits = check(path)
+        os.remove(path)
+        results[name] = {"seconds": round(elapsed, 4), "reports_per_sec": round(args.reports / elapsed, 1),
+                         "shares_credited": shares, "credit_rows": credits}
+        print(f"{name:>6}: {args.reports} reports in {elapsed:.3f}s -> {args.reports / elapsed:,.0f} reports/s")
+    print(f"speedup: {results['single']['seconds'] / results['batch']['seconds']:.1f}x")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
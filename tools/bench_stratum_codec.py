@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+bench_stratum_codec.py - messages per second on one core for the Stratum hot path, before and after
+backend/stratum_codec.py. "before" is the previous code path: json.loads(line.decode().strip()) and
+(json.dumps(dict) + "\\n").encode(); "after" is stratum_codec with every JSON library installed
+(orjson, msgspec) and the stdlib fallback. Cases:
+  parse_submit    decode a mining.submit line
+  submit_ack      build the {"id":N,"result":true,"error":null} reply
+  submit_error    build a rejected-share reply
+  set_difficulty  build a mining.set_difficulty frame
+  notify          encode a mining.notify frame (once per job)
+  submit_cycle    parse a submit + build its ack (one accepted share)
+Usage:
+  python tools/bench_stratum_codec.py [--seconds 1.0]
+"""
+import argparse, json, os, sys, time
+
+PROJ = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(PROJ, "backend"))
+import stratum_codec  # noqa: E402
+
+SUBMIT = b'{"id": 4711, "method": "mining.submit", "params": ["miner1.rig7", "5f0e2c7a-3b1d-4c55-9a0e-8d1f6b2a9c33", "0000002a", "6613f2b1", "1a2b3c4d"]}\n'
+NOTIFY_PARAMS = {
+    "target": "00000000ffff0000000000000000000000000000000000000000000000000000", "height": 840000,
+    "prevhash": "00" * 32, "merkle_branch": ["ab" * 32] * 12, "coinb1": "01000000010000" + "00" * 40,
+    "coinb2": "ffffffff0100000000000000000000000000", "version": 536870912, "nbits": "17034219", "ntime": 1713571767,
+}
+
+
+def before_cases():
+    def dumps_line(obj):
+        return (json.dumps(obj) + "\n").encode("utf-8")
+    return {
+        "parse_submit": lambda: json.loads(SUBMIT.decode("utf-8").strip()),
+        "submit_ack": lambda: dumps_line({"id": 4711, "result": True, "error": None}),
+        "submit_error": lambda: dumps_line({"id": 4711, "result": False, "error": "duplicate share"}),
+        "set_difficulty": lambda: dumps_line({"id": None, "method": "mining.set_difficulty", "params": [0.5]}),
+        "notify": lambda: dumps_line({"id": None, "method": "mining.notify", "params": ["job1", NOTIFY_PARAMS, True]}),
+        "submit_cycle": lambda: dumps_line({"id": json.loads(SUBMIT.decode("utf-8").strip())["id"], "result": True,
+                                            "error": None}),
+    }
+
+
+def after_cases():
+    c = stratum_codec
+    return {
+        "parse_submit": lambda: c.loads(SUBMIT),
+        "submit_ack": lambda: c.ack(4711),
+        "submit_error": lambda: c.error(4711, "duplicate share"),
+        "set_difficulty": lambda: c.set_difficulty(0.5),
+        "notify": lambda: c.notify("job1", NOTIFY_PARAMS, True),
+        "submit_cycle": lambda: c.ack(c.loads(SUBMIT)["id"]),
+    }
+
+
+def rate(fn, seconds):
+    """Calls per second, timed in batches to keep the loop overhead small."""
+    batch, calls, start = 1000, 0, time.perf_counter()
+    while True:
+        for _ in range(batch):
+            fn()
+        calls += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return calls / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=1.0, help='Time per case and variant')
+    args = parser.parse_args()
+
+    variants = [("before (stdlib dicts)", before_cases())]
+    table = {variants[0][0]: {case: rate(fn, args.seconds) for case, fn in variants[0][1].items()}}
+    for name in stratum_codec.BACKENDS:
+        # the codec cases call whichever library is in use, so time each one right after use()
+        if stratum_codec.use(name) == name:
+            label = f"codec/{name}"
+            variants.append((label, after_cases()))
+            table[label] = {case: rate(fn, args.seconds) for case, fn in variants[-1][1].items()}
+    stratum_codec.use()
+
+    cases = list(variants[0][1])
+    print(f"messages per second, one core ({args.seconds:g}s per case)")
+    print(f"{'':24}" + "".join(f"{c:>16}" for c in cases))
+    base = table[variants[0][0]]
+    for label, _ in variants:
+        print(f"{label:24}" + "".join(f"{table[label][c]:>16,.0f}" for c in cases))
+        if label != variants[0][0]:
+            print(f"{'  speedup':24}" + "".join(f"{table[label][c] / base[c]:>15.1f}x" for c in cases))
+
+
+if __name__ == "__main__":
+    main()
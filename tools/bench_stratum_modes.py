@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+bench_stratum_modes.py - backend/stratum_server.py threaded mode (one thread per miner) against
+selector mode (one thread, epoll) by connection count. Runs tools/stratum_loadgen.py once per
+(mode, connection count) with the same submit rate and prints connections/s, handshake p99,
+submit round trip p99, server threads, RSS after connecting and RSS per connection.
+Usage:
+  python tools/bench_stratum_modes.py --connections 1000,5000,10000 --processes 2
+"""
+import argparse, json, os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import stratum_loadgen  # noqa: E402
+
+COLUMNS = [
+    ("mode", "meta.server"), ("connections", "meta.connections"), ("established", "connect.established"),
+    ("connect_per_s", "connect.per_second"), ("handshake_p99_ms", "connect.handshake_ms.p99"),
+    ("submit_p99_ms", "submit.rtt_ms.p99"), ("threads", "server.threads_connected"),
+    ("rss_mb", "server.rss_mb_connected"), ("kb_per_conn", "server.rss_kb_per_connection"),
+]
+
+
+def lookup(results, path):
+    value = results
+    for part in path.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', default='threaded,selector', help='Comma-separated stratum_server.py modes')
+    parser.add_argument('--connections', default='1000,5000', help='Comma-separated connection counts')
+    parser.add_argument('--processes', type=int, default=2, help='Client processes')
+    parser.add_argument('--submit-rate', type=float, default=1000.0, help='Total mining.submit per second')
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds of the submit phase')
+    parser.add_argument('--difficulty', type=float, default=1e-10, help='Share difficulty')
+    parser.add_argument('--connect-concurrency', type=int, default=256, help='Connection attempts in flight per process')
+    parser.add_argument('--source-ips', type=int, default=1, help='Spread connections over 127.0.0.1..N')
+    parser.add_argument('--out', default=None, help='Write all results as JSON to this file')
+    args = parser.parse_args()
+
+    runs = []
+    for count in [int(n) for n in args.connections.split(",") if n.strip()]:
+        for mode in [m.strip() for m in args.modes.split(",") if m.strip()]:
+            run_args = argparse.Namespace(
+                server=mode, server_processes=1, port=0, connections=count,
+                processes=max(1, min(args.processes, count)), submit_rate=args.submit_rate,
+                duration=args.duration, blocks=0, difficulty=args.difficulty,
+                connect_concurrency=args.connect_concurrency, source_ips=args.source_ips)
+            print(f"\n=== {mode}, {count} connections ===")
+            results = stratum_loadgen.run(run_args)
+            if results is None:
+                print("run failed")
+                sys.exit(1)
+            runs.append(results)
+
+    print(f"\n{os.cpu_count()} CPU core(s), submit rate {args.submit_rate:g}/s")
+    print("  ".join(f"{name:>16}" for name, _ in COLUMNS))
+    for results in runs:
+        print("  ".join(f"{'-' if lookup(results, path) is None else lookup(results, path):>16}" for _, path in COLUMNS))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(runs, f, indent=2)
+        print(f"results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+bench_stratum_scaling.py - connection capacity of backend/stratum_async.py by number of worker
+processes (STRATUM_PROCESSES, SO_REUSEPORT). Runs tools/stratum_loadgen.py once per process count
+with the same load and prints one line per run: connections/s, handshake p99, submit round trip
+p99, notify fan-out p50 and server RSS (all processes). Capacity only grows with spare cores: on a
+machine with fewer cores than server + client processes the runs compete for the same CPU.
+Usage:
+  python tools/bench_stratum_scaling.py --server-processes 1,2,4 --connections 20000 --processes 4
+"""
+import argparse, json, os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import stratum_loadgen  # noqa: E402
+
+
+def headline(results):
+    get = lambda *path: stratum_loadgen.flatten(results).get(".".join(path))
+    return {
+        "server_processes": results["meta"]["server_processes"],
+        "established": get("connect", "established"),
+        "connect_per_s": get("connect", "per_second"),
+        "handshake_p99_ms": get("connect", "handshake_ms", "p99"),
+        "submit_per_s": get("submit", "per_second"),
+        "submit_p99_ms": get("submit", "rtt_ms", "p99"),
+        "notify_p50_ms": get("notify", "latency_ms", "p50"),
+        "rss_mb_peak": get("server", "rss_mb_peak"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server-processes', default='1,2,4', help='Comma-separated worker process counts')
+    parser.add_argument('--connections', type=int, default=5000, help='Concurrent Stratum connections per run')
+    parser.add_argument('--processes', type=int, default=2, help='Client processes')
+    parser.add_argument('--submit-rate', type=float, default=1000.0, help='Total mining.submit per second')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds of the submit phase')
+    parser.add_argument('--blocks', type=int, default=3, help='New chain tips pushed during the submit phase')
+    parser.add_argument('--difficulty', type=float, default=1e-10, help='Share difficulty')
+    parser.add_argument('--connect-concurrency', type=int, default=256, help='Connection attempts in flight per process')
+    parser.add_argument('--source-ips', type=int, default=1, help='Spread connections over 127.0.0.1..N')
+    parser.add_argument('--out', default=None, help='Write all results as JSON to this file')
+    args = parser.parse_args()
+    counts = [int(n) for n in args.server_processes.split(",") if n.strip()]
+
+    rows, runs = [], []
+    for n in counts:
+        run_args = argparse.Namespace(server="async", server_processes=n, port=0, **{
+            k: getattr(args, k) for k in ("connections", "processes", "submit_rate", "duration", "blocks",
+                                          "difficulty", "connect_concurrency", "source_ips")})
+        run_args.processes = max(1, min(run_args.processes, run_args.connections))
+        print(f"\n=== {n} server process(es) ===")
+        results = stratum_loadgen.run(run_args)
+        if results is None:
+            print("run failed")
+            sys.exit(1)
+        runs.append(results)
+        rows.append(headline(results))
+
+    print(f"\n{os.cpu_count()} CPU core(s), {args.connections} connections, {args.processes} client process(es)")
+    cols = list(rows[0])
+    print("  ".join(f"{c:>16}" for c in cols))
+    for row in rows:
+        print("  ".join(f"{'-' if row[c] is None else row[c]:>16}" for c in cols))
+    base = rows[0]["connect_per_s"] or 0
+    for row in rows[1:]:
+        if base:
+            print(f"connect/s with {row['server_processes']} processes: x{row['connect_per_s'] / base:.2f} "
+                  f"of {rows[0]['server_processes']}")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"summary": rows, "runs": runs}, f, indent=2)
+        print(f"results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+bench_workers.py - measure API throughput as the number of gunicorn worker processes grows.
+For each worker count it starts gunicorn (backend/gunicorn.conf.py, wsgi:app) on a throwaway
+database, drives it with several client processes on keep-alive connections and reports req/s
+and latency percentiles. Rate limiting is switched off for the run.
+Usage:
+  python tools/bench_workers.py --workers 1,2,4 --clients 8 --duration 5 --path /api/status
+Throughput can only scale up to the number of CPU cores, which is printed first.
+"""
+import argparse, http.client, multiprocessing, os, shutil, socket, subprocess, sys, tempfile, time
+
+PROJ = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+BACKEND = os.path.join(PROJ, "backend")
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def wait_ready(port, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/api/status")
+            if conn.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def client(port, path, duration, out):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    latencies, errors = [], 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        try:
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status != 200:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+            continue
+        latencies.append(time.perf_counter() - start)
+    out.put((latencies, errors))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def run(workers, args):
+    tmp = tempfile.mkdtemp(prefix="bench_workers_")
+    port = free_port()
+    env = dict(os.environ, MINING_DB_PATH=os.path.join(tmp, "bench.db"), USE_RATE_LIMIT="false",
+               PORT=str(port), WEB_CONCURRENCY=str(workers), GUNICORN_THREADS=str(args.threads))
+    proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"],
+                            cwd=BACKEND, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_ready(port):
+            print(f"workers={workers}: gunicorn did not come up")
+            return None
+        time.sleep(0.5)  # let every worker finish booting
+        out = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=client, args=(port, args.path, args.duration, out))
+                   for _ in range(args.clients)]
+        for c in clients:
+            c.start()
+        results = [out.get() for _ in clients]
+        for c in clients:
+            c.join()
+    finally:
+        proc.terminate()
+        proc.wait(10)
+        shutil.rmtree(tmp, ignore_errors=True)
+    latencies = [x for r in results for x in r[0]]
+    errors = sum(r[1] for r in results)
+    rps = len(latencies) / args.duration
+    print(f"workers={workers:<3} req/s={rps:8.0f}  p50={percentile(latencies, 50) * 1000:6.2f}ms  "
+          f"p99={percentile(latencies, 99) * 1000:6.2f}ms  errors={errors}")
+    return rps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default='1,2,4', help='Comma separated worker counts')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent client processes')
+    parser.add_argument('--threads', type=int, default=8, help='Threads per worker (GUNICORN_THREADS)')
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds per run')
+    parser.add_argument('--path', default='/api/status', help='GET endpoint to load')
+    args = parser.parse_args()
+    print(f"CPU cores: {os.cpu_count()}  clients: {args.clients}  path: {args.path}")
+    base = None
+    for workers in [int(w) for w in args.workers.split(",") if w.strip()]:
+        rps = run(workers, args)
+        if rps and base is None:
+            base = rps
+        elif rps and base:
+            print(f"            {rps / base:.2f}x the first run")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+build_static.py - build the frontend for caching (served by nginx or backend/static_assets.py).
+Output layout (default frontend/dist):
+  index.html admin.html psbt.html          HTML entry points, referencing hashed assets
+  static/app.<hash>.js static/styles.<hash>.css ...   content-hashed copies (cache forever)
+  static/<every other frontend file>        unchanged names (revalidated with ETag)
+  static/service-worker.js                  precaches the hashed assets (cache name = build version)
+  asset-manifest.json                       {"version", "assets": {original: hashed}, "precache": [...]}
+Every text file also gets .gz and, when the brotli package is installed, .br siblings.
+Usage:
+  python tools/build_static.py [--src frontend] [--out frontend/dist]
+"""
+import argparse, gzip, hashlib, json, os, re, shutil, sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+PROJ = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+ENTRY_POINTS = ("index.html", "admin.html", "psbt.html")
+HASHED_EXTS = (".js", ".css")
+NOT_HASHED = ("service-worker.js",)  # must keep a stable URL to be updated by the browser
+COMPRESS_EXTS = (".html", ".js", ".css", ".json", ".svg", ".txt", ".webmanifest")
+MIN_COMPRESS = 256  # bytes; smaller files are not worth a variant
+
+
+def content_hash(data, length=10):
+    return hashlib.sha256(data).hexdigest()[:length]
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def compress(path, data, stats):
+    if not path.endswith(COMPRESS_EXTS) or len(data) < MIN_COMPRESS:
+        return
+    # mtime=0 keeps the output byte-identical between builds
+    gz = gzip.compress(data, 9, mtime=0)
+    write(path + ".gz", gz)
+    stats["raw"] += len(data)
+    stats["gzip"] += len(gz)
+    if brotli is not None:
+        br = brotli.compress(data, quality=11)
+        write(path + ".br", br)
+        stats["br"] += len(br)
+
+
+def rewrite_refs(text, assets):
+    for name, hashed in assets.items():
+        text = text.replace(f"/static/{name}", f"/static/{hashed}")
+    return text
+
+
+def service_worker(source, version, precache):
+    source = re.sub(r"const CACHE_NAME = '[^']*';", f"const CACHE_NAME = 'mining-static-{version}';", source, count=1)
+    return re.sub(r"const PRECACHE_URLS = \[[^\]]*\];", "const PRECACHE_URLS = " + json.dumps(precache) + ";",
+                  source, count=1)
+
+
+def build(src, out):
+    files = sorted(f for f in os.listdir(src) if os.path.isfile(os.path.join(src, f)))
+    assets = {}
+    for name in files:
+        if name.endswith(HASHED_EXTS) and name not in NOT_HASHED:
+            stem, ext = os.path.splitext(name)
+            assets[name] = f"{stem}.{content_hash(read(os.path.join(src, name)))}{ext}"
+    precache = ["/index.html"] + ["/static/" + h for h in sorted(assets.values())]
+    version = content_hash(json.dumps(assets, sort_keys=True).encode() +
+                           b"".join(read(os.path.join(src, n)) for n in ENTRY_POINTS if n in files))
+
+    if os.path.isdir(out):
+        shutil.rmtree(out)
+    stats = {"raw": 0, "gzip": 0, "br": 0}
+    for name in files:
+        data = read(os.path.join(src, name))
+        if name.endswith(".html"):
+            data = rewrite_refs(data.decode("utf-8"), assets).encode("utf-8")
+        elif name == "service-worker.js":
+            data = service_worker(data.decode("utf-8"), version, precache).encode("utf-8")
+        targets = [os.path.join(out, "static", name)]
+        if name in assets:
+            targets.append(os.path.join(out, "static", assets[name]))
+        if name in ENTRY_POINTS:
+            targets.append(os.path.join(out, name))
+        for target in targets:
+            write(target, data)
+            compress(target, data, stats)
+    manifest = {"version": version, "assets": assets, "precache": precache}
+    write(os.path.join(out, "asset-manifest.json"), json.dumps(manifest, indent=2).encode("utf-8"))
+    return manifest, stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--src', default=os.path.join(PROJ, "frontend"), help='Frontend source folder')
+    parser.add_argument('--out', default=None, help='Build output folder (default <src>/dist)')
+    args = parser.parse_args()
+    out = args.out or os.path.join(args.src, "dist")
+    if not os.path.isdir(args.src):
+        print(f"Frontend folder not found: {args.src}")
+        sys.exit(1)
+    if os.path.abspath(out) == os.path.abspath(args.src):
+        print("--out must differ from --src")
+        sys.exit(1)
+    manifest, stats = build(args.src, out)
+    print(f"Built {out} (version {manifest['version']})")
+    for name, hashed in manifest["assets"].items():
+        print(f"  {name} -> static/{hashed}")
+    if stats["raw"]:
+        line = f"Precompressed {stats['raw']} bytes: gzip {stats['gzip']} ({stats['gzip'] * 100 // stats['raw']}%)"
+        if brotli is not None:
+            line += f", brotli {stats['br']} ({stats['br'] * 100 // stats['raw']}%)"
+        else:
+            line += "; brotli skipped (pip install brotli)"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
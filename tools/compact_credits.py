@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+compact_credits.py - compact the credits ledger and verify it against the miner balances
+(see backend/credit_ledger.py). Meant to run from cron, e.g. hourly:
+  python tools/compact_credits.py compact [--raw-days 7] [--hourly-days 90] [--archive-dir DIR] [--vacuum]
+  python tools/compact_credits.py verify     (exit status 1 when a miner does not match its ledger)
+Raw credits older than --raw-days become one row per miner and hour, hourly rows older than
+--hourly-days one row per miner and day. Raw rows are appended to DIR/credits-YYYY-MM.csv.gz first
+(default backend/data/credit_archive; --no-archive drops them). The database is MINING_DB_PATH or
+backend/data/withdrawals.db, like the server.
+"""
+import argparse, json, os, sys, time
+
+PROJ = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+BACKEND = os.path.join(PROJ, "backend")
+sys.path.insert(0, BACKEND)
+import credit_ledger  # noqa: E402
+from db import get_pool, migrate  # noqa: E402
+
+
+def table_counts(path):
+    pool = get_pool(path)
+    conn = pool.acquire()
+    try:
+        return {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in ("credits", "credit_rollups")}
+    finally:
+        pool.release(conn)
+
+
+def db_size(path):
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+
+def cmd_compact(args):
+    before = table_counts(args.db)
+    size = db_size(args.db)
+    start = time.perf_counter()
+    stats = credit_ledger.compact(args.db, raw_days=args.raw_days, hourly_days=args.hourly_days,
+                                  archive_dir=None if args.no_archive else args.archive_dir,
+                                  batch_size=args.batch_size, log=print if args.verbose else None)
+    elapsed = time.perf_counter() - start
+    if args.vacuum:
+        pool = get_pool(args.db)
+        conn = pool.acquire()
+        try:
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            pool.release(conn)
+    after = table_counts(args.db)
+    print(f"Compacted in {elapsed:.1f}s: {stats['raw_rows']} raw credits -> hourly, "
+          f"{stats['hourly_rows']} hourly rows -> daily")
+    print(f"  credits {before['credits']} -> {after['credits']}, "
+          f"credit_rollups {before['credit_rollups']} -> {after['credit_rollups']}, "
+          f"database {size / 1e6:.1f} MB -> {db_size(args.db) / 1e6:.1f} MB")
+    if args.verify:
+        return cmd_verify(args)
+    return 0
+
+
+def cmd_verify(args):
+    result = credit_ledger.verify(args.db)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(f"Verified {result['miners']} miners: {len(result['problems'])} problem(s)")
+        for p in result["problems"][:20]:
+            print("  " + json.dumps(p))
+        if len(result["problems"]) > 20:
+            print(f"  ... {len(result['problems']) - 20} more (use --json)")
+    return 0 if result["ok"] else 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default=os.getenv("MINING_DB_PATH") or os.path.join(BACKEND, "data", "withdrawals.db"),
+                        help='SQLite database (default MINING_DB_PATH or backend/data/withdrawals.db)')
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("compact", help="Roll old credits into hourly / daily rows")
+    p.add_argument('--raw-days', type=float, default=7, help='Keep raw credits this many days')
+    p.add_argument('--hourly-days', type=float, default=90, help='Keep hourly rows this many days')
+    p.add_argument('--archive-dir', default=os.path.join(BACKEND, "data", "credit_archive"),
+                   help='Where raw credits are archived before deletion')
+    p.add_argument('--no-archive', action='store_true', help='Delete raw credits without archiving them')
+    p.add_argument('--batch-size', type=int, default=5000, help='Rows per transaction')
+    p.add_argument('--vacuum', action='store_true', help='VACUUM afterwards to return freed pages to the OS '
+                   '(blocks writers while it runs)')
+    p.add_argument('--verify', action='store_true', help='Run verify afterwards')
+    p.add_argument('--json', action='store_true', help='Verify output as JSON')
+    p.add_argument('--verbose', action='store_true', help='Print progress per batch')
+    p.set_defaults(func=cmd_compact)
+    p = sub.add_parser("verify", help="Check miners.shares / miners.balance against the ledger")
+    p.add_argument('--json', action='store_true', help='Print the full result as JSON')
+    p.set_defaults(func=cmd_verify)
+    args = parser.parse_args()
+    if not os.path.exists(args.db):
+        print(f"Database not found: {args.db}")
+        sys.exit(1)
+    migrate(args.db)
+    sys.exit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
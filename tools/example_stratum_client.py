@@ -4,34 +4,62 @@ example_stratum_client.py - simple TCP client to talk to the minimal Stratum ser
 Usage:
   python tools/example_stratum_client.py --url tcp://127.0.0.1:3333 --worker miner1
 """
-import socket, json, time, argparse
+import socket, json, time, argparse, os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from share_validator import validate_share  # noqa: E402
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--host', default='127.0.0.1', help='Stratum host')
 parser.add_argument('--port', type=int, default=3333, help='Stratum port')
 parser.add_argument('--worker', default='miner1', help='Worker name')
+parser.add_argument('--max-nonces', type=int, default=200000, help='Nonces to try for one share')
 args = parser.parse_args()
 
 def send(sock, obj):
     data = (json.dumps(obj) + "\n").encode('utf-8')
     sock.sendall(data)
 
+def read_messages(f, until):
+    # collect lines until a message with id == until arrives
+    msgs = []
+    while True:
+        line = f.readline()
+        if not line:
+            return msgs
+        msg = json.loads(line)
+        print(line.strip()[:200])
+        msgs.append(msg)
+        if msg.get("id") == until:
+            return msgs
+
 with socket.create_connection((args.host, args.port)) as s:
-    # subscribe
+    s.settimeout(10.0)
+    f = s.makefile('r')
+    # subscribe: result is [subscriptions, extranonce1, extranonce2_size], followed by set_difficulty and notify
     send(s, {"id": 1, "method": "mining.subscribe", "params": []})
-    time.sleep(0.5)
+    msgs = read_messages(f, 1)
+    extranonce1, en2_size = msgs[-1]["result"][1], msgs[-1]["result"][2]
     # authorize
     send(s, {"id": 2, "method": "mining.authorize", "params": [args.worker, "x"]})
-    time.sleep(0.5)
-    # submit a fake share
-    send(s, {"id": 3, "method": "mining.submit", "params": [args.worker, "jobid", "nonce123"]})
-    # read responses
-    s.settimeout(2.0)
-    try:
-        while True:
-            line = s.recv(4096)
-            if not line:
-                break
-            print(line.decode('utf-8').strip())
-    except Exception as e:
-        pass
+    msgs += read_messages(f, 2)
+    difficulty, job = 1.0, None
+    for m in msgs:
+        if m.get("method") == "mining.set_difficulty":
+            difficulty = m["params"][0]
+        elif m.get("method") == "mining.notify":
+            p = m["params"][1]
+            job = {"job_id": m["params"][0], "coinb1": p["coinb1"], "coinb2": p["coinb2"],
+                   "merkle_branch": p["merkle_branch"], "previousblockhash": p["prevhash"],
+                   "bits": p["nbits"], "version": p["version"], "curtime": p["ntime"]}
+    if job is None:
+        sys.exit("no job received")
+    # search for a share at the current difficulty (only practical on low-difficulty test pools)
+    extranonce2 = "00" * en2_size
+    ntime = "%08x" % job["curtime"]
+    for n in range(args.max_nonces):
+        nonce = "%08x" % n
+        if validate_share(job, extranonce1, extranonce2, ntime, nonce, difficulty, en2_size)[0]:
+            break
+    send(s, {"id": 3, "method": "mining.submit", "params": [args.worker, job["job_id"], extranonce2, ntime, nonce]})
+    read_messages(f, 3)